@@ -13,44 +13,46 @@ from dash import dash_table
 import plotly.express as px
 from dash.dependencies import Input, Output, State
 import os
+import math
+import functools
 from zipfile import ZipFile
 import urllib.parse
-from flask import Flask, send_from_directory
+from flask import Flask, send_from_directory, request, g, Response
 
 import pandas as pd
-import requests
 import uuid
 import json
 import dash_table
-from flask_caching import Cache
 
 import utils
+import download_resolver
+import dataset_loader
+import repositories
+import deadline
+import circuit_breaker
+import zenodo
 
 server = Flask(__name__)
 app = dash.Dash(__name__, server=server, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.title = 'GNPS2 - Dataset Browser'
 
-# Optionally turn on caching
-if __name__ == "__main__":
-    cache = Cache(app.server, config={
-        'CACHE_TYPE': "null",
-        #'CACHE_TYPE': 'filesystem',
-        'CACHE_DIR': 'temp/flask-cache',
-        'CACHE_DEFAULT_TIMEOUT': 0,
-        'CACHE_THRESHOLD': 1000000
-    })
-else:
-    WORKER_UP = True
-    cache = Cache(app.server, config={
-        #'CACHE_TYPE': "null",
-        'CACHE_TYPE': 'filesystem',
-        'CACHE_DIR': 'temp/flask-cache',
-        'CACHE_DEFAULT_TIMEOUT': 0,
-        'CACHE_THRESHOLD': 120
-    })
-
 server = app.server
 
+# Every callback and API request gets a time budget that all of its upstream calls share
+@server.before_request
+def _start_request_deadline():
+    g.deadline_token = deadline.start(deadline.REQUEST_BUDGET)
+
+@server.teardown_request
+def _end_request_deadline(exception):
+    deadline_token = g.pop("deadline_token", None)
+    if deadline_token is not None:
+        deadline.reset(deadline_token)
+
+@server.errorhandler(deadline.DeadlineExceeded)
+def _handle_deadline_exceeded(error):
+    return {"error": "timeout", "message": str(error), "budget": deadline.REQUEST_BUDGET}, 504
+
 
 NAVBAR = dbc.Navbar(
     children=[
@@ -192,10 +194,18 @@ DASHBOARD = [
                 columns=[{"name": "filename", "id": "filename"}],
                 data=[],
                 row_selectable='multi',
+                page_current=0,
                 page_size=10,
-                filter_action="native",
-                sort_action='native',
-                export_format="xlsx"),
+                page_action="custom",
+                filter_action="custom",
+                filter_query="",
+                sort_action='custom',
+                sort_by=[]),
+            # The table only has the current page, so the export is done on the server over the whole filtered listing
+            dbc.Button("Export All Filtered Files", color="secondary", size="sm", className="me-1", id="file-table-export"),
+            dcc.Download(id="file-table-export-download"),
+            dcc.Store(id='file-table-selection', data=[]),
+            dcc.Store(id='dataset_files_store'),
             html.Br(),
             html.Br(),
 
@@ -206,10 +216,17 @@ DASHBOARD = [
                 columns=[{"name": "filename", "id": "filename"}],
                 data=[],
                 row_selectable='multi',
+                page_current=0,
                 page_size= 10,
-                filter_action="native",
-                sort_action='native',
-                export_format="xlsx"),
+                page_action="custom",
+                filter_action="custom",
+                filter_query="",
+                sort_action='custom',
+                sort_by=[]),
+            # The table only has the current page, so the export is done on the server over the whole filtered listing
+            dbc.Button("Export All Filtered Files", color="secondary", size="sm", className="me-1", id="file-table2-export"),
+            dcc.Download(id="file-table2-export-download"),
+            dcc.Store(id='file-table2-selection', data=[]),
             html.Br(),
             html.Div([
                 dcc.Loading(
@@ -218,22 +235,61 @@ DASHBOARD = [
                     children=[html.Div(id="loading-output-9"),
                     ],
                 ),
+                html.Br(),
+                html.Div([
+                    html.Div(id="selected-dashboard-link"),
+                    html.Div(id="filtered-dashboard-link"),
+                    dcc.Dropdown(
+                        id='server-dropdown',
+                        options=[{'label': 'USA-UCR', 'value': 'us'}, {'label': 'De-Tue', 'value': 'de'}, {'label': 'Br', 'value': 'br'}],
+                        placeholder='Select Server: ',  # Set the default value to 'US Server'
+                        style={'width': '300px', 'color': 'black', 'cursor':'default',
+                                            'font-weight': 'bold', 'z-index': 1000, 'opacity': 1,
+                                            },
+                        value="us",
+                        searchable=False,
+                    )],
+                    style={'display': 'flex', 'align-items': 'center'}),
+                html.Hr(),
+                html.Div([
+                    html.Span(id="selected-networking-link"),
+                    html.Span(id="filtered-networking-link"),
+                ]),
+                html.Hr(),
+                html.H3("Selected USIs for Dataset"),
+                html.Hr(),
+                dcc.Textarea(
+                    id='usi-textarea',
+                    value="",
+                    style={'width': '100%', 'height': 300},
+                    readOnly=True
+                ),
+                html.Hr(),
+                html.H3("All USIs for Dataset"),
+                dcc.Textarea(
+                    id='usi-textarea-all',
+                    value="",
+                    style={'width': '100%', 'height': 300},
+                    readOnly=True
+                ),
+                html.Hr(),
+                html.H3("Selected USIs for Download"),
+
+                # Download links are only resolved when asked for, since it goes over the network
+                dbc.Button("Resolve Download Links for Selected Files", color="primary", className="me-1", id="resolve_downloads_button"),
+                html.Br(),
+                html.Br(),
 
                 # Making a download
-                # dbc.Button("Download All Selected", color="primary", className="me-1", id="download_all_button"),
+                dbc.Button("Download All Selected", color="primary", className="me-1", id="download_all_button"),
+
+                # Download links are resolved in the background and filled in progressively
+                html.Div(id="download-links"),
+                dcc.Interval(id="download-links-interval", interval=1000, disabled=True),
 
                 # Making a store
                 dcc.Store(id='download_links_store'),
-                
-                html.Div([dcc.Dropdown(
-                                                        id='server-dropdown',
-                                                        options=[{'label': 'USA-UCR', 'value': 'us'}, {'label': 'De-Tue', 'value': 'de'}],
-                                                        placeholder='Select Server: ',  # Set the default value to 'US Server'
-                                                        style={'width': '300px', 'color': 'black', 'cursor':'default',
-                                                                            'font-weight': 'bold', 'z-index': 1000, 'opacity': 1, 'display':'none'},   
-                                                        searchable=False,
-                                                        value="us",),
-                ]),
+                dcc.Store(id='download_usis_store'),
             ]),
          
             html.Hr(),
@@ -337,6 +393,7 @@ def _get_param_from_url(search, param_key, default):
     return default
 
 # Here in case we have a DOI
+@functools.lru_cache(maxsize=1024)
 def _resolve_accession(accession):
     if "doi" in accession:
         doi = accession.replace("doi:", "")
@@ -396,71 +453,21 @@ def _get_group_usi_string(gnps_task, metadata_column, metadata_term):
 
     return usi_string
 
-def _determine_usi_list(accession, file_table_data, selected_table_data, get_all=False, private=False):
-    usi_list = []
-
+def _determine_usi_list(files_df, selected_ids, get_all=False):
+    # USIs are already built for the whole dataset in utils.get_dataset_files
     if get_all is True:
-        for i in range(len(file_table_data)):
-            filename = file_table_data[i]["filename"]
+        return list(files_df["usi"])
 
-            # first check if usi is in the dataframe
-            if "usi" in file_table_data[i]:
-                usi = file_table_data[i]["usi"]
-            else:
-                # try to construct it here
-                if private:
-                    usi = "mzspec:PRIVATE{}:{}".format(accession, filename)
-                else:
-                    usi = "mzspec:{}:{}".format(accession, filename)
-
-                if len(accession) == 32:
-                    usi = "mzspec:GNPS:TASK-{}-{}".format(accession, filename)
-            
-            usi_list.append(usi)
-    else:
-        for selected_index in selected_table_data:
-            # first check if usi is in the dataframe
-            if "usi" in file_table_data[selected_index]:
-                usi = file_table_data[selected_index]["usi"]
-            
-            else:
-                filename = file_table_data[selected_index]["filename"]
-                if private:
-                    usi = "mzspec:PRIVATE{}:{}".format(accession, filename)
-                else:
-                    usi = "mzspec:{}:{}".format(accession, filename)
-
-                if len(accession) == 32:
-                    usi = "mzspec:GNPS:TASK-{}-{}".format(accession, filename)
-            
-            usi_list.append(usi)
+    return list(files_df["usi"].iloc[selected_ids])
 
-    return usi_list
 
+def _determine_gnps_list(accession, files_df, selected_ids, get_all=False):
+    if get_all is False:
+        files_df = files_df.iloc[selected_ids]
 
-def _determine_gnps_list(accession, file_table_data, selected_table_data, get_all=False):
-    file_list = []
+    gnps_path_prefix = utils.get_gnps_path_prefix(accession)
 
-    if get_all:
-        for i in range(len(file_table_data)):
-            filename = file_table_data[i]["filename"]
-            file_path = "f.{}/{}".format(accession, filename)
-
-            if len(accession) == 32:
-                file_path = "f.{}".format(filename)
-            
-            file_list.append(file_path)
-    else:
-        for selected_index in selected_table_data:
-            filename = file_table_data[selected_index]["filename"]
-            file_path = "f.{}/{}".format(accession, filename)
-
-            if len(accession) == 32:
-                file_path = "f.{}".format(filename)
-            
-            file_list.append(file_path)
-
-    return file_list
+    return list(gnps_path_prefix + files_df["filename"].map(str))
 
 def _determine_row_selection_list(file_table_data, selected_table_data, get_all=False):
     if get_all:
@@ -487,30 +494,43 @@ def get_formatted_analysis_link(name, server_dict, params, selected_server):
     return linkout_obj 
 
 
+# Dictionary to access the urls
+DASHBOARD_SERVERS = {
+    "us": "https://dashboard.gnps2.org/#",
+    "de": "http://de.dashboard.gnps2.org/#",
+    "br": "http://br.dashboard.gnps2.org/#"
+}
+
+GNPS2_SERVERS = {
+    "us": "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow#",
+    "de": "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow#",
+    "br": "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow#"
+}
+
+# This only reruns on selection changes and stays cheap, no network calls here
 @app.callback([   
                   Output('link-button', 'children'),
-                  Output('download_links_store', 'data'),
+                  Output('selected-dashboard-link', 'children'),
+                  Output('selected-networking-link', 'children'),
+                  Output('usi-textarea', 'value'),
+                  Output('download_usis_store', 'data'),
               ],
               [   
-                  Input('dataset_accession', 'value'), 
-                  Input('dataset_password', 'value'), 
-                  Input('file-table', 'derived_virtual_data'),
-                  Input('file-table', 'derived_virtual_selected_rows'),
-                  Input('file-table2', 'derived_virtual_data'),
-                  Input('file-table2', 'derived_virtual_selected_rows'),
+                  Input('file-table-selection', 'data'),
+                  Input('file-table2-selection', 'data'),
                   Input('server-dropdown', 'value'),             
+              ],
+              [
+                  State('dataset_files_store', 'data'),
               ])
+def create_link(selected_ids, selected_ids2, selected_server, dataset_files):
+    try:
+        files_df = _get_stored_files_df(dataset_files)
+    except:
+        raise PreventUpdate
 
-def create_link(accession, dataset_password, file_table_data, selected_table_data, file_table_data2, selected_table_data2,selected_server):
-    
-    is_private = False
-    if len(dataset_password) > 0:
-        is_private = True
-
-    accession = _resolve_accession(accession)
-
-    usi_list1 = _determine_usi_list(accession, file_table_data, selected_table_data, private=is_private)
-    usi_list2 = _determine_usi_list(accession, file_table_data2, selected_table_data2, private=is_private)
+    usi_list1 = _determine_usi_list(files_df, selected_ids or [])
+    usi_list2 = _determine_usi_list(files_df, selected_ids2 or [])
 
     usi_string1 = "\n".join(usi_list1)
     usi_string2 = "\n".join(usi_list2)
@@ -522,55 +542,11 @@ def create_link(accession, dataset_password, file_table_data, selected_table_dat
 
     total_file_count = len(usi_list1) + len(usi_list2)
 
-    # Dictionary to access the urls
-    dashboard_servers = {
-        "us": "https://dashboard.gnps2.org/#",
-        "de": "http://de.dashboard.gnps2.org/#",
-        "br": "http://br.dashboard.gnps2.org/#"
-    }
-
-    gnps2_servers = {
-        "us": "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow#",
-        "de": "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow#",
-        "br": "https://gnps2.org/workflowinput?workflowname=classical_networking_workflow#"
-    }
-    
     url_provenance = dbc.Button("Visualize {} Files in GNPS2 Dashboard".format(total_file_count), color="primary", className="me-1")
-    link_selected_object = get_formatted_analysis_link(url_provenance, dashboard_servers, url_params, selected_server)
-
-    # Selecting the max of all files
-    all_usi_list1 = _determine_usi_list(accession, file_table_data, selected_table_data, get_all=True, private=is_private)
-    all_usi_list1_complete = all_usi_list1
-    all_usi_list1 = all_usi_list1[:24] # Lets limit to 24 here
-
-    all_usi_list2 = _determine_usi_list(accession, file_table_data2, selected_table_data2, get_all=True, private=is_private)
-    all_usi_list2 = all_usi_list2[:24] # Lets limit to 24 here
-    
-    url_params = {}
-    url_params["usi"] = "\n".join(all_usi_list1)
-    url_params["usi2"] = "\n".join(all_usi_list2)
-
-    link_all_to_dashboard = dbc.Button("Visualize All Filtered {} Files (24 max each) in GNPS2 Dashboard".format(len(all_usi_list1) + len(all_usi_list2)), color="primary", className="me-1")
-    link_all_to_dashboard_object = get_formatted_analysis_link(link_all_to_dashboard, dashboard_servers, url_params, selected_server)
-
+    link_selected_object = get_formatted_analysis_link(url_provenance, DASHBOARD_SERVERS, url_params, selected_server)
 
     # Creating the set of USIs in text area
     unique_selected_usis = set(usi_list1 + usi_list2)
-    usi_textarea = dcc.Textarea(
-        id='usi-textarea',
-        value="\n".join(unique_selected_usis),
-        style={'width': '100%', 'height': 300},
-        readOnly=True
-    )
-
-    # Create a set of USIs for all files in a text area
-    unique_all_usis = set(all_usi_list1_complete)
-    usi_textarea_all = dcc.Textarea(
-        id='usi-textarea-all',
-        value="\n".join(unique_all_usis),
-        style={'width': '100%', 'height': 300},
-        readOnly=True
-    )
     
     # For selected GNPS2 USIs
     gnps2_parameters = {}
@@ -579,106 +555,268 @@ def create_link(accession, dataset_password, file_table_data, selected_table_dat
 
 
     gnps2_selected_networking_button = dbc.Button("Molecular Network Selected {} Files at GNPS2".format(len(usi_list1)), color="primary", className="me-1")
-    gnps2_selected_networking_link = get_formatted_analysis_link(gnps2_selected_networking_button, gnps2_servers, gnps2_parameters, selected_server)
+    gnps2_selected_networking_link = get_formatted_analysis_link(gnps2_selected_networking_button, GNPS2_SERVERS, gnps2_parameters, selected_server)
     #gnps2_selected_networking_link = dcc.Link(gnps2_selected_networking_button, href=servers.get("us_network"), target="_blank")
 
+    # Selection Text
+    selection_text = "Selected {} Default Files and {} Comparison Files for LCMS Analysis".format(len(usi_list1), len(usi_list2))
+
+    return [
+        [
+            html.Br(), 
+            html.Hr(), 
+            selection_text, 
+            html.Br(), 
+        ],
+        link_selected_object,
+        gnps2_selected_networking_link,
+        "\n".join(unique_selected_usis),
+        usi_list1
+    ]
+
+# This reruns when filtering or sorting the tables, but only looks at the first files
+@app.callback([
+                  Output('filtered-dashboard-link', 'children'),
+                  Output('filtered-networking-link', 'children'),
+              ],
+              [
+                  Input('file-table', 'filter_query'),
+                  Input('file-table', 'sort_by'),
+                  Input('file-table2', 'filter_query'),
+                  Input('file-table2', 'sort_by'),
+                  Input('dataset_files_store', 'data'),
+                  Input('server-dropdown', 'value'),
+              ])
+def create_filtered_link(filter_query, sort_by, filter_query2, sort_by2, dataset_files, selected_server):
+    try:
+        files_df = _get_stored_files_df(dataset_files)
+    except:
+        raise PreventUpdate
+
+    # Selecting the max of all files, Lets limit to 24 here
+    filtered_df1 = _sort_files_df(_filter_files_df(files_df, filter_query), sort_by).head(24)
+    filtered_df2 = _sort_files_df(_filter_files_df(files_df, filter_query2), sort_by2).head(24)
+
+    all_usi_list1 = _determine_usi_list(filtered_df1, [], get_all=True)
+    all_usi_list2 = _determine_usi_list(filtered_df2, [], get_all=True)
+    
+    url_params = {}
+    url_params["usi"] = "\n".join(all_usi_list1)
+    url_params["usi2"] = "\n".join(all_usi_list2)
+
+    link_all_to_dashboard = dbc.Button("Visualize All Filtered {} Files (24 max each) in GNPS2 Dashboard".format(len(all_usi_list1) + len(all_usi_list2)), color="primary", className="me-1")
+    link_all_to_dashboard_object = get_formatted_analysis_link(link_all_to_dashboard, DASHBOARD_SERVERS, url_params, selected_server)
+
     # All USIs
     gnps2_parameters = {}
     gnps2_parameters["usi"] = "\n".join(all_usi_list1)
     gnps2_parameters["description"] = "USI Molecular Networking Analysis"
 
     gnps2_all_networking_button = dbc.Button("Molecular Network All {} Files at GNPS2".format(len(all_usi_list1)), color="primary", className="me-1")
-    gnps2_all_networking_link = get_formatted_analysis_link(gnps2_all_networking_button, gnps2_servers, gnps2_parameters, selected_server)
+    gnps2_all_networking_link = get_formatted_analysis_link(gnps2_all_networking_button, GNPS2_SERVERS, gnps2_parameters, selected_server)
     #gnps2_all_networking_link = dcc.Link(gnps2_all_networking_button, href=servers.get("us_network"), target="_blank")
 
+    return [link_all_to_dashboard_object, gnps2_all_networking_link]
 
-    # Lets create download links to the original source location
-    download_links_list = []
-    if len(usi_list1) > 0:
-        download_button_list = []
+# This only reruns when a new dataset is loaded into the table
+@app.callback(
+              Output('usi-textarea-all', 'value'),
+              [
+                  Input('dataset_files_store', 'data'),
+              ])
+def create_all_usi_text(dataset_files):
+    try:
+        files_df = _get_stored_files_df(dataset_files)
+    except:
+        return ""
 
-        for usi in usi_list1:
-            # getting the url from the dashboard
-            resolve_url = "https://dashboard.gnps2.org/downloadlink?usi={}".format(usi)
-            try:
-                r = requests.get(resolve_url)
+    # Create a set of USIs for all files in a text area
+    unique_all_usis = set(_determine_usi_list(files_df, [], get_all=True))
 
-                if r.status_code == 200:
-                    download_url = r.text
-                    download_button = dbc.Button("Download {}".format(usi), color="primary", className="me-1")
-                    download_link = dcc.Link(download_button, href=download_url, target="_blank")
+    return "\n".join(unique_all_usis)
 
-                    download_links_list.append(download_url)
+# Download links are only resolved on request since they go over the network
+@app.callback([
+                  Output('download-links', 'children'),
+                  Output('download_links_store', 'data'),
+                  Output('download-links-interval', 'disabled'),
+              ],
+              [
+                  Input('resolve_downloads_button', 'n_clicks'),
+                  Input('download-links-interval', 'n_intervals'),
+                  Input('download_usis_store', 'data'),
+              ])
+def update_download_links(n_clicks, n_intervals, usi_list):
+    triggered_props = [triggered["prop_id"] for triggered in dash.callback_context.triggered]
 
-                    download_button_list.append(download_link)
-                    download_button_list.append(html.Br())
-                    download_button_list.append(html.Br())
-            except:
-                pass
+    # A new selection clears out the previous links until asked again
+    if "download_usis_store.data" in triggered_props or usi_list is None or len(usi_list) == 0:
+        return [html.Br(), [], True]
 
-        download_links = html.Div(download_button_list)
-    else:
-        download_links = html.Br()
+    # When polling, we only pick up what has been resolved in the background
+    resolve_deadline = download_resolver.RESOLVE_DEADLINE
+    if "download-links-interval.n_intervals" in triggered_props:
+        resolve_deadline = 0
 
-    # Selection Text
-    selection_text = "Selected {} Default Files and {} Comparison Files for LCMS Analysis".format(len(usi_list1), len(usi_list2))
+    resolved_links, pending_usis = download_resolver.resolve_download_links(usi_list, deadline=resolve_deadline)
 
-    return [
-    [
-        html.Br(), 
-        html.Hr(), 
-        selection_text, 
-        html.Br(), 
-        html.Br(),
-        html.Div([link_selected_object, link_all_to_dashboard_object, dcc.Dropdown(
-                                                    id='server-dropdown',
-                                                    options=[{'label': 'USA-UCR', 'value': 'us'}, {'label': 'De-Tue', 'value': 'de'}, {'label': 'Br', 'value': 'br'}],
-                                                    placeholder='Select Server: ',  # Set the default value to 'US Server'
-                                                    style={'width': '300px', 'color': 'black', 'cursor':'default',
-                                                                        'font-weight': 'bold', 'z-index': 1000, 'opacity': 1, 
-                                                                        },
-                                                    value=selected_server,
-                                                    searchable=False,
-        
-                                                )],
-                style={'display': 'flex', 'align-items': 'center'}),
-        html.Hr(),
-        gnps2_selected_networking_link,
-        gnps2_all_networking_link,
-        html.Hr(),
-        html.H3("Selected USIs for Dataset"),
-        html.Hr(),
-        usi_textarea,
-        html.Hr(),
-        html.H3("All USIs for Dataset"),
-        usi_textarea_all,
-        html.Hr(),
-        html.H3("Selected USIs for Download"),
-        download_links
-    ],
-    download_links_list
-]
+    # Lets create download links to the original source location
+    download_links_list = []
+    download_button_list = []
+    for usi, download_url in resolved_links:
+        download_button = dbc.Button("Download {}".format(usi), color="primary", className="me-1")
+        download_link = dcc.Link(download_button, href=download_url, target="_blank")
+
+        download_links_list.append(download_url)
 
+        download_button_list.append(download_link)
+        download_button_list.append(html.Br())
+        download_button_list.append(html.Br())
+
+    if len(pending_usis) > 0:
+        download_button_list.append(html.Div("Resolving download links for {} more files...".format(len(pending_usis))))
+
+    return [html.Div(download_button_list), download_links_list, len(pending_usis) == 0]
 
 
     
 
-@cache.memoize()
 def _get_dataset_files(accession, metadata_source, dataset_password="", metadata_option=None):
-    return utils.get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+    return dataset_loader.get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
 
-@cache.memoize()
 def _get_dataset_description(accession):
-    return utils.get_dataset_description(accession)
+    return dataset_loader.get_dataset_description(accession)
 
-# This function will rerun at any time that the selection is updated for column
+# Each of the dataset callbacks starts loading everything for the dataset, whichever runs first
+def _prefetch_dataset(accession, dataset_password, metadata_source, metadata_option):
+    try:
+        dataset_loader.prefetch(_resolve_accession(accession), metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+    except:
+        pass
+
+TABLE_ID_COLUMN = "metadata id"
+
+# The tables only get their current page from the server, recent datasets stay in memory in the dataset cache
+def _get_table_files_df(accession, dataset_password, metadata_source, metadata_option):
+    accession = _resolve_accession(accession)
+
+    files_df = _get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+
+    # The tables use "id" for the row ids, an id column from the metadata is kept under another name
+    if "id" in files_df.columns:
+        files_df = files_df.rename(columns={"id": TABLE_ID_COLUMN})
+
+    return files_df
+
+def _get_stored_files_df(dataset_files):
+    return _get_table_files_df(dataset_files["accession"], dataset_files["dataset_password"], dataset_files["metadata_source"], dataset_files["metadata_option"])
+
+FILTER_OPERATORS = [['ge ', '>='],
+                    ['le ', '<='],
+                    ['lt ', '<'],
+                    ['gt ', '>'],
+                    ['ne ', '!='],
+                    ['eq ', '='],
+                    ['contains '],
+                    ['datestartswith ']]
+
+def _split_filter_part(filter_part):
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value = value_part.strip()
+                if len(value) > 1 and value[0] == value[-1] and value[0] in ("'", '"', '`'):
+                    value = value[1: -1].replace('\\' + value[0], value[0])
+
+                return name, operator_type[0].strip(), value
+
+    return [None] * 3
+
+def _filter_files_df(files_df, filter_query):
+    if filter_query is None or len(filter_query) == 0:
+        return files_df
+
+    for filter_part in filter_query.split(' && '):
+        column, operator, value = _split_filter_part(filter_part)
+
+        if column not in files_df:
+            continue
+
+        column_values = files_df[column]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if pd.api.types.is_numeric_dtype(column_values):
+                try:
+                    value = float(value)
+                except ValueError:
+                    return files_df.iloc[0:0]
+            else:
+                column_values = column_values.astype(str)
+
+            files_df = files_df.loc[getattr(column_values, operator)(value)]
+        elif operator == 'contains':
+            files_df = files_df.loc[column_values.astype(str).str.contains(value, regex=False)]
+        elif operator == 'datestartswith':
+            files_df = files_df.loc[column_values.astype(str).str.startswith(value)]
+
+    return files_df
+
+def _sort_files_df(files_df, sort_by):
+    sort_by = [sort_column for sort_column in (sort_by or []) if sort_column["column_id"] in files_df]
+    if len(sort_by) == 0:
+        return files_df
+
+    sort_columns = [sort_column["column_id"] for sort_column in sort_by]
+    ascending = [sort_column["direction"] == "asc" for sort_column in sort_by]
+
+    try:
+        return files_df.sort_values(sort_columns, ascending=ascending)
+    except TypeError:
+        # Mixed types in a column, lets just sort it as text
+        return files_df.sort_values(sort_columns, ascending=ascending, key=lambda column_values: column_values.astype(str))
+
+def _get_table_page(files_df, page_current, page_size, sort_by, filter_query, selected_ids):
+    files_df = _sort_files_df(_filter_files_df(files_df, filter_query), sort_by)
+
+    page_count = max(math.ceil(len(files_df) / page_size), 1)
+    page_current = min(page_current or 0, page_count - 1)
+
+    page_df = files_df.iloc[page_current * page_size:(page_current + 1) * page_size]
+    page_df = page_df.drop(columns=["usi"], errors="ignore")
+
+    # The row ids are the position in the whole dataset so that selections survive paging, sorting and filtering
+    page_df = page_df.assign(id=page_df.index)
+    page_data = page_df.to_dict(orient="records")
+
+    selected_ids = set(selected_ids or [])
+    selected_rows = [i for i, row in enumerate(page_data) if row["id"] in selected_ids]
+
+    return page_data, page_count, selected_rows
+
+def _export_table(dataset_files, sort_by, filter_query):
+    files_df = _sort_files_df(_filter_files_df(_get_stored_files_df(dataset_files), filter_query), sort_by)
+
+    return dcc.send_data_frame(files_df.to_csv, "{}_files.csv".format(dataset_files["accession"]), index=False)
+
+def _update_selection(selected_row_ids, page_data, selected_ids):
+    # Only the current page can change the selection, everything else we keep
+    page_ids = set(row["id"] for row in (page_data or []))
+    selected_ids = set(selected_ids or []) - page_ids
+    selected_ids |= set(selected_row_ids or [])
+
+    return sorted(selected_ids)
+
+# This function will rerun at any time that the dataset is changed, the tables then fetch their pages
 @app.callback(
     [
         Output('file-summary', 'children'), 
-        Output('file-table', 'data'), 
-        Output('file-table', 'columns'), 
-        Output('file-table2', 'data'), 
-        Output('file-table2', 'columns')],
+        Output('dataset_files_store', 'data'), 
+        Output('file-table', 'page_current'), 
+        Output('file-table-selection', 'data'), 
+        Output('file-table2', 'page_current'), 
+        Output('file-table2-selection', 'data')],
     [
         Input('dataset_accession', 'value'), 
         Input('dataset_password', 'value'), 
@@ -689,23 +827,149 @@ def _get_dataset_description(accession):
 def list_files(accession, dataset_password, metadata_source, metadata_option):
     columns = [{"name": "filename", "id": "filename"}]
 
-    accession = _resolve_accession(accession)
+    _prefetch_dataset(accession, dataset_password, metadata_source, metadata_option)
 
     # If this errors out, then we want to clear the table
     try:
-        files_df = _get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+        files_df = _get_table_files_df(accession, dataset_password, metadata_source, metadata_option)
+    except deadline.DeadlineExceeded:
+        # The prefetch keeps loading it in the background, so trying again later is fast
+        return [html.Div("Timeout: This dataset is taking longer than {} seconds to load, please try again in a moment".format(int(deadline.REQUEST_BUDGET))), None, 0, [], 0, []]
     except:
-        return [html.Div("Error: Finding files for this dataset"), [], columns, [], columns]
+        return [html.Div("Error: Finding files for this dataset"), None, 0, [], 0, []]
 
     new_columns = files_df.columns
     for column in new_columns:
-        if column == "filename":
+        # The USIs are only for building links, not shown in the table
+        if column == "filename" or column == "usi":
             continue
         columns.append({"name": column, "id": column})
 
     file_summary = html.Div("This dataset contains {} files that can be viewed by GNPS2 Dashboard or other GNPS Tools (i.e. mzML, mzXML, .mgf, .raw files)".format(len(files_df)))
 
-    return [[file_summary], files_df.to_dict(orient="records"), columns, files_df.to_dict(orient="records"), columns]
+    # Both tables share this handle to the server side listing, the files themselves are never sent in full
+    dataset_files = {
+        "accession": accession,
+        "dataset_password": dataset_password,
+        "metadata_source": metadata_source,
+        "metadata_option": metadata_option,
+        "file_count": len(files_df),
+        "columns": columns
+    }
+
+    return [[file_summary], dataset_files, 0, [], 0, []]
+
+# Both tables get their columns from the shared handle
+app.clientside_callback(
+    """
+    function(dataset_files) {
+        var columns = [{"name": "filename", "id": "filename"}];
+        if (dataset_files) {
+            columns = dataset_files["columns"];
+        }
+        return [columns, columns];
+    }
+    """,
+    [
+        Output('file-table', 'columns'),
+        Output('file-table2', 'columns'),
+    ],
+    [
+        Input('dataset_files_store', 'data'),
+    ]
+)
+
+@app.callback(
+    [
+        Output('file-table', 'data'),
+        Output('file-table', 'page_count'),
+        Output('file-table', 'selected_rows'),
+    ],
+    [
+        Input('dataset_files_store', 'data'),
+        Input('file-table', 'page_current'),
+        Input('file-table', 'page_size'),
+        Input('file-table', 'sort_by'),
+        Input('file-table', 'filter_query'),
+    ],
+    [
+        State('file-table-selection', 'data'),
+    ]
+)
+def update_file_table(dataset_files, page_current, page_size, sort_by, filter_query, selected_ids):
+    try:
+        files_df = _get_stored_files_df(dataset_files)
+    except:
+        return [[], 1, []]
+
+    return list(_get_table_page(files_df, page_current, page_size, sort_by, filter_query, selected_ids))
+
+@app.callback(
+    [
+        Output('file-table2', 'data'),
+        Output('file-table2', 'page_count'),
+        Output('file-table2', 'selected_rows'),
+    ],
+    [
+        Input('dataset_files_store', 'data'),
+        Input('file-table2', 'page_current'),
+        Input('file-table2', 'page_size'),
+        Input('file-table2', 'sort_by'),
+        Input('file-table2', 'filter_query'),
+    ],
+    [
+        State('file-table2-selection', 'data'),
+    ]
+)
+def update_file_table2(dataset_files, page_current, page_size, sort_by, filter_query, selected_ids):
+    try:
+        files_df = _get_stored_files_df(dataset_files)
+    except:
+        return [[], 1, []]
+
+    return list(_get_table_page(files_df, page_current, page_size, sort_by, filter_query, selected_ids))
+
+@app.callback(
+    Output('file-table-export-download', 'data'),
+    [Input('file-table-export', 'n_clicks')],
+    [State('dataset_files_store', 'data'), State('file-table', 'sort_by'), State('file-table', 'filter_query')],
+    prevent_initial_call=True
+)
+def export_file_table(n_clicks, dataset_files, sort_by, filter_query):
+    if dataset_files is None:
+        raise PreventUpdate
+
+    return _export_table(dataset_files, sort_by, filter_query)
+
+@app.callback(
+    Output('file-table2-export-download', 'data'),
+    [Input('file-table2-export', 'n_clicks')],
+    [State('dataset_files_store', 'data'), State('file-table2', 'sort_by'), State('file-table2', 'filter_query')],
+    prevent_initial_call=True
+)
+def export_file_table2(n_clicks, dataset_files, sort_by, filter_query):
+    if dataset_files is None:
+        raise PreventUpdate
+
+    return _export_table(dataset_files, sort_by, filter_query)
+
+@app.callback(
+    Output('file-table-selection', 'data', allow_duplicate=True),
+    [Input('file-table', 'selected_row_ids')],
+    [State('file-table', 'data'), State('file-table-selection', 'data')],
+    prevent_initial_call=True
+)
+def update_file_table_selection(selected_row_ids, page_data, selected_ids):
+    return _update_selection(selected_row_ids, page_data, selected_ids)
+
+@app.callback(
+    Output('file-table2-selection', 'data', allow_duplicate=True),
+    [Input('file-table2', 'selected_row_ids')],
+    [State('file-table2', 'data'), State('file-table2-selection', 'data')],
+    prevent_initial_call=True
+)
+def update_file_table2_selection(selected_row_ids, page_data, selected_ids):
+    return _update_selection(selected_row_ids, page_data, selected_ids)
 
 # Metadata Options
 @app.callback(
@@ -717,16 +981,24 @@ def list_files(accession, dataset_password, metadata_source, metadata_option):
         Input("metadata_source", "value")
     ],
     [
-        State('url', 'search')
+        State('url', 'search'),
+        State('metadata_option', 'value')
     ]
 )
-def list_metadata_options(accession, dataset_password, metadata_source, url_search):
+def list_metadata_options(accession, dataset_password, metadata_source, url_search, metadata_option):
+    _prefetch_dataset(accession, dataset_password, metadata_source, metadata_option)
+
     # clean the DOI
     accession = _resolve_accession(accession)
 
-    msv_accession = utils._accession_to_msv_accession(accession)
-    
-    metadata_list = utils._get_massive_metadata_options(msv_accession)
+    if not repositories.has_capability(accession, repositories.CAPABILITY_METADATA_OPTIONS):
+        raise PreventUpdate
+
+    try:
+        metadata_list = dataset_loader.get_metadata_options(accession)
+    except deadline.DeadlineExceeded:
+        # Keeping the current options, they are still loading in the background
+        raise PreventUpdate
 
     options = []
     options_set = set()
@@ -751,13 +1023,18 @@ def list_metadata_options(accession, dataset_password, metadata_source, url_sear
 @app.callback(
     [Output('dataset-title', 'children'), Output('dataset-details', 'children')],
     [Input('dataset_accession', 'value'), Input('dataset_password', 'value')],
+    [State("metadata_source", "value"), State("metadata_option", "value")],
 )
-def dataset_information(accession, dataset_password):
+def dataset_information(accession, dataset_password, metadata_source, metadata_option):
     
+    _prefetch_dataset(accession, dataset_password, metadata_source, metadata_option)
+
     accession = _resolve_accession(accession)
 
     try:
         dataset_title, dataset_description = _get_dataset_description(accession)
+    except deadline.DeadlineExceeded:
+        return ["Dataset - {}".format(accession), "Timeout: The dataset description is taking too long to load, please try again in a moment"]
     except:
         if len(dataset_password) > 0:
             return ["Private Dataset - {}".format(accession), "Private Dataset No Description"]
@@ -779,9 +1056,18 @@ def set_page_size(page_size):
 
 app.clientside_callback(
     """
-    function(n_clicks, data) {
+    async function(n_clicks, usi_list) {
         original_text = "Click to Download All Selected"
         if (n_clicks > 0) {
+            // resolving all the download links in a single batch call
+            const response = await fetch("/api/resolve_downloads", {
+                method: "POST",
+                headers: {"Content-Type": "application/json"},
+                body: JSON.stringify({"usis": usi_list || []})
+            });
+            const resolved = await response.json();
+            const data = Object.values(resolved["resolved"]);
+
             console.log(data)
             // looping through all links and forcing a download on the user
             for (var i = 0; i < data.length; i++) {
@@ -808,7 +1094,7 @@ app.clientside_callback(
         Input('download_all_button', 'n_clicks'),
     ],
     [
-        State('download_links_store', 'data'),
+        State('download_usis_store', 'data'),
     ]
 )
 
@@ -819,5 +1105,53 @@ def get_dataset_files(accession):
     
     return dataset_files_df.to_json(orient="records")
 
+@app.server.route('/api/resolve_downloads', methods=['GET', 'POST'])
+def resolve_downloads():
+    if request.method == "POST":
+        usi_list = (request.get_json(silent=True) or {}).get("usis", [])
+    else:
+        usi_list = request.args.getlist("usi")
+
+    if not isinstance(usi_list, list) or len(usi_list) > download_resolver.MAX_BATCH_SIZE:
+        return {"error": "Expected a list of at most {} USIs".format(download_resolver.MAX_BATCH_SIZE)}, 400
+
+    usi_list = [usi for usi in usi_list if isinstance(usi, str)]
+    # Whatever is not resolved within the request budget is returned as pending
+    resolved_links, pending_usis = download_resolver.resolve_download_links(usi_list, deadline=deadline.bound_timeout(download_resolver.BATCH_RESOLVE_DEADLINE))
+
+    return {
+        "resolved": dict(resolved_links),
+        "pending": pending_usis
+    }
+
+@app.server.route('/api/zenodo/<record>/member')
+def get_zenodo_zip_member(record):
+    zip_filename = request.args.get("zip", "")
+    member_filename = request.args.get("member", "")
+
+    zip_member = zenodo.get_zip_member(record, zip_filename, member_filename)
+    if zip_member is None:
+        return {"error": "No member {} in {} of Zenodo record {}".format(member_filename, zip_filename, record)}, 404
+
+    url, zip_member = zip_member
+    try:
+        member_chunks = zenodo.open_zip_member(url, zip_member)
+    except NotImplementedError as error:
+        return {"error": str(error)}, 501
+
+    # Streamed as it is inflated, the size is known from the central directory
+    return Response(member_chunks, mimetype="application/octet-stream", headers={
+        "Content-Length": str(zip_member["file_size"]),
+        "Content-Disposition": "attachment; filename=\"{}\"".format(os.path.basename(member_filename)),
+    })
+
+@app.server.route('/api/status')
+def status():
+    # Each worker process has its own breakers, this is the one that answered
+    return {
+        "pid": os.getpid(),
+        "upstreams": circuit_breaker.get_status()
+    }
+
 if __name__ == "__main__":
     app.run_server(debug=True, port=5000, host="0.0.0.0")
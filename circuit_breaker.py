@@ -0,0 +1,151 @@
+import time
+import threading
+import contextlib
+
+import requests
+
+import deadline
+
+# Consecutive failed calls, each with all of its retries, after which we stop calling an upstream, and how long until we probe it again
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling an upstream that is known to be down
+
+    It is a connection error, so callers fall back to their next option the same way they do when the upstream is down.
+    """
+
+class CircuitBreaker:
+    """Failure state of one upstream host, shared by all the threads of a worker
+
+    Closed, calls go through. Open, calls fail right away. Half open, after RESET_TIMEOUT
+    a single call is let through as a probe and its outcome closes or opens the breaker again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = STATE_CLOSED
+        self.failure_count = 0
+        self.opened_time = None
+        self.last_failure = None
+        self.is_probing = False
+
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return
+
+            if self.state == STATE_OPEN and time.time() - self.opened_time >= RESET_TIMEOUT:
+                self.state = STATE_HALF_OPEN
+
+            if self.state == STATE_HALF_OPEN and not self.is_probing:
+                self.is_probing = True
+                return
+
+        raise CircuitOpenError("Circuit open for {}, last failure: {}".format(self.name, self.last_failure))
+
+    def is_open(self):
+        return self.state == STATE_OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = STATE_CLOSED
+            self.failure_count = 0
+            self.opened_time = None
+            self.is_probing = False
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failure_count += 1
+            self.last_failure = repr(error)
+
+            if self.state == STATE_HALF_OPEN or self.failure_count >= FAILURE_THRESHOLD:
+                self.state = STATE_OPEN
+                self.opened_time = time.time()
+
+            self.is_probing = False
+
+    def release(self):
+        # The call ended without telling us anything about the upstream, e.g. the request ran out of time first
+        with self._lock:
+            self.is_probing = False
+
+    def get_status(self):
+        with self._lock:
+            status = {
+                "state": self.state,
+                "failure_count": self.failure_count,
+                "last_failure": self.last_failure,
+            }
+
+            if self.opened_time is not None:
+                status["opened_time"] = self.opened_time
+                status["retry_time"] = self.opened_time + RESET_TIMEOUT
+
+            return status
+
+def is_network_error(error):
+    # Connection errors, timeouts and requests exceptions, not errors in handling what the upstream returned
+    return isinstance(error, OSError)
+
+def get_breaker(name):
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+
+        return _breakers[name]
+
+@contextlib.contextmanager
+def guard(name, is_failure=lambda error: True):
+    """Runs the block through the breaker of an upstream
+
+    Args:
+        name (str): upstream the block calls, usually the host name
+        is_failure (function): tells if an exception of the block means the upstream is failing
+
+    Raises:
+        CircuitOpenError: if the upstream is known to be down, without running the block
+    """
+
+    breaker = get_breaker(name)
+    breaker.before_call()
+
+    try:
+        yield
+    except deadline.DeadlineExceeded:
+        breaker.release()
+        raise
+    except Exception as error:
+        if is_failure(error):
+            breaker.record_failure(error)
+        else:
+            breaker.record_success()
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    else:
+        breaker.record_success()
+
+def get_status():
+    """State of every upstream we have called in this worker"""
+
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+
+    return {breaker.name: breaker.get_status() for breaker in breakers}
+
+def reset():
+    with _breakers_lock:
+        _breakers.clear()
@@ -0,0 +1,441 @@
+import os
+import io
+import json
+import time
+import pickle
+import hashlib
+import functools
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # No cross process locking on this platform, we still dedupe across threads
+    fcntl = None
+
+import pandas as pd
+
+import deadline
+
+# On disk store shared by all the workers, with an in-process LRU in front of it
+CACHE_DIR = os.path.join("temp", "dataset-cache")
+MEMORY_BUDGET_BYTES = 512 * 1024 * 1024
+DISK_BUDGET_BYTES = 20 * 1024 * 1024 * 1024
+DISK_PRUNE_INTERVAL = 100
+
+# How long a caller waits for someone else computing the same key before doing it themselves
+LOCK_TIMEOUT = 600
+LOCK_POLL_INTERVAL = 0.05
+
+# TTLs are (soft, hard). After the soft TTL we still serve the cached value but refresh it
+# in the background, after the hard TTL callers have to wait for a fresh value
+DEFAULT_TTL = (86400, 7 * 86400)
+
+REFRESH_WORKERS = 2
+
+EXPIRATION_METADATA_KEY = b"dataset_cache_expiration"
+REFRESH_METADATA_KEY = b"dataset_cache_refresh"
+
+_memory_lock = threading.Lock()
+
+# key -> (value, expiration, refresh time, size in bytes)
+_memory_cache = OrderedDict()
+_memory_size = 0
+
+_disk_write_lock = threading.Lock()
+_disk_write_count = 0
+
+_prune_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dataset-cache-prune")
+_prune_future = None
+
+# key -> [lock, number of threads using it]
+_key_locks_lock = threading.Lock()
+_key_locks = {}
+
+_refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="dataset-cache-refresh")
+_refreshing_lock = threading.Lock()
+_refreshing_keys = set()
+
+
+def get_repository_ttl(accession):
+    # Every repository adapter knows how long its datasets stay the same
+    import repositories
+
+    return repositories.get_ttl(accession)
+
+def _make_key(function, args, kwargs):
+    key_string = json.dumps([function.__module__, function.__name__, args, sorted(kwargs.items())], default=str)
+
+    return hashlib.sha256(key_string.encode("utf-8")).hexdigest()
+
+def _estimate_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+
+    return len(pickle.dumps(value))
+
+def _get_memory(key, now):
+    global _memory_size
+
+    with _memory_lock:
+        cached = _memory_cache.get(key)
+        if cached is None:
+            return False, None, None
+
+        value, expiration, refresh_at, size = cached
+        if expiration < now:
+            del _memory_cache[key]
+            _memory_size -= size
+            return False, None, None
+
+        _memory_cache.move_to_end(key)
+
+        return True, value, refresh_at
+
+def _set_memory(key, value, expiration, refresh_at):
+    global _memory_size
+
+    size = _estimate_size(value)
+
+    # Too big to keep in memory, it'll still be on disk
+    if size > MEMORY_BUDGET_BYTES:
+        return
+
+    with _memory_lock:
+        previous = _memory_cache.pop(key, None)
+        if previous is not None:
+            _memory_size -= previous[3]
+
+        _memory_cache[key] = (value, expiration, refresh_at, size)
+        _memory_size += size
+
+        while _memory_size > MEMORY_BUDGET_BYTES and len(_memory_cache) > 0:
+            _, (_, _, _, evicted_size) = _memory_cache.popitem(last=False)
+            _memory_size -= evicted_size
+
+@contextlib.contextmanager
+def _thread_lock(key, timeout):
+    with _key_locks_lock:
+        if key not in _key_locks:
+            _key_locks[key] = [threading.Lock(), 0]
+        _key_locks[key][1] += 1
+        key_lock = _key_locks[key][0]
+
+    is_acquired = key_lock.acquire(timeout=timeout)
+    try:
+        yield is_acquired
+    finally:
+        if is_acquired:
+            key_lock.release()
+
+        with _key_locks_lock:
+            _key_locks[key][1] -= 1
+            if _key_locks[key][1] == 0:
+                del _key_locks[key]
+
+@contextlib.contextmanager
+def _file_lock(key, timeout):
+    if fcntl is None:
+        yield True
+        return
+
+    lock_path = os.path.join(CACHE_DIR, "locks", key + ".lock")
+
+    try:
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        lock_file = open(lock_path, "a")
+        os.utime(lock_path)
+    except OSError:
+        yield False
+        return
+
+    is_acquired = False
+    try:
+        give_up_time = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                is_acquired = True
+                break
+            except BlockingIOError:
+                if time.time() > give_up_time:
+                    break
+                time.sleep(LOCK_POLL_INTERVAL)
+
+        yield is_acquired
+    finally:
+        if is_acquired:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+@contextlib.contextmanager
+def _single_flight(key, timeout=LOCK_TIMEOUT):
+    """Only one thread across all the worker processes computes a key at a time, the others wait for it"""
+
+    with _thread_lock(key, timeout) as is_thread_acquired:
+        # Not waiting a second time for the file lock, another thread of this worker is holding it
+        if not is_thread_acquired:
+            yield False
+            return
+
+        with _file_lock(key, timeout) as is_file_acquired:
+            yield is_file_acquired
+
+def _disk_paths(key):
+    base_path = os.path.join(CACHE_DIR, key[:2], key)
+
+    return [base_path + ".parquet", base_path + ".json", base_path + ".pickle"]
+
+def _read_disk(key, now):
+    parquet_path, json_path, pickle_path = _disk_paths(key)
+
+    try:
+        if os.path.exists(parquet_path):
+            import pyarrow.parquet as pq
+
+            # Checking the expiration from the footer before reading any data
+            schema_metadata = pq.read_schema(parquet_path).metadata or {}
+            if float(schema_metadata.get(EXPIRATION_METADATA_KEY, 0)) < now:
+                return False, None, None, None
+
+            expiration = float(schema_metadata[EXPIRATION_METADATA_KEY])
+            refresh_at = float(schema_metadata[REFRESH_METADATA_KEY])
+            return True, pq.read_table(parquet_path).to_pandas(), expiration, refresh_at
+
+        if os.path.exists(json_path):
+            with open(json_path) as json_file:
+                cached = json.load(json_file)
+
+            if cached["expiration"] < now:
+                return False, None, None, None
+
+            value = cached["value"]
+            if cached["type"] == "tuple":
+                value = tuple(value)
+
+            return True, value, cached["expiration"], cached["refresh_at"]
+
+        if os.path.exists(pickle_path):
+            with open(pickle_path, "rb") as pickle_file:
+                expiration, refresh_at, value = pickle.load(pickle_file)
+
+            if expiration < now:
+                return False, None, None, None
+
+            return True, value, expiration, refresh_at
+    except Exception:
+        pass
+
+    return False, None, None, None
+
+def _write_atomic(path, content, modified_time=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, "wb") as output_file:
+        output_file.write(content)
+
+    # Set before the file shows up, so nobody sees it with the wrong one
+    if modified_time is not None:
+        os.utime(temp_path, (modified_time, modified_time))
+
+    os.replace(temp_path, path)
+
+def _serialize_dataframe(value, expiration, refresh_at):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(value, preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[EXPIRATION_METADATA_KEY] = str(expiration).encode("utf-8")
+    schema_metadata[REFRESH_METADATA_KEY] = str(refresh_at).encode("utf-8")
+    table = table.replace_schema_metadata(schema_metadata)
+
+    output_buffer = io.BytesIO()
+    pq.write_table(table, output_buffer)
+
+    return output_buffer.getvalue()
+
+def _write_disk(key, value, expiration, refresh_at):
+    parquet_path, json_path, pickle_path = _disk_paths(key)
+
+    # The expiration is also the modification time of the entry, so pruning never has to read one
+    try:
+        if isinstance(value, pd.DataFrame):
+            try:
+                _write_atomic(parquet_path, _serialize_dataframe(value, expiration, refresh_at), modified_time=expiration)
+                return
+            except Exception:
+                # Columns with mixed types can't go into parquet, those fall through to pickle
+                pass
+        elif isinstance(value, (tuple, list, dict, str)):
+            cached = {
+                "expiration": expiration,
+                "refresh_at": refresh_at,
+                "type": "tuple" if isinstance(value, tuple) else "json",
+                "value": value
+            }
+            _write_atomic(json_path, json.dumps(cached).encode("utf-8"), modified_time=expiration)
+            return
+
+        _write_atomic(pickle_path, pickle.dumps((expiration, refresh_at, value)), modified_time=expiration)
+    except Exception:
+        pass
+    finally:
+        _count_disk_write()
+
+def _count_disk_write():
+    global _disk_write_count, _prune_future
+
+    with _disk_write_lock:
+        _disk_write_count += 1
+
+        # In the background, a walk of the whole cache has no place in a user request
+        if _disk_write_count % DISK_PRUNE_INTERVAL == 0 and (_prune_future is None or _prune_future.done()):
+            _prune_future = _prune_executor.submit(prune_disk)
+
+def prune_disk(now=None):
+    """Removes expired entries from disk, and then the ones expiring first until we are under the disk budget
+
+    Entries are only looked at with stat, their modification time is their expiration.
+    """
+
+    if now is None:
+        now = time.time()
+
+    all_entries = []
+    for root, dirs, files in os.walk(CACHE_DIR):
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            try:
+                file_stats = os.stat(file_path)
+            except OSError:
+                continue
+
+            all_entries.append((file_stats.st_mtime, file_stats.st_size, file_path))
+
+    all_entries.sort()
+
+    total_size = sum(file_size for _, file_size, _ in all_entries)
+    for modified_time, file_size, file_path in all_entries:
+        # Lock files are tiny, we only clean up the ones nobody has used in a long time
+        if file_path.endswith(".lock"):
+            if modified_time < now - 86400:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            continue
+
+        # Temporary files get the expiration of their entry just before they are renamed, so a leftover one goes after it
+        is_expired = not file_path.endswith(".tmp") and modified_time < now
+        is_stale_temp = file_path.endswith(".tmp") and modified_time < now - 3600
+
+        if is_expired or is_stale_temp or total_size > DISK_BUDGET_BYTES:
+            try:
+                os.remove(file_path)
+                total_size -= file_size
+            except OSError:
+                pass
+
+def _get_cached(key, now):
+    is_cached, value, refresh_at = _get_memory(key, now)
+    if is_cached:
+        return True, value, refresh_at
+
+    is_cached, value, expiration, refresh_at = _read_disk(key, now)
+    if is_cached:
+        _set_memory(key, value, expiration, refresh_at)
+        return True, value, refresh_at
+
+    return False, None, None
+
+def _compute(key, function, args, kwargs, ttl_function):
+    value = function(*args, **kwargs)
+
+    now = time.time()
+    soft_ttl, hard_ttl = ttl_function(*args[:1])
+    _set_memory(key, value, now + hard_ttl, now + soft_ttl)
+    _write_disk(key, value, now + hard_ttl, now + soft_ttl)
+
+    return value
+
+def _refresh(key, function, args, kwargs, ttl_function):
+    try:
+        # If any other thread or worker is already computing this key, we leave it to them
+        with _single_flight(key, timeout=0) as is_acquired:
+            if not is_acquired:
+                return
+
+            # Another worker might have refreshed it already
+            is_cached, value, expiration, refresh_at = _read_disk(key, time.time())
+            if is_cached and refresh_at > time.time():
+                _set_memory(key, value, expiration, refresh_at)
+                return
+
+            _compute(key, function, args, kwargs, ttl_function)
+    except Exception:
+        # We keep serving the stale value, the next request after the soft TTL tries again
+        pass
+    finally:
+        with _refreshing_lock:
+            _refreshing_keys.discard(key)
+
+def _schedule_refresh(key, function, args, kwargs, ttl_function):
+    with _refreshing_lock:
+        if key in _refreshing_keys:
+            return
+        _refreshing_keys.add(key)
+
+    _refresh_executor.submit(_refresh, key, function, args, kwargs, ttl_function)
+
+def memoize(ttl_function=get_repository_ttl, key_function=None):
+    """Caches a function in memory and on disk, the TTL is determined from the first argument (the accession)
+
+    Values past their soft TTL are returned right away and refreshed in the background,
+    values past their hard TTL are computed again before returning.
+
+    Args:
+        ttl_function (function): gives the (soft, hard) number of seconds to keep a value for the accession
+        key_function (function): gives what identifies a value from the arguments, all of the arguments by default
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if key_function is None:
+                key = _make_key(function, args, kwargs)
+            else:
+                key = _make_key(function, [key_function(*args, **kwargs)], {})
+
+            is_cached, value, refresh_at = _get_cached(key, time.time())
+            if is_cached:
+                if refresh_at < time.time():
+                    _schedule_refresh(key, function, args, kwargs, ttl_function)
+                return value
+
+            # A request waits for whoever is computing it at most until its own deadline
+            with _single_flight(key, timeout=deadline.bound_timeout(LOCK_TIMEOUT)) as is_acquired:
+                if not is_acquired:
+                    deadline.check()
+
+                # Someone else might have computed it while we were waiting
+                is_cached, value, refresh_at = _get_cached(key, time.time())
+                if is_cached:
+                    return value
+
+                return _compute(key, function, args, kwargs, ttl_function)
+
+        return wrapper
+
+    return decorator
+
+def clear_memory():
+    global _memory_size
+
+    with _memory_lock:
+        _memory_cache.clear()
+        _memory_size = 0
@@ -0,0 +1,94 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+import dataset_cache
+import private_cache
+import repositories
+
+# Loads everything the page needs for a dataset at once, the callbacks then share the results
+LOADER_WORKERS = 8
+PREFETCH_WINDOW = 30
+
+_executor = ThreadPoolExecutor(max_workers=LOADER_WORKERS, thread_name_prefix="dataset-loader")
+_prefetch_lock = threading.Lock()
+
+# prefetch key -> time it was started
+_prefetched = {}
+
+
+@dataset_cache.memoize()
+def _get_public_dataset_files(accession, metadata_source, metadata_option=None):
+    files_df = utils.get_dataset_files(accession, metadata_source, metadata_option=metadata_option)
+
+    return files_df.reset_index(drop=True)
+
+def _get_private_dataset_files(accession, metadata_source, dataset_password, metadata_option=None):
+    files_df = utils.get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+
+    return files_df.reset_index(drop=True)
+
+def get_dataset_files(accession, metadata_source, dataset_password="", metadata_option=None):
+    # The dataset cache keys include the arguments, so private datasets go to the encrypted cache that never keeps the password
+    if dataset_password is not None and len(dataset_password) > 0:
+        return private_cache.get_listing(accession, dataset_password,
+                                         lambda: _get_private_dataset_files(accession, metadata_source, dataset_password, metadata_option=metadata_option),
+                                         key_parts=("dataset files", metadata_source, metadata_option))
+
+    return _get_public_dataset_files(accession, metadata_source, metadata_option=metadata_option)
+
+@dataset_cache.memoize()
+def get_dataset_description(accession):
+    return utils.get_dataset_description(accession)
+
+def get_metadata_options(accession):
+    msv_accession = utils._accession_to_msv_accession(accession)
+
+    return utils._get_massive_metadata_options(msv_accession)
+
+def _run_quietly(function, *args, **kwargs):
+    # The callbacks report the errors when they ask for the result themselves
+    try:
+        function(*args, **kwargs)
+    except:
+        pass
+
+def prefetch(accession, metadata_source, dataset_password="", metadata_option=None):
+    """Starts all the upstream requests for a dataset at the same time
+
+    The files, description and metadata options are loaded in the background into the dataset cache,
+    callbacks asking for them while they are loading wait for the same request instead of starting another.
+    The loading is not bound by the deadline of the callback, so slow datasets are ready when it is retried.
+
+    Args:
+        accession (str): dataset accession
+        metadata_source (str): where the file metadata comes from
+        dataset_password (str): password for private datasets
+        metadata_option (str): which metadata file to use
+    """
+
+    if accession is None or len(accession) == 0:
+        return
+
+    if dataset_password is None:
+        dataset_password = ""
+
+    now = time.time()
+    prefetch_key = (accession, metadata_source, dataset_password, metadata_option)
+
+    # Every callback for the dataset calls this, only the first one needs to start the requests
+    with _prefetch_lock:
+        started_time = _prefetched.get(prefetch_key)
+        if started_time is not None and now - started_time < PREFETCH_WINDOW:
+            return
+
+        for expired_key in [key for key, started_time in _prefetched.items() if now - started_time >= PREFETCH_WINDOW]:
+            del _prefetched[expired_key]
+
+        _prefetched[prefetch_key] = now
+
+    _executor.submit(_run_quietly, get_dataset_files, accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+    _executor.submit(_run_quietly, get_dataset_description, accession)
+    if repositories.has_capability(accession, repositories.CAPABILITY_METADATA_OPTIONS):
+        _executor.submit(_run_quietly, get_metadata_options, accession)
@@ -0,0 +1,93 @@
+import os
+import time
+import contextlib
+import contextvars
+import concurrent.futures
+
+# Seconds every request to the app gets for all of its upstream calls, must stay below the gunicorn timeout
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", 45))
+
+# Monotonic time the current request has to be done by, None outside of a request
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The time budget of the current request ran out before the upstream calls were done"""
+
+    def __init__(self, message="Request time budget exceeded"):
+        super().__init__(message)
+
+def start(seconds):
+    """Starts a budget for the current context, a nested budget can only make it shorter
+
+    Returns:
+        token to give to reset() once the budget is over
+    """
+
+    deadline = time.monotonic() + seconds
+
+    current_deadline = _deadline.get()
+    if current_deadline is not None:
+        deadline = min(deadline, current_deadline)
+
+    return _deadline.set(deadline)
+
+def reset(token):
+    _deadline.reset(token)
+
+@contextlib.contextmanager
+def budget(seconds):
+    token = start(seconds)
+    try:
+        yield
+    finally:
+        reset(token)
+
+def remaining():
+    """Seconds left in the current budget, None if there is no budget"""
+
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+
+    return max(deadline - time.monotonic(), 0)
+
+def check():
+    if remaining() == 0:
+        raise DeadlineExceeded()
+
+def bound_timeout(timeout):
+    """Shortens a timeout (seconds or a (connect, read) tuple) to what is left of the budget
+
+    Raises:
+        DeadlineExceeded: if there is nothing left, so no upstream call is even started
+    """
+
+    seconds_left = remaining()
+    if seconds_left is None:
+        return timeout
+
+    if seconds_left == 0:
+        raise DeadlineExceeded()
+
+    if timeout is None:
+        return seconds_left
+
+    if isinstance(timeout, tuple):
+        return tuple(seconds_left if part is None else min(part, seconds_left) for part in timeout)
+
+    return min(timeout, seconds_left)
+
+def submit(executor, function, *args, **kwargs):
+    """Same as executor.submit, but the function runs within the budget of the caller"""
+
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+def result(future):
+    """Waits for a future at most until the end of the budget"""
+
+    concurrent.futures.wait([future], timeout=remaining())
+    if not future.done():
+        raise DeadlineExceeded()
+
+    return future.result()
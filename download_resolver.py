@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import http_client
+
+DOWNLOAD_RESOLVE_URL = "https://dashboard.gnps2.org/downloadlink?usi={}"
+
+# Bounds for the resolution, per request and for the total wait inside a callback
+MAX_WORKERS = 8
+REQUEST_TIMEOUT = 10
+RESOLVE_DEADLINE = 2
+
+# Limits for the batch API
+MAX_BATCH_SIZE = 1000
+BATCH_RESOLVE_DEADLINE = 30
+
+# How long we remember resolved links, failures are remembered for a shorter time
+CACHE_TTL = 3600
+FAILURE_TTL = 60
+MAX_CACHE_ENTRIES = 100000
+
+# Resolved links are also persisted on disk so they survive restarts and are shared across workers
+PERSISTENT_CACHE_PATH = os.path.join("temp", "download-links.sqlite")
+PERSISTENT_CACHE_TTL = 7 * 86400
+SQLITE_BATCH_SIZE = 500
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="download-resolver")
+_lock = threading.RLock()
+
+# usi -> (download_url or None, expiration time)
+_resolved_cache = {}
+
+# usi -> future that is currently resolving
+_pending_futures = {}
+
+
+def _connect_persistent_cache():
+    connection = sqlite3.connect(PERSISTENT_CACHE_PATH, timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS download_links (usi TEXT PRIMARY KEY, download_url TEXT NOT NULL, expiration REAL NOT NULL)")
+    return connection
+
+def _load_persistent(usi_list, now):
+    found_links = {}
+
+    try:
+        connection = _connect_persistent_cache()
+        try:
+            for i in range(0, len(usi_list), SQLITE_BATCH_SIZE):
+                usi_batch = usi_list[i:i + SQLITE_BATCH_SIZE]
+                query = "SELECT usi, download_url, expiration FROM download_links WHERE expiration > ? AND usi IN ({})".format(",".join("?" * len(usi_batch)))
+                for usi, download_url, expiration in connection.execute(query, [now] + usi_batch):
+                    found_links[usi] = (download_url, expiration)
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        pass
+
+    return found_links
+
+def _save_persistent(usi, download_url, expiration):
+    try:
+        connection = _connect_persistent_cache()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO download_links (usi, download_url, expiration) VALUES (?, ?, ?)", (usi, download_url, expiration))
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        pass
+
+def _fetch_download_link(usi):
+    r = http_client.get(DOWNLOAD_RESOLVE_URL.format(usi), timeout=REQUEST_TIMEOUT)
+
+    if r.status_code == 200:
+        return r.text
+
+    return None
+
+def _prune_cache(now):
+    expired_usis = [usi for usi, (_, expiration) in _resolved_cache.items() if expiration < now]
+    for usi in expired_usis:
+        del _resolved_cache[usi]
+
+    # Still too big, dropping the oldest entries
+    overflow = len(_resolved_cache) - MAX_CACHE_ENTRIES
+    if overflow > 0:
+        for usi in list(_resolved_cache.keys())[:overflow]:
+            del _resolved_cache[usi]
+
+def _store_result(usi, future):
+    try:
+        download_url = future.result()
+    except Exception:
+        download_url = None
+
+    now = time.time()
+    ttl = CACHE_TTL if download_url is not None else FAILURE_TTL
+
+    if download_url is not None:
+        _save_persistent(usi, download_url, now + PERSISTENT_CACHE_TTL)
+
+    with _lock:
+        _pending_futures.pop(usi, None)
+        if len(_resolved_cache) >= MAX_CACHE_ENTRIES:
+            _prune_cache(now)
+        _resolved_cache[usi] = (download_url, now + ttl)
+
+def _get_cached(usi, now):
+    cached = _resolved_cache.get(usi)
+    if cached is None:
+        return False, None
+
+    download_url, expiration = cached
+    if expiration < now:
+        return False, None
+
+    return True, download_url
+
+def resolve_download_links(usi_list, deadline=RESOLVE_DEADLINE):
+    """Resolves download urls for a list of USIs concurrently
+
+    Lookups that are not finished within the deadline keep running in the background
+    and their results end up in the cache for the next call.
+
+    Args:
+        usi_list (list): USIs to resolve
+        deadline (float): total number of seconds to wait for unresolved USIs
+
+    Returns:
+        tuple: list of (usi, download_url) for resolved USIs in input order, list of USIs still pending
+    """
+
+    now = time.time()
+    futures_to_wait = {}
+
+    with _lock:
+        missing_usis = [usi for usi in usi_list if not _get_cached(usi, now)[0] and usi not in _pending_futures]
+
+    # Filling in the memory cache from disk before going to the network
+    if len(missing_usis) > 0:
+        persistent_links = _load_persistent(missing_usis, now)
+        with _lock:
+            for usi, (download_url, expiration) in persistent_links.items():
+                _resolved_cache[usi] = (download_url, min(expiration, now + CACHE_TTL))
+
+    with _lock:
+        for usi in usi_list:
+            is_cached, _ = _get_cached(usi, now)
+            if is_cached:
+                continue
+
+            future = _pending_futures.get(usi)
+            if future is None:
+                future = _executor.submit(_fetch_download_link, usi)
+                _pending_futures[usi] = future
+                future.add_done_callback(lambda f, usi=usi: _store_result(usi, f))
+
+            futures_to_wait[usi] = future
+
+    if len(futures_to_wait) > 0 and deadline > 0:
+        wait(futures_to_wait.values(), timeout=deadline)
+
+    resolved_links = []
+    pending_usis = []
+
+    now = time.time()
+    with _lock:
+        for usi in usi_list:
+            is_cached, download_url = _get_cached(usi, now)
+
+            # Finished futures might not have run their done callback yet
+            if not is_cached and usi in futures_to_wait and futures_to_wait[usi].done():
+                _store_result(usi, futures_to_wait[usi])
+                is_cached, download_url = _get_cached(usi, time.time())
+
+            if not is_cached:
+                pending_usis.append(usi)
+            elif download_url is not None:
+                resolved_links.append((usi, download_url))
+
+    return resolved_links, pending_usis
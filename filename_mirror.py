@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import dataset_cache
+import http_client
+
+# The filename table of the dataset cache, one dataset at a time or the new rows since the last sync
+DATASET_FILES_URL = "https://datasetcache.gnps2.org/datasette/database/filename.csv?_stream=on&_sort=filepath&dataset__exact={}&_size=max"
+SYNC_URL = "https://datasetcache.gnps2.org/datasette/database/filename.csv?_stream=on&_sort=rowid&rowid__gt={}&_size=max"
+SYNC_CHUNK_SIZE = 100000
+
+# Dataset listings are parsed in chunks, keeping only the columns and files we use
+READ_CHUNK_SIZE = 20000
+
+# The mirror is optional, it is only used once it has been created with "python filename_mirror.py"
+MIRROR_PATH = os.environ.get("FILENAME_MIRROR_PATH", os.path.join("temp", "filename-mirror.sqlite"))
+SYNC_INTERVAL = 3600
+
+# Seconds before retrying a failed sync, doubled after every failure up to SYNC_INTERVAL
+SYNC_RETRY_BACKOFF = 60
+
+MIRROR_COLUMNS = ["dataset", "filepath", "collection", "update_name", "size_mb", "spectra_ms2", "instrument_vendor", "instrument_model"]
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="filename-mirror")
+_lock = threading.Lock()
+_sync_future = None
+
+
+def _connect():
+    connection = sqlite3.connect(MIRROR_PATH, timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS filename ({}, PRIMARY KEY (dataset, filepath))".format(", ".join(MIRROR_COLUMNS)))
+    connection.execute("CREATE INDEX IF NOT EXISTS filename_dataset ON filename (dataset)")
+    connection.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+    return connection
+
+def _get_sync_state(connection, name, default=0):
+    row = connection.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return default
+    return row[0]
+
+def _set_sync_state(connection, name, value):
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+def _read_csv_chunks(url, chunk_size):
+    return http_client.read_csv(url, sep=",", usecols=lambda column: column in MIRROR_COLUMNS or column == "rowid", chunksize=chunk_size)
+
+def _filter_extensions(files_df, acceptable_extensions):
+    if acceptable_extensions is None:
+        return files_df
+
+    return files_df[files_df["filepath"].str.lower().str.endswith(tuple(acceptable_extensions), na=False)]
+
+def _insert_rows(connection, files_df):
+    files_df = files_df.reindex(columns=MIRROR_COLUMNS)
+    files_df = files_df.astype(object).where(files_df.notnull(), None)
+
+    query = "INSERT OR REPLACE INTO filename ({}) VALUES ({})".format(", ".join(MIRROR_COLUMNS), ", ".join("?" * len(MIRROR_COLUMNS)))
+    connection.executemany(query, files_df.itertuples(index=False, name=None))
+
+def is_enabled():
+    return os.path.exists(MIRROR_PATH)
+
+def sync_mirror():
+    """Brings the mirror up to date with the rows added to the dataset cache since the last sync"""
+
+    connection = _connect()
+    try:
+        last_rowid = int(_get_sync_state(connection, "last_rowid"))
+
+        for files_df in _read_csv_chunks(SYNC_URL.format(last_rowid), SYNC_CHUNK_SIZE):
+            with connection:
+                _insert_rows(connection, files_df)
+                if "rowid" in files_df and len(files_df) > 0:
+                    last_rowid = max(last_rowid, int(files_df["rowid"].max()))
+                    connection.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('last_rowid', ?)", (last_rowid,))
+
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('last_sync', ?)", (time.time(),))
+    finally:
+        connection.close()
+
+def _sync_in_background():
+    try:
+        # Only one worker process syncs at a time
+        with dataset_cache._single_flight("filename-mirror", timeout=0) as is_acquired:
+            if not is_acquired:
+                return
+
+            connection = _connect()
+            try:
+                # Every attempt is recorded, so an upstream outage doesn't have each lookup try again
+                _set_sync_state(connection, "last_attempt", time.time())
+                try:
+                    sync_mirror()
+                except Exception:
+                    _set_sync_state(connection, "failed_syncs", _get_sync_state(connection, "failed_syncs") + 1)
+                    raise
+                _set_sync_state(connection, "failed_syncs", 0)
+            finally:
+                connection.close()
+    except Exception:
+        # We keep using the mirror we have, e.g. when offline
+        pass
+
+def _get_next_sync_time(connection):
+    failed_syncs = _get_sync_state(connection, "failed_syncs")
+    if failed_syncs == 0:
+        return _get_sync_state(connection, "last_sync") + SYNC_INTERVAL
+
+    return _get_sync_state(connection, "last_attempt") + min(SYNC_RETRY_BACKOFF * 2 ** (failed_syncs - 1), SYNC_INTERVAL)
+
+def _schedule_sync(connection):
+    global _sync_future
+
+    if time.time() < _get_next_sync_time(connection):
+        return
+
+    with _lock:
+        if _sync_future is None or _sync_future.done():
+            _sync_future = _executor.submit(_sync_in_background)
+
+def _get_mirrored_files(dataset_accession):
+    connection = _connect()
+    try:
+        _schedule_sync(connection)
+
+        query = "SELECT {} FROM filename WHERE dataset = ? ORDER BY filepath".format(", ".join(MIRROR_COLUMNS))
+        return pd.read_sql_query(query, connection, params=(dataset_accession,))
+    finally:
+        connection.close()
+
+def _read_dataset_files(dataset_accession, acceptable_extensions):
+    mirror_connection = None
+    if is_enabled():
+        try:
+            mirror_connection = _connect()
+            mirror_connection.execute("DELETE FROM filename WHERE dataset = ?", (dataset_accession,))
+        except sqlite3.Error:
+            mirror_connection = None
+
+    all_files_df = []
+    try:
+        for files_df in _read_csv_chunks(DATASET_FILES_URL.format(dataset_accession), READ_CHUNK_SIZE):
+            # The mirror gets every file of the dataset, the caller only the ones it can use
+            if mirror_connection is not None:
+                try:
+                    _insert_rows(mirror_connection, files_df.assign(dataset=dataset_accession))
+                except sqlite3.Error:
+                    mirror_connection.close()
+                    mirror_connection = None
+
+            all_files_df.append(_filter_extensions(files_df.drop(columns="rowid", errors="ignore"), acceptable_extensions))
+
+        if mirror_connection is not None:
+            mirror_connection.commit()
+    finally:
+        if mirror_connection is not None:
+            mirror_connection.close()
+
+    if len(all_files_df) == 0:
+        return pd.DataFrame(columns=["filepath"])
+
+    return pd.concat(all_files_df, ignore_index=True)
+
+def get_dataset_files(dataset_accession, acceptable_extensions=None):
+    """Gets the rows of the dataset cache filename table for a dataset
+
+    With a local mirror this is a single indexed lookup, datasets missing from the mirror
+    are fetched from the dataset cache and added to the mirror.
+
+    Args:
+        dataset_accession (str): dataset accession
+        acceptable_extensions (list): lower case file extensions to keep, all files if None
+
+    Returns:
+        pandas.DataFrame: one row per file, with a filepath column
+    """
+
+    if is_enabled():
+        try:
+            files_df = _get_mirrored_files(dataset_accession)
+            if len(files_df) > 0:
+                return _filter_extensions(files_df, acceptable_extensions).reset_index(drop=True)
+        except sqlite3.Error:
+            pass
+
+    return _read_dataset_files(dataset_accession, acceptable_extensions)
+
+if __name__ == "__main__":
+    # Creating or updating the mirror, e.g. from cron
+    if len(sys.argv) > 1:
+        MIRROR_PATH = sys.argv[1]
+
+    os.makedirs(os.path.dirname(os.path.abspath(MIRROR_PATH)), exist_ok=True)
+    sync_mirror()
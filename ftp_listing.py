@@ -0,0 +1,164 @@
+import stat
+import ftplib
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import deadline
+
+# Directories are listed on this many FTP connections at the same time
+FTP_CONNECTIONS = 4
+FTP_TIMEOUT = 120
+
+
+class _ConnectionPool:
+    """One FTP connection per worker thread, all of them closed together at the end of a walk"""
+
+    def __init__(self, host, user, password, port):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+
+        # None until we know, then whether the server supports MLSD
+        self.supports_mlsd = None
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get_connection(self):
+        ftp = getattr(self._local, "ftp", None)
+        if ftp is None:
+            ftp = ftplib.FTP(timeout=deadline.bound_timeout(FTP_TIMEOUT))
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.password)
+
+            self._local.ftp = ftp
+            with self._lock:
+                self._connections.append(ftp)
+
+        return ftp
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for ftp in connections:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+def _is_missing_mlsd(error):
+    # The server not knowing the command, as opposed to e.g. 550 for a missing directory
+    return str(error)[:3] in ("500", "501", "502")
+
+def _list_directory_mlsd(ftp, directory):
+    directories, files = [], []
+
+    # Servers report the type by default, asking for it would cost another round trip per directory
+    for name, facts in ftp.mlsd(directory):
+        entry_type = facts.get("type", "").lower()
+        if entry_type in ("cdir", "pdir") or name in (".", ".."):
+            continue
+
+        if entry_type == "dir":
+            directories.append(posixpath.join(directory, name))
+        else:
+            files.append(posixpath.join(directory, name))
+
+    return directories, files
+
+def _list_directory_list(ftp, directory):
+    import ftputil.stat
+
+    lines = []
+    ftp.retrlines("LIST {}".format(directory), lines.append)
+
+    parser = ftputil.stat.UnixParser()
+
+    directories, files = [], []
+    for line in lines:
+        if parser.ignores_line(line):
+            continue
+
+        stat_result = parser.parse_line(line)
+        name = stat_result._st_name
+        if name in (".", ".."):
+            continue
+
+        if stat.S_ISDIR(stat_result.st_mode):
+            directories.append(posixpath.join(directory, name))
+        else:
+            files.append(posixpath.join(directory, name))
+
+    return directories, files
+
+def _list_directory(pool, directory):
+    deadline.check()
+
+    # Login errors are for the caller, unlike the errors of a single directory
+    ftp = pool.get_connection()
+
+    try:
+        if pool.supports_mlsd is not False:
+            try:
+                directories, files = _list_directory_mlsd(ftp, directory)
+                pool.supports_mlsd = True
+                return directories, files
+            except ftplib.error_perm as error:
+                if not _is_missing_mlsd(error):
+                    raise
+                pool.supports_mlsd = False
+
+        return _list_directory_list(ftp, directory)
+    except ftplib.error_perm:
+        return [], []
+
+def walk_files(host, directories, user="anonymous", password="", port=21, connection_count=FTP_CONNECTIONS):
+    """Lists all the files below some directories of an FTP server
+
+    Subdirectories are listed concurrently over a small pool of connections, with a single
+    MLSD per directory when the server supports it and LIST otherwise.
+    Directories that don't exist or can't be read are skipped, like ftputil's walk does.
+
+    Args:
+        host (str): FTP server
+        directories (list): directories to walk
+        user (str): login, anonymous by default
+        password (str): password for the login
+        port (int): FTP port
+        connection_count (int): number of connections to list on at the same time
+
+    Returns:
+        list: sorted paths of all the files, starting with the directory they were found in
+    """
+
+    pool = _ConnectionPool(host, user, password, port)
+    executor = ThreadPoolExecutor(max_workers=connection_count, thread_name_prefix="ftp-listing")
+
+    all_files = []
+    pending_futures = set()
+    try:
+        pending_futures = set(deadline.submit(executor, _list_directory, pool, directory) for directory in directories)
+
+        while len(pending_futures) > 0:
+            done_futures, pending_futures = wait(pending_futures, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if len(done_futures) == 0:
+                raise deadline.DeadlineExceeded()
+
+            for future in done_futures:
+                subdirectories, files = future.result()
+
+                all_files += files
+                pending_futures |= set(deadline.submit(executor, _list_directory, pool, subdirectory) for subdirectory in subdirectories)
+    finally:
+        # The listings not started yet are dropped when we give up early, by hand as cancel_futures needs Python 3.9
+        for future in pending_futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        pool.close()
+
+    # Listings finish in any order
+    return sorted(all_files)
@@ -0,0 +1,196 @@
+import io
+import os
+import time
+import threading
+from urllib.parse import urlparse
+
+import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
+
+import deadline
+import circuit_breaker
+
+# Seconds to wait for a connection and between bytes of a response, can be changed per deployment
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 120))
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Number of hosts we keep a pool for, and the kept alive connections per host
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 32
+
+# Failed connections and overloaded upstreams are retried with exponential backoff, within the request deadline
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_METHODS = ["HEAD", "GET", "OPTIONS"]
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _create_session():
+    session = requests.Session()
+
+    # Retries are done in request(), so every attempt is bounded by the deadline
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+def get_session():
+    """The session shared by every upstream request, so connections are kept alive and reused across threads"""
+
+    global _session
+
+    # Created on first use, after the response cache is installed
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+
+    return _session
+
+def _get_backoff(attempt):
+    return RETRY_BACKOFF * (2 ** attempt)
+
+def _has_time_to_retry(attempt):
+    seconds_left = deadline.remaining()
+    return seconds_left is None or seconds_left > _get_backoff(attempt)
+
+def _is_shortened_timeout(error, timeout, attempt_timeout):
+    # Only the part of the timeout that fired counts, connecting or reading
+    if not isinstance(error, requests.Timeout):
+        return False
+
+    if isinstance(timeout, tuple):
+        part = 1 if isinstance(error, requests.ReadTimeout) else 0
+        return timeout[part] != attempt_timeout[part]
+
+    return timeout != attempt_timeout
+
+def _get_cached_response(method, url, kwargs):
+    session = get_session()
+
+    # Only there once the response cache is installed
+    if not hasattr(session, "cache"):
+        return None
+
+    response = session.request(method, url, only_if_cached=True, **kwargs)
+    if response.status_code == 504:
+        return None
+
+    return response
+
+def request(method, url, **kwargs):
+    """Same as requests.request on the shared session
+
+    Each attempt gets at most what is left of the deadline of the current request,
+    timing out because of it raises deadline.DeadlineExceeded instead of a timeout.
+    Without the time for a retry, the call ends with the failure of its last attempt.
+    Hosts that keep failing are not called until their circuit breaker lets a probe through,
+    in the meantime we only answer from the response cache or raise circuit_breaker.CircuitOpenError.
+    A call counts once for the breaker, after all of its retries.
+    """
+
+    timeout = kwargs.pop("timeout", DEFAULT_TIMEOUT)
+    max_retries = MAX_RETRIES if method.upper() in RETRY_METHODS else 0
+    breaker = circuit_breaker.get_breaker(urlparse(url).hostname)
+
+    try:
+        breaker.before_call()
+    except circuit_breaker.CircuitOpenError:
+        cached_response = _get_cached_response(method, url, kwargs)
+        if cached_response is not None:
+            return cached_response
+        raise
+
+    # The breaker counts calls, not attempts, the retries of a call are one outcome
+    try:
+        response = _request_with_retries(method, url, timeout, max_retries, breaker, kwargs)
+    except deadline.DeadlineExceeded:
+        breaker.release()
+        raise
+    except (requests.ConnectionError, requests.Timeout) as error:
+        breaker.record_failure(error)
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure("HTTP {}".format(response.status_code))
+    elif getattr(response, "from_cache", False):
+        breaker.release()
+    else:
+        breaker.record_success()
+
+    return response
+
+def _request_with_retries(method, url, timeout, max_retries, breaker, kwargs):
+    attempt = 0
+    while True:
+        attempt_timeout = deadline.bound_timeout(timeout)
+
+        try:
+            response = get_session().request(method, url, timeout=attempt_timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            # Timing out on a timeout shortened by the deadline means the request is out of time, not that the host is down
+            if deadline.remaining() == 0 or _is_shortened_timeout(error, timeout, attempt_timeout):
+                raise deadline.DeadlineExceeded() from error
+
+            # No point retrying once other calls have opened the breaker,
+            # and without the time for another attempt the call ends with this failure, so the breaker counts it
+            if attempt >= max_retries or isinstance(error, requests.ReadTimeout) or breaker.is_open() or not _has_time_to_retry(attempt):
+                raise
+        else:
+            if attempt >= max_retries or response.status_code not in RETRY_STATUS_CODES or breaker.is_open() or not _has_time_to_retry(attempt):
+                return response
+
+            response.close()
+
+        time.sleep(_get_backoff(attempt))
+        attempt += 1
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def _is_http_url(path):
+    return isinstance(path, str) and urlparse(path).scheme in ("http", "https")
+
+def read_csv(path, headers=None, **kwargs):
+    """Same as pd.read_csv, but http urls are streamed through the shared session with the given request headers
+
+    The response cache is skipped, it would read the whole table into memory and store it before we parse the first row.
+    """
+
+    if not _is_http_url(path):
+        return pd.read_csv(path, **kwargs)
+
+    response = get(path, stream=True, headers=dict(headers or {}, **{"Cache-Control": "no-store"}))
+    response.raise_for_status()
+
+    # The body of a cached response has already been read
+    if getattr(response, "from_cache", False):
+        return pd.read_csv(io.BytesIO(response.content), **kwargs)
+
+    # Decompressing on the fly if the server gzips the response
+    response.raw.decode_content = True
+
+    return pd.read_csv(response.raw, **kwargs)
+
+def read_json(path, **kwargs):
+    """Same as pd.read_json, but http urls are fetched through the shared session"""
+
+    if not _is_http_url(path):
+        return pd.read_json(path, **kwargs)
+
+    response = get(path)
+    response.raise_for_status()
+
+    return pd.read_json(io.StringIO(response.text), **kwargs)
@@ -1,42 +1,120 @@
-import requests
 import ftplib
 import sys
 import os
 import pandas as pd
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+import filename_mirror
+import repositories
+import dataset_cache
+import http_client
+import deadline
 
 BASE_URL = 'https://www.ebi.ac.uk/metabolights/ws/studies'
 EBI_FTP_SERVER = 'ftp.ebi.ac.uk'
 MTBLS_BASE_DIR = '/pub/databases/metabolights/studies/public'
 SWAGGER_API = 'https://www.ebi.ac.uk:443/metabolights/ws'
+ASSAY_BASE_URL = "http://" + EBI_FTP_SERVER + MTBLS_BASE_DIR
+
+# Only these columns of the assay tables are used, named by the text in brackets if there is any
+ASSAY_COLUMNS = ['Instrument', 'Instrument manufacturer', 'Raw Spectral Data File', 'Derived Spectral Data File', 'Scan polarity']
+
+# Parsed assays are cached by their modification time, so they can be kept for long
+ASSAY_TTL = (365 * 86400, 365 * 86400)
+
+# Assay tables of a study are downloaded at the same time
+ASSAY_WORKERS = 8
+
+_assay_executor = ThreadPoolExecutor(max_workers=ASSAY_WORKERS, thread_name_prefix="mtbls-assay")
+
+
+def _extract_bracketed_text(col_name):
+    match = re.search(r'\[(.*?)\]', col_name)
+    return match.group(1) if match else col_name
+
+@dataset_cache.memoize(ttl_function=lambda *args: ASSAY_TTL)
+def _get_cached_assay_metadata(study_id, assay_filename, modification_time):
+    return _read_assay_metadata(study_id, assay_filename)
+
+def _get_assay_metadata(study_id, assay_filename, modification_time):
+    # Without a modification time we can't tell when the cached one is out of date
+    if modification_time is None:
+        return _read_assay_metadata(study_id, assay_filename)
+
+    return _get_cached_assay_metadata(study_id, assay_filename, modification_time)
+
+def _read_assay_metadata(study_id, assay_filename):
+    http_path = os.path.join(ASSAY_BASE_URL, study_id, assay_filename)
+
+    # Not from the response cache, it could still have the table from before the modification
+    assay_df = http_client.read_csv(http_path, headers={"Cache-Control": "no-store"}, sep="\t", usecols=lambda col: _extract_bracketed_text(col) in ASSAY_COLUMNS)
+
+    return _select_assay_columns(assay_df)
+
+def _select_assay_columns(assay_df):
+    assay_df = assay_df.loc[:, [_extract_bracketed_text(col) in ASSAY_COLUMNS for col in assay_df.columns]]
+    assay_df.columns = [_extract_bracketed_text(col) for col in assay_df.columns]
 
+    # The same field can be there more than once, e.g. as a comment
+    return assay_df.loc[:, ~assay_df.columns.duplicated()]
+
+def _get_assay_tables(accession):
+    # Fallback when the study document doesn't have the assays, every assay table is downloaded on its own
+    assay_versions = _get_active_assay_versions(accession)
+    assay_futures = [deadline.submit(_assay_executor, _get_assay_metadata, accession, assay_filename, modification_time) for assay_filename, modification_time in assay_versions]
+
+    return [deadline.result(future) for future in assay_futures]
+
+@dataset_cache.memoize()
+def _get_mtbls_study(dataset_accession):
+    """Gets the public study document, the files, assays, title and description all come from this one request
+
+    Returns:
+        dict: title, description and the assays with their table headers in order and rows
+    """
+
+    url = '{SWAGGER_API}/studies/public/study/{study_id}'.format(SWAGGER_API=SWAGGER_API, study_id=dataset_accession)
+    r = http_client.get(url)
+    r.raise_for_status()
+
+    study_details = r.json()['content']
+
+    # Only what we use, the document also has the protocols, factors, publications and so on
+    study_assays = []
+    for assay_json in study_details['assays']:
+        fields_df = pd.DataFrame.from_dict(assay_json['assayTable']['fields'], orient="index")
+
+        study_assays.append({
+            "technology": assay_json['technology'],
+            "headers": fields_df.sort_values("index")["header"].tolist(),
+            "data": assay_json['assayTable']['data'],
+        })
+
+    return {
+        "title": study_details['title'],
+        "description": study_details['description'],
+        "assays": study_assays,
+    }
+
+def _get_study_assays(dataset_accession):
+    # There can be multiple assay tables in the same study, not all of them MS
+    return [pd.DataFrame(assay["data"], columns=assay["headers"]) for assay in _get_mtbls_study(dataset_accession)["assays"] if assay["technology"] == 'mass spectrometry']
 
 def add_mtbls_metadata(files_df, accession):
     try:
-        possible_assays, study_metadata_filename = get_active_assays(accession)
-        assay_list = []
-        for assay_metadata in possible_assays:
-            study_metadata_df_single = get_study_level_metadata(accession, assay_metadata)
-            assay_list.append(study_metadata_df_single)
-
-        #add missing value columns
-        all_columns = set().union(*(df.columns for df in assay_list))
-        for df in assay_list:
-            for col in all_columns:
-                if col not in df.columns:
-                    df[col] = pd.NA
-
-        study_metadata_df = pd.concat(assay_list, ignore_index=True)     
-
-        # Remove unnecissary columns and adapt column names
-        def extract_bracketed_text(col_name):
-            match = re.search(r'\[(.*?)\]', col_name)
-            return match.group(1) if match else col_name
-        
-        study_metadata_df.columns = [extract_bracketed_text(col) for col in study_metadata_df.columns]
-        
-        desired_columns = ['Instrument', 'Instrument manufacturer', 'Raw Spectral Data File', 'Derived Spectral Data File', 'Scan polarity']
-        study_metadata_df = study_metadata_df[[col for col in desired_columns if col in study_metadata_df.columns]]
+        try:
+            assay_list = [_select_assay_columns(assay_df) for assay_df in _get_study_assays(accession)]
+        except deadline.DeadlineExceeded:
+            raise
+        except:
+            assay_list = []
+
+        if len(assay_list) == 0:
+            assay_list = _get_assay_tables(accession)
+
+        # Columns missing from some assays are filled with NA
+        study_metadata_df = pd.concat(assay_list, join="outer", ignore_index=True)
 
         # Duplicate rows if we have mzml AND raw files
         df_study_raw = pd.DataFrame()
@@ -75,16 +153,18 @@ def add_mtbls_metadata(files_df, accession):
         desired_columns = ['filename', 'Instrument', 'Instrument manufacturer', 'Scan polarity']
         files_df = files_df[[col for col in desired_columns if col in files_df.columns]]
 
+    except deadline.DeadlineExceeded:
+        # Not the same as having no metadata, so the files without it don't end up in the cache
+        raise
     except:
         pass
 
     return files_df
 
-def get_active_assays(study_id):
+def _get_active_study_files(study_id):
     url = '{SWAGGER_API}/studies/{study_id}/files?include_raw_data=false'.format(SWAGGER_API=SWAGGER_API, study_id=study_id)
 
-    session = requests.Session()
-    response = session.get(url, timeout = 90) 
+    response = http_client.get(url, timeout=(http_client.CONNECT_TIMEOUT, 90))
     
     try:
         data = response.json()
@@ -97,48 +177,42 @@ def get_active_assays(study_id):
         print("Data not returned properly in getting active assays ", sys.exc_info()[0])
         return
 
-    study_file_info = data['study']
+    return [file_dict for file_dict in data['study'] if file_dict['status'] == 'active']
+
+def _get_active_assay_versions(study_id):
+    # The timestamp changes whenever the file is modified
+    return [(file_dict["file"], file_dict.get("timestamp") or file_dict.get("createdAt")) for file_dict in _get_active_study_files(study_id) if file_dict['type'] == 'metadata_assay']
+
+def get_active_assays(study_id):
+    study_file_info = _get_active_study_files(study_id)
+    if study_file_info is None:
+        return
+
     possible_assays = []
     study_metadata_filename = ''
 
     for file_dict in study_file_info:
-        if file_dict['status' ] == 'active':
-            if file_dict['type'] == 'metadata_sample':
-                study_metadata_filename = file_dict['file']
-            if file_dict['type'] == 'metadata_assay':
-                possible_assays.append(file_dict["file"])        
-        else:
-            continue
+        if file_dict['type'] == 'metadata_sample':
+            study_metadata_filename = file_dict['file']
+        if file_dict['type'] == 'metadata_assay':
+            possible_assays.append(file_dict["file"])        
 
     return(possible_assays, study_metadata_filename)
 
 def get_study_level_metadata(study_id, study_metadata_filename):
-    http_path = os.path.join("http://" + EBI_FTP_SERVER + MTBLS_BASE_DIR, study_id, study_metadata_filename)
+    http_path = os.path.join(ASSAY_BASE_URL, study_id, study_metadata_filename)
     
-    return pd.read_csv(http_path, sep="\t")
+    return http_client.read_csv(http_path, sep="\t")
     
 def _get_mtbls_dataset_information(dataset_accession):
-    url = "https://www.ebi.ac.uk/metabolights/ws/studies/{}/description".format(dataset_accession)
-    r = requests.get(url)
-    description = r.json()["description"]
+    study_details = _get_mtbls_study(dataset_accession)
 
-    url = "https://www.ebi.ac.uk/metabolights/ws/studies/{}/title".format(dataset_accession)
-    r = requests.get(url)
-    title = r.json()["title"]
-     
-    return title, description
+    return study_details["title"], study_details["description"]
 
 def _get_mtbls_files_cached(dataset_accession):
-    url = "https://datasetcache.gnps2.org/datasette/database/filename.csv?_stream=on&_sort=filepath&dataset__exact={}&_size=max".format(dataset_accession)
-    all_files_df = pd.read_csv(url, sep=",")
-
-    all_files = list(all_files_df["filepath"])
-
     acceptable_extensions = [".mzml", ".mzxml", ".cdf", ".raw", ".d"]
-    
-    all_files = [filename for filename in all_files if os.path.splitext(filename)[1].lower() in acceptable_extensions]
 
-    all_files_df = all_files_df[all_files_df["filepath"].isin(all_files)]
+    all_files_df = filename_mirror.get_dataset_files(dataset_accession, acceptable_extensions=acceptable_extensions)
 
     return all_files_df
 
@@ -148,80 +222,23 @@ def _get_mtbls_files(dataset_accession):
         all_files_df = _get_mtbls_files_cached(dataset_accession)
 
         if len(all_files_df) > 0:
-            files_df = pd.DataFrame()
-            files_df["filename"] = all_files_df["filepath"]
-
-            # Adding more information if possible
-            if "collection" in all_files_df:
-                files_df["collection"] = all_files_df["collection"]
-                
-            if "update_name" in all_files_df:
-                files_df["update_name"] = all_files_df["update_name"]
-
-            if "size_mb" in all_files_df:
-                files_df["size_mb"] = all_files_df["size_mb"]
-                files_df["ms2"] = all_files_df["spectra_ms2"]
-                files_df["Vendor"] = all_files_df["instrument_vendor"]
-                files_df["Model"] = all_files_df["instrument_model"]
-
-            return files_df
+            return repositories.shape_cached_files(all_files_df)
     except:
         pass
     
-    study_url = "https://www.ebi.ac.uk:443/metabolights/ws/studies/public/study/" + dataset_accession
-
-    response = requests.get(study_url)
-    study_details = response.json()
-
-    study_assays = study_details['content']['assays']
-
-    df_assays = pd.DataFrame()
-    ms_study_assays = []
-
-    #get study assays if they are MS. There can be multiple assay tables in the same study
-    for index, assay_json in enumerate(study_assays):
-        if assay_json['technology'] == 'mass spectrometry':  
-            # Extract headers in the correct order
-            headers = [None] * len(assay_json['assayTable']['fields'])
-            for key, value in assay_json['assayTable']['fields'].items():
-                headers[value['index']] = value['header']        
+    study_assays = _get_study_assays(dataset_accession)
+    if len(study_assays) == 0:
+        return pd.DataFrame(columns=["filename"])
 
-            df = pd.DataFrame(assay_json['assayTable']['data'])
-            df.columns = headers
-            ms_study_assays.append(df)
+    # Columns missing from some assays are filled with NA
+    df_assays = pd.concat([_select_assay_columns(assay_df) for assay_df in study_assays], join="outer", ignore_index=True)
 
-    if len(ms_study_assays) > 0:
+    # Duplicate rows if we have mzml AND raw files
+    extensions = [".mzml", ".mzxml", ".cdf", ".raw", ".wiff", ".d"]
+    raw_files = df_assays[df_assays['Raw Spectral Data File'].str.lower().str.endswith(tuple(extensions), na=False)]['Raw Spectral Data File'].tolist() if 'Raw Spectral Data File' in df_assays.columns else []
+    mzml_files = df_assays[df_assays['Derived Spectral Data File'].str.lower().str.endswith(tuple(extensions), na=False)]['Derived Spectral Data File'].tolist() if 'Derived Spectral Data File' in df_assays.columns else []
 
-        all_columns = set()
-        for df in ms_study_assays:
-            all_columns.update(df.columns)
-
-        aligned_dfs = []
-        for df in ms_study_assays:
-            # Add missing columns with NaN values
-            for col in all_columns:
-                if col not in df.columns:
-                    df[col] = np.nan
-
-            # Reorder columns and add to the aligned list
-            aligned_dfs.append(df[list(all_columns)])
-
-        df_assays = pd.concat(aligned_dfs, ignore_index=True)
-        # Duplicate rows if we have mzml AND raw files
-        extensions = [".mzml", ".mzxml", ".cdf", ".raw", ".wiff", ".d"]
-        raw_files = df_assays[df_assays['Raw Spectral Data File'].str.lower().str.endswith(tuple(extensions), na=False)]['Raw Spectral Data File'].tolist() if 'Raw Spectral Data File' in df_assays.columns else []
-        mzml_files = df_assays[df_assays['Derived Spectral Data File'].str.lower().str.endswith(tuple(extensions), na=False)]['Derived Spectral Data File'].tolist() if 'Derived Spectral Data File' in df_assays.columns else []
-
-        combined_files = raw_files + mzml_files
-
-        # formatting the output
-        all_files = []
-        for file in combined_files:
-            file_dict = {}
-            file_dict["filename"] = file
-            all_files.append(file_dict)
-
-        return pd.DataFrame(all_files)
+    return pd.DataFrame({"filename": raw_files + mzml_files})
 
 
 
@@ -251,3 +268,20 @@ def _get_mtbls_files(dataset_accession):
 #             pass
     
 #     return acceptable_files
+
+
+class MetabolightsAdapter(repositories.RepositoryAdapter):
+    name = "MetaboLights"
+    accession_pattern = r"^MTBLS\d+$"
+    ttl = (86400, 7 * 86400)
+
+    def list_files(self, accession, dataset_password=""):
+        return _get_mtbls_files(accession)
+
+    def describe(self, accession):
+        return _get_mtbls_dataset_information(accession)
+
+    def add_metadata(self, files_df, accession, metadata_source=None, metadata_option=None):
+        return add_mtbls_metadata(files_df, accession)
+
+repositories.register(MetabolightsAdapter())
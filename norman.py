@@ -1,8 +1,24 @@
-import requests
 from io import StringIO
 import pandas as pd
 import re
+import threading
 from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+
+import repositories
+import dataset_cache
+import http_client
+
+NORMAN_API = "https://dsfp.norman-data.eu/api/1/metastore/schemas/dataset"
+NORMAN_FILES_URL = "https://dsfp.norman-data.eu/data/{}/files.csv"
+
+# The internal id of a dataset never changes, the catalog is refreshed daily to pick up new datasets
+NORMAN_CATALOG_TTL = (86400, 30 * 86400)
+NORMAN_DATASET_TTL = (30 * 86400, 90 * 86400)
+
+_catalog_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="norman-catalog")
+_catalog_lock = threading.Lock()
+_catalog_future = None
 
 
 def _extract_file_name(url):
@@ -80,59 +96,84 @@ def process_dataset_files(
     return df
 
 
-def _get_norman_files(dataset_accession, filter_extensions=True):
-    norman_id = dataset_accession.replace("NORMAN-", "")
-
-    #TODO:  first we go to the dataset cache
+def _get_catalog_entry(dataset):
+    # Only what we use of every dataset
+    return {
+        "internal_id": dataset["internal_id"],
+        "title": dataset.get("title"),
+        "description": dataset.get("description"),
+    }
 
-    # Here we will go directly to Norman API
-    datasets_url = "https://dsfp.norman-data.eu/api/1/metastore/schemas/dataset/all"
+@dataset_cache.memoize(ttl_function=lambda *args: NORMAN_CATALOG_TTL)
+def _get_norman_catalog():
+    """Gets the whole NORMAN catalog, indexed by the uuid of the datasets"""
 
-    response = requests.get(datasets_url)
-    response.raise_for_status()  # Raise an error for bad status codes
-    datasets = response.json()
+    response = http_client.get(NORMAN_API + "/all")
+    response.raise_for_status()
 
-    # lets find the dataset with the norman_id
-    datasets = [ds for ds in datasets if ds['uuid'] == norman_id]
+    return {dataset["uuid"]: _get_catalog_entry(dataset) for dataset in response.json()}
 
-    if len(datasets) == 0:
-        raise ValueError("Dataset with accession {} not found in NORMAN".format(dataset_accession))
-    
-    if len(datasets) >= 1:
-        internal_id = datasets[0]['internal_id']
+def _get_norman_catalog_if_loaded():
+    global _catalog_future
 
-        file_url = f"https://dsfp.norman-data.eu/data/{internal_id}/files.csv"
+    # The first load of the whole catalog is slow, so it happens in the background and we don't wait for it
+    with _catalog_lock:
+        if _catalog_future is None or (_catalog_future.done() and _catalog_future.exception() is not None):
+            _catalog_future = _catalog_executor.submit(_get_norman_catalog)
 
-        response = requests.get(file_url)
-        file_response = requests.get(file_url)
-        file_response.raise_for_status()
+        if not _catalog_future.done():
+            return None
 
-        
-        # Read CSV data into DataFrame
-        csv_data = StringIO(file_response.text)
-        df_files = pd.read_csv(csv_data)
-        print(f"Fetched file data for dataset {internal_id}")
+    # Once loaded it comes from the dataset cache, which also refreshes it in the background
+    try:
+        return _get_norman_catalog()
+    except:
+        return None
 
-        df_files = process_dataset_files(
-            df_files,
-            internal_id=internal_id,
-            uuid=norman_id,
-            filter_extensions=filter_extensions
-        )
+@dataset_cache.memoize(ttl_function=lambda *args: NORMAN_DATASET_TTL)
+def _get_norman_dataset_uncached(norman_id):
+    response = http_client.get("{}/items/{}".format(NORMAN_API, norman_id))
+    if response.status_code == 404:
+        raise ValueError("Dataset with accession NORMAN-{} not found in NORMAN".format(norman_id))
+    response.raise_for_status()
 
-        return df_files
+    return _get_catalog_entry(response.json())
 
-        
+def _get_norman_dataset(dataset_accession):
+    norman_id = dataset_accession.replace("NORMAN-", "")
 
+    norman_catalog = _get_norman_catalog_if_loaded()
 
+    if norman_catalog is not None and norman_id in norman_catalog:
+        return norman_catalog[norman_id]
 
+    # Not in the catalog yet, e.g. a new dataset, so we ask for just this one
+    return _get_norman_dataset_uncached(norman_id)
 
-def _get_norman_dataset_information(dataset_accession):
+def _get_norman_files(dataset_accession, filter_extensions=True):
     norman_id = dataset_accession.replace("NORMAN-", "")
 
-    norman_url = "https://dsfp.norman-data.eu/api/1/metastore/schemas/dataset/items/{}".format(norman_id)
+    internal_id = _get_norman_dataset(dataset_accession)['internal_id']
+
+    file_response = http_client.get(NORMAN_FILES_URL.format(internal_id))
+    file_response.raise_for_status()
+
+    # Read CSV data into DataFrame
+    csv_data = StringIO(file_response.text)
+    df_files = pd.read_csv(csv_data)
+    print(f"Fetched file data for dataset {internal_id}")
 
-    dataset_information = requests.get(norman_url).json()
+    df_files = process_dataset_files(
+        df_files,
+        internal_id=internal_id,
+        uuid=norman_id,
+        filter_extensions=filter_extensions
+    )
+
+    return df_files
+
+def _get_norman_dataset_information(dataset_accession):
+    dataset_information = _get_norman_dataset(dataset_accession)
 
     title = dataset_information["title"]
     description = dataset_information["description"]
@@ -140,5 +181,16 @@ def _get_norman_dataset_information(dataset_accession):
     return title, description
 
 
+class NormanAdapter(repositories.RepositoryAdapter):
+    name = "NORMAN"
+    accession_pattern = r"^NORMAN-[0-9A-Za-z-]+$"
+    ttl = (86400, 30 * 86400)
+
+    def list_files(self, accession, dataset_password=""):
+        # This gets all the metadata as well
+        return _get_norman_files(accession)
 
+    def describe(self, accession):
+        return _get_norman_dataset_information(accession)
 
+repositories.register(NormanAdapter())
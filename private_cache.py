@@ -0,0 +1,197 @@
+import os
+import io
+import hmac
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    # Without it private listings are simply not cached
+    Fernet = None
+
+import pandas as pd
+
+import deadline
+import dataset_cache
+
+# Listings of private datasets, encrypted with a key derived from the password, the password itself is never stored
+CACHE_DIR = os.path.join("temp", "private-listings")
+CACHE_TTL = 600
+MEMORY_ENTRIES = 64
+
+# Secret mixed into every key, so the file names can't be checked against guessed passwords without it
+SECRET_PATH = os.path.join(CACHE_DIR, "secret")
+SECRET_ENV = "PRIVATE_CACHE_SECRET"
+
+# Slow on purpose, the disk entries are only found and decrypted with the right password
+KDF_ITERATIONS = 200000
+
+_secret = None
+_secret_lock = threading.Lock()
+
+_memory_lock = threading.Lock()
+
+# keyed hash of the credentials -> (value, expiration)
+_memory_cache = OrderedDict()
+
+
+def is_enabled():
+    return Fernet is not None
+
+def _get_secret():
+    global _secret
+
+    with _secret_lock:
+        if _secret is not None:
+            return _secret
+
+        if os.environ.get(SECRET_ENV):
+            _secret = os.environ[SECRET_ENV].encode("utf-8")
+            return _secret
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        # The first worker creates it, readable only by us
+        try:
+            secret_file = os.open(SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.write(secret_file, os.urandom(32))
+            finally:
+                os.close(secret_file)
+        except FileExistsError:
+            pass
+
+        with open(SECRET_PATH, "rb") as secret_file:
+            _secret = secret_file.read()
+
+        return _secret
+
+def _credentials(accession, password, key_parts=()):
+    return "\0".join([accession, password] + ["{}".format(part) for part in key_parts]).encode("utf-8")
+
+def _memory_key(accession, password, key_parts=()):
+    return hmac.new(_get_secret(), _credentials(accession, password, key_parts), hashlib.sha256).hexdigest()
+
+def _derive_keys(accession, password, key_parts=()):
+    """Gives the file name and the encryption key of a dataset, password and the rest of the key"""
+
+    derived_key = hashlib.pbkdf2_hmac("sha256", _credentials(accession, password, key_parts), _get_secret(), KDF_ITERATIONS, dklen=64)
+
+    return derived_key[:32].hex(), Fernet(base64.urlsafe_b64encode(derived_key[32:]))
+
+def _get_memory(memory_key):
+    with _memory_lock:
+        if memory_key not in _memory_cache:
+            return None
+
+        value, expiration = _memory_cache[memory_key]
+        if expiration < time.time():
+            del _memory_cache[memory_key]
+            return None
+
+        _memory_cache.move_to_end(memory_key)
+        return value.copy()
+
+def _set_memory(memory_key, value):
+    with _memory_lock:
+        _memory_cache[memory_key] = (value.copy(), time.time() + CACHE_TTL)
+        _memory_cache.move_to_end(memory_key)
+
+        while len(_memory_cache) > MEMORY_ENTRIES:
+            _memory_cache.popitem(last=False)
+
+def _entry_path(entry_id):
+    return os.path.join(CACHE_DIR, entry_id + ".bin")
+
+def _read_disk(entry_id, fernet):
+    try:
+        with open(_entry_path(entry_id), "rb") as entry_file:
+            token = entry_file.read()
+    except OSError:
+        return None
+
+    try:
+        # The token carries its creation time, so the TTL is checked on the encrypted value itself
+        content = fernet.decrypt(token, ttl=CACHE_TTL)
+    except InvalidToken:
+        return None
+
+    return pd.read_parquet(io.BytesIO(content))
+
+def _write_disk(entry_id, fernet, value):
+    output_buffer = io.BytesIO()
+    value.to_parquet(output_buffer, index=False)
+
+    dataset_cache._write_atomic(_entry_path(entry_id), fernet.encrypt(output_buffer.getvalue()))
+
+def prune_disk(now=None):
+    """Removes the entries past their TTL, they can't be decrypted anymore anyway"""
+
+    if now is None:
+        now = time.time()
+
+    try:
+        filenames = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+
+    for filename in filenames:
+        if not filename.endswith(".bin"):
+            continue
+
+        path = os.path.join(CACHE_DIR, filename)
+        try:
+            if os.path.getmtime(path) + CACHE_TTL < now:
+                os.remove(path)
+        except OSError:
+            pass
+
+def get_listing(accession, password, compute_listing, key_parts=()):
+    """Gets the file listing of a private dataset, computing it if it is not cached for this password
+
+    Args:
+        accession (str): dataset accession
+        password (str): password of the dataset
+        compute_listing (function): gives the listing as a pandas.DataFrame when it is not cached
+        key_parts (tuple): anything else the listing depends on, e.g. the metadata added to it
+
+    Returns:
+        pandas.DataFrame: the listing
+    """
+
+    if not is_enabled():
+        return compute_listing()
+
+    memory_key = _memory_key(accession, password, key_parts)
+    files_df = _get_memory(memory_key)
+    if files_df is not None:
+        return files_df
+
+    entry_id, fernet = _derive_keys(accession, password, key_parts)
+
+    # Only one walk per dataset and password at a time, the lock is named after the salted id
+    with dataset_cache._single_flight("private-" + entry_id, timeout=deadline.bound_timeout(dataset_cache.LOCK_TIMEOUT)) as is_acquired:
+        if not is_acquired:
+            deadline.check()
+
+        files_df = _read_disk(entry_id, fernet)
+        if files_df is not None:
+            _set_memory(memory_key, files_df)
+            return files_df.copy()
+
+        files_df = compute_listing()
+
+        _set_memory(memory_key, files_df)
+        try:
+            _write_disk(entry_id, fernet, files_df)
+        except Exception:
+            # Not cached on disk, e.g. columns that can't go into parquet
+            pass
+
+    prune_disk()
+
+    return files_df.copy()
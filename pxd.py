@@ -1,8 +1,12 @@
-import requests
+import os
+import pandas as pd
+
+import repositories
+import http_client
 
 def _get_pxd_dataset_information(dataset_accession):
     url = "http://proteomecentral.proteomexchange.org/cgi/GetDataset?ID={}&outputMode=json&test=no".format(dataset_accession)
-    r = requests.get(url)
+    r = http_client.get(url)
 
     title = r.json()["title"]
     description = r.json()["description"]
@@ -11,7 +15,7 @@ def _get_pxd_dataset_information(dataset_accession):
 
 def _get_pxd_files(dataset_accession):
     url = "http://proteomecentral.proteomexchange.org/cgi/GetDataset?ID={}&outputMode=json&test=no".format(dataset_accession)
-    r = requests.get(url)
+    r = http_client.get(url)
     
     acceptable_extensions = [".raw", ".mzML", ".mzXML", ".CDF", ".RAW", "cdf"]
 
@@ -28,3 +32,15 @@ def _get_pxd_files(dataset_accession):
     return output_list
 
 
+class PrideAdapter(repositories.RepositoryAdapter):
+    name = "PRIDE"
+    accession_pattern = r"^PXD\d+$"
+    ttl = (86400, 30 * 86400)
+
+    def list_files(self, accession, dataset_password=""):
+        return pd.DataFrame(_get_pxd_files(accession))
+
+    def describe(self, accession):
+        return _get_pxd_dataset_information(accession)
+
+repositories.register(PrideAdapter())
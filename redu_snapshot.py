@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+import dataset_cache
+import http_client
+
+REDU_DUMP_URL = "https://redu.gnps2.org/dump"
+
+# Only the columns the app shows, sorted by dataset so every dataset is one contiguous block of rows
+REDU_COLUMNS = ["ATTRIBUTE_DatasetAccession", "filename", "MassSpectrometer", "SampleType", "SampleTypeSub1"]
+
+# The snapshot is an uncompressed Arrow IPC (Feather v2) file, so it can be memory mapped
+SNAPSHOT_PATH = os.path.join("temp", "redu-snapshot", "redu.arrow")
+SNAPSHOT_TTL = 86400
+INDEX_METADATA_KEY = b"redu_snapshot_index"
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="redu-snapshot")
+_lock = threading.Lock()
+_refresh_future = None
+
+# (path, modification time, table, accession -> [start, stop]) of the currently open snapshot
+_open_snapshot = None
+
+
+def _read_redu_dump():
+    return http_client.read_csv(REDU_DUMP_URL, sep="\t", usecols=REDU_COLUMNS, dtype=str)
+
+def build_snapshot():
+    """Downloads the full ReDU table and writes it as a snapshot indexed by dataset accession"""
+
+    redu_df = _read_redu_dump()
+    redu_df = redu_df[REDU_COLUMNS].sort_values("ATTRIBUTE_DatasetAccession", kind="stable").reset_index(drop=True)
+
+    # Row range of every dataset
+    accession_index = {}
+    for accession, row_positions in redu_df.groupby("ATTRIBUTE_DatasetAccession", sort=False).indices.items():
+        accession_index[accession] = [int(row_positions[0]), int(row_positions[-1]) + 1]
+
+    table = pa.Table.from_pandas(redu_df, preserve_index=False)
+    table = table.replace_schema_metadata({INDEX_METADATA_KEY: json.dumps(accession_index).encode("utf-8")})
+
+    os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+    temp_path = "{}.{}.{}.tmp".format(SNAPSHOT_PATH, os.getpid(), threading.get_ident())
+    with pa.OSFile(temp_path, "wb") as output_file:
+        with pa.ipc.new_file(output_file, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, SNAPSHOT_PATH)
+
+def _refresh_snapshot(timeout=0):
+    # Only one worker process downloads the dump, the others keep using the snapshot they have
+    with dataset_cache._single_flight("redu-snapshot", timeout=timeout) as is_acquired:
+        if not is_acquired:
+            return
+
+        # Another worker might have just refreshed it
+        if os.path.exists(SNAPSHOT_PATH) and time.time() - os.path.getmtime(SNAPSHOT_PATH) < SNAPSHOT_TTL:
+            return
+
+        build_snapshot()
+
+def _schedule_refresh():
+    global _refresh_future
+
+    with _lock:
+        if _refresh_future is None or _refresh_future.done():
+            _refresh_future = _executor.submit(_refresh_snapshot)
+
+def _get_open_snapshot():
+    global _open_snapshot
+
+    modification_time = os.path.getmtime(SNAPSHOT_PATH)
+
+    with _lock:
+        if _open_snapshot is not None and _open_snapshot[0] == SNAPSHOT_PATH and _open_snapshot[1] == modification_time:
+            return _open_snapshot[2], _open_snapshot[3]
+
+        # Memory mapped, so only the pages of the datasets we look up are actually read
+        source = pa.memory_map(SNAPSHOT_PATH, "r")
+        table = pa.ipc.open_file(source).read_all()
+        accession_index = json.loads(table.schema.metadata[INDEX_METADATA_KEY])
+
+        _open_snapshot = (SNAPSHOT_PATH, modification_time, table, accession_index)
+
+        return table, accession_index
+
+def get_dataset_metadata(accession):
+    """Gets the ReDU rows of one dataset from the local snapshot
+
+    An old snapshot is still used while a new one is built in the background,
+    if there is no snapshot yet the first one is built in the background and there is no metadata until then.
+
+    Args:
+        accession (str): dataset accession
+
+    Returns:
+        pandas.DataFrame: ReDU metadata of the dataset
+    """
+
+    if not os.path.exists(SNAPSHOT_PATH):
+        # Downloading the whole dump would take the request way past its deadline
+        _schedule_refresh()
+        return pd.DataFrame(columns=REDU_COLUMNS, dtype=str)
+    elif time.time() - os.path.getmtime(SNAPSHOT_PATH) > SNAPSHOT_TTL:
+        _schedule_refresh()
+
+    table, accession_index = _get_open_snapshot()
+
+    start, stop = accession_index.get(accession, [0, 0])
+
+    return table.slice(start, stop - start).to_pandas()
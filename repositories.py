@@ -0,0 +1,156 @@
+import re
+import time
+import threading
+import contextlib
+
+import pandas as pd
+
+import deadline
+import dataset_cache
+
+# What an adapter can do besides listing files and describing the dataset
+CAPABILITY_PRIVATE = "private"
+CAPABILITY_REDU_METADATA = "redu_metadata"
+CAPABILITY_MASSIVE_METADATA = "massive_metadata"
+CAPABILITY_METADATA_OPTIONS = "metadata_options"
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+_adapters = []
+
+# Functions called with (repository name, operation, accession, seconds) after every adapter call
+_timing_hooks = []
+
+
+class RepositoryAdapter:
+    """A data repository we can list files and metadata for
+
+    Subclasses set the class attributes, implement list_files and describe,
+    and register an instance with register() at the bottom of their module.
+    """
+
+    name = None
+
+    # Anchored, so an accession only ever matches one repository
+    accession_pattern = None
+
+    # (soft, hard) seconds we keep listings of this repository in the dataset cache
+    ttl = dataset_cache.DEFAULT_TTL
+
+    # Number of calls into this repository at the same time, per worker
+    max_concurrency = DEFAULT_MAX_CONCURRENCY
+
+    capabilities = frozenset()
+
+    # How files of a dataset are named in USIs and in GNPS workflow parameters
+    usi_prefix_format = "mzspec:{}:"
+    private_usi_prefix_format = "mzspec:PRIVATE{}:"
+    gnps_path_prefix_format = "f.{}/"
+
+    def __init__(self):
+        self.accession_regex = re.compile(self.accession_pattern)
+        self.semaphore = threading.BoundedSemaphore(self.max_concurrency)
+
+    def matches(self, accession):
+        return self.accession_regex.match(accession) is not None
+
+    def list_files(self, accession, dataset_password=""):
+        raise NotImplementedError
+
+    def describe(self, accession):
+        raise NotImplementedError
+
+    def add_metadata(self, files_df, accession, metadata_source=None, metadata_option=None):
+        return files_df
+
+    def get_dataset_files(self, accession, metadata_source, dataset_password="", metadata_option=None):
+        files_df = self.list_files(accession, dataset_password=dataset_password)
+
+        return self.add_metadata(files_df, accession, metadata_source=metadata_source, metadata_option=metadata_option)
+
+def register(adapter):
+    _adapters.append(adapter)
+
+    return adapter
+
+def add_timing_hook(hook):
+    _timing_hooks.append(hook)
+
+def get_adapter(accession):
+    for adapter in _adapters:
+        if adapter.matches(accession):
+            return adapter
+
+    return None
+
+def has_capability(accession, capability):
+    adapter = get_adapter(accession)
+
+    return adapter is not None and capability in adapter.capabilities
+
+def get_ttl(accession):
+    adapter = get_adapter(accession)
+    if adapter is None:
+        return dataset_cache.DEFAULT_TTL
+
+    return adapter.ttl
+
+@contextlib.contextmanager
+def _instrument(adapter, operation, accession):
+    # Waiting for a slot is part of the request budget too, without one we wait as long as it takes
+    if not adapter.semaphore.acquire(timeout=deadline.bound_timeout(None)):
+        raise deadline.DeadlineExceeded()
+
+    try:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            for hook in _timing_hooks:
+                try:
+                    hook(adapter.name, operation, accession, elapsed_time)
+                except:
+                    pass
+    finally:
+        adapter.semaphore.release()
+
+def get_dataset_files(accession, metadata_source, dataset_password="", metadata_option=None):
+    adapter = get_adapter(accession)
+    if adapter is None:
+        raise ValueError("Unknown accession {}".format(accession))
+
+    with _instrument(adapter, "list_files", accession):
+        return adapter.get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
+
+def describe(accession):
+    adapter = get_adapter(accession)
+    if adapter is None:
+        raise ValueError("Unknown accession {}".format(accession))
+
+    with _instrument(adapter, "describe", accession):
+        return adapter.describe(accession)
+
+def has_acceptable_extension(filename, acceptable_extensions):
+    return filename.lower().endswith(tuple(acceptable_extensions))
+
+def shape_cached_files(all_files_df):
+    """Turns rows of the dataset cache filename table into the columns we show"""
+
+    files_df = pd.DataFrame()
+    files_df["filename"] = all_files_df["filepath"]
+
+    # Adding more information if possible
+    if "collection" in all_files_df:
+        files_df["collection"] = all_files_df["collection"]
+
+    if "update_name" in all_files_df:
+        files_df["update_name"] = all_files_df["update_name"]
+
+    if "size_mb" in all_files_df:
+        files_df["size_mb"] = all_files_df["size_mb"]
+        files_df["ms2"] = all_files_df["spectra_ms2"]
+        files_df["Vendor"] = all_files_df["instrument_vendor"]
+        files_df["Model"] = all_files_df["instrument_model"]
+
+    return files_df
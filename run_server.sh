@@ -2,4 +2,4 @@
 
 #python ./app.py
 source activate python310
-gunicorn -w 4 --threads=6 --worker-class=gthread -b 0.0.0.0:5000 --timeout 3600 app:server --access-logfile /app/logs/access.log
+gunicorn -w 4 --threads=6 --worker-class=gthread -b 0.0.0.0:5000 --timeout 60 app:server --access-logfile /app/logs/access.log
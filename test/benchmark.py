@@ -0,0 +1,729 @@
+import os
+import sys
+import time
+import json
+sys.path.insert(0, "..")
+
+import pandas as pd
+import plotly
+
+def _time_callback(callback, *args, repeats=5):
+    best_time = None
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        output = callback(*args)
+        elapsed_time = time.perf_counter() - start_time
+
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+
+    request_size = len(json.dumps(args))
+    response_size = len(json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder))
+
+    return best_time * 1000, request_size, response_size
+
+def _synthetic_files_df(accession, file_count):
+    # Looks like a large MassIVE listing from the dataset cache
+    files_df = pd.DataFrame()
+    files_df["filename"] = ["ccms_peak/batch_{}/sample_{}.mzML".format(i % 50, i) for i in range(file_count)]
+    files_df["collection"] = "ccms_peak"
+    files_df["update_name"] = ["update_{}".format(i % 3) for i in range(file_count)]
+    files_df["size_mb"] = [i % 500 for i in range(file_count)]
+    files_df["ms2"] = [i % 7000 for i in range(file_count)]
+    files_df["Vendor"] = "Thermo Fisher Scientific"
+    files_df["Model"] = "Q Exactive HF"
+
+    return files_df
+
+def benchmark_link_callbacks(file_count=20000):
+    import app
+    import utils
+
+    accession = "MSV000000001"
+    files_df = utils._add_usi_column(_synthetic_files_df(accession, file_count), accession)
+
+    # Serving the synthetic dataset instead of going upstream
+    app._get_dataset_files = lambda *args, **kwargs: files_df
+    app._prefetch_dataset = lambda *args, **kwargs: None
+
+    dataset_files = app.list_files(accession, "", "DEFAULT", "")[1]
+    selected_ids = list(range(0, 500, 10))
+    page_data, page_count, selected_rows = app._get_table_page(files_df, 0, 10, [], "", selected_ids)
+    selected_row_ids = [page_data[i]["id"] for i in selected_rows]
+    sort_by = [{"column_id": "size_mb", "direction": "desc"}]
+    filter_query = "{filename} contains 1"
+
+    interactions = {
+        "selection change": [
+            ("update_file_table_selection", app.update_file_table_selection, (selected_row_ids, page_data, selected_ids)),
+            ("create_link", app.create_link, (selected_ids, [], "us", dataset_files)),
+        ],
+        "filter/sort change": [
+            ("update_file_table", app.update_file_table, (dataset_files, 0, 10, sort_by, filter_query, selected_ids)),
+            ("create_filtered_link", app.create_filtered_link, (filter_query, sort_by, "", [], dataset_files, "us")),
+        ],
+        "page change": [
+            ("update_file_table", app.update_file_table, (dataset_files, 5, 10, [], "", selected_ids)),
+        ],
+        "dataset load": [
+            ("list_files", app.list_files, (accession, "", "DEFAULT", "")),
+            ("update_file_table", app.update_file_table, (dataset_files, 0, 10, [], "", [])),
+            ("update_file_table2", app.update_file_table2, (dataset_files, 0, 10, [], "", [])),
+            ("create_all_usi_text", app.create_all_usi_text, (dataset_files,)),
+            ("create_filtered_link", app.create_filtered_link, ("", [], "", [], dataset_files, "us")),
+            ("create_link", app.create_link, ([], [], "us", dataset_files)),
+        ],
+    }
+
+    for interaction, callbacks in interactions.items():
+        for callback_name, callback, args in callbacks:
+            elapsed_ms, request_size, response_size = _time_callback(callback, *args)
+            print("{}: {} {:.1f} ms, request {} bytes, response {} bytes".format(interaction, callback_name, elapsed_ms, request_size, response_size))
+
+def benchmark_list_files(file_count=50000):
+    import app
+    import utils
+
+    accession = "MSV000000002"
+    files_df = utils._add_usi_column(_synthetic_files_df(accession, file_count), accession)
+
+    app._get_dataset_files = lambda *args, **kwargs: files_df
+    app._prefetch_dataset = lambda *args, **kwargs: None
+
+    # What list_files used to send, the full listing once per table
+    def _list_files_both_tables():
+        return [files_df.to_dict(orient="records"), files_df.to_dict(orient="records")]
+
+    elapsed_ms, request_size, response_size = _time_callback(_list_files_both_tables, repeats=3)
+    print("dataset load before: full listing for both tables {:.1f} ms, response {} bytes".format(elapsed_ms, response_size))
+
+    total_ms = 0
+    total_size = 0
+    elapsed_ms, request_size, response_size = _time_callback(app.list_files, accession, "", "DEFAULT", "", repeats=3)
+    total_ms += elapsed_ms
+    total_size += response_size
+
+    dataset_files = app.list_files(accession, "", "DEFAULT", "")[1]
+    for table_callback in [app.update_file_table, app.update_file_table2]:
+        elapsed_ms, request_size, response_size = _time_callback(table_callback, dataset_files, 0, 10, [], "", [], repeats=3)
+        total_ms += elapsed_ms
+        total_size += response_size
+
+    print("dataset load after: shared handle and one page per table {:.1f} ms, response {} bytes".format(total_ms, total_size))
+
+# Typical latencies of the upstream services for a large MassIVE dataset, in seconds
+UPSTREAM_LATENCIES = {
+    "files": 2.0,
+    "description": 0.8,
+    "metadata options": 0.6,
+    "metadata file": 0.5,
+    "dataset index": 5.0,
+}
+
+class _StubResponse:
+    def __init__(self, json_data):
+        self.json_data = json_data
+
+    def json(self):
+        return self.json_data
+
+class _StubMassiveRequests:
+    # Stands in for the http client in utils, only the metadata options lookups go through it
+    def get(self, url, **kwargs):
+        time.sleep(UPSTREAM_LATENCIES["metadata options"])
+
+        if "massiveinformation" in url:
+            return _StubResponse({"task": "0123456789abcdef0123456789abcdef"})
+        return _StubResponse({"blockData": [{"File_descriptor": "f.MSV000000007/metadata/metadata.tsv"}]})
+
+def _stub_upstreams(file_count):
+    import utils
+    import ming_proteosafe_library
+
+    def _stub_all_datasets():
+        time.sleep(UPSTREAM_LATENCIES["dataset index"])
+        return [{"dataset": "MSV{:09d}".format(i), "task": "{:032x}".format(i)} for i in range(20000)]
+
+    def _stub_files_cached(accession):
+        time.sleep(UPSTREAM_LATENCIES["files"])
+        all_files_df = _synthetic_files_df(accession, file_count).rename(columns={"filename": "filepath", "ms2": "spectra_ms2", "Vendor": "instrument_vendor", "Model": "instrument_model"})
+        all_files_df["filepath"] = accession + "/" + all_files_df["filepath"]
+        return all_files_df
+
+    def _stub_metadata(accession, metadata_option=None):
+        utils._get_massive_metadata_options(accession)
+        time.sleep(UPSTREAM_LATENCIES["metadata file"])
+        metadata_df = pd.DataFrame()
+        metadata_df["filename"] = ["sample_{}.mzML".format(i) for i in range(file_count)]
+        metadata_df["ATTRIBUTE_Group"] = ["G{}".format(i % 4) for i in range(file_count)]
+        return metadata_df
+
+    def _stub_description(accession):
+        time.sleep(UPSTREAM_LATENCIES["description"])
+        return "Title", "Description"
+
+    utils.http_client = _StubMassiveRequests()
+    ming_proteosafe_library.get_all_datasets = _stub_all_datasets
+    utils._get_massive_files_cached = _stub_files_cached
+    utils._get_massive_metadata = _stub_metadata
+    utils._get_massive_dataset_information = _stub_description
+
+def _run_callbacks_concurrently(callbacks):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Dash fires the callbacks for a new accession at the same time
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(callbacks)) as executor:
+        all_futures = [executor.submit(callback) for callback in callbacks]
+        for future in all_futures:
+            future.result()
+
+    return (time.perf_counter() - start_time) * 1000
+
+def benchmark_dataset_loading(file_count=5000):
+    import tempfile
+    import app
+    import utils
+    import dataset_cache
+
+    accession = "MSV000000007"
+    dataset_cache.CACHE_DIR = tempfile.mkdtemp()
+    dataset_cache.clear_memory()
+    _stub_upstreams(file_count)
+
+    # How the callbacks loaded an MSV dataset before, one request after the other inside each callback
+    def _metadata_options_uncached(accession):
+        dataset_task = utils.http_client.get("massiveinformation").json()["task"]
+        return utils.http_client.get(dataset_task).json()["blockData"]
+
+    def _list_files_before():
+        files_df = utils._get_massive_files(accession)
+        _metadata_options_uncached(accession)
+        time.sleep(UPSTREAM_LATENCIES["metadata file"])
+        return files_df
+
+    def _dataset_information_before():
+        return utils._get_massive_dataset_information(accession)
+
+    def _list_metadata_options_before():
+        return _metadata_options_uncached(utils._accession_to_msv_accession(accession))
+
+    elapsed_ms = _run_callbacks_concurrently([_list_files_before, _dataset_information_before, _list_metadata_options_before])
+    print("dataset loading before: serial fetches per callback {:.0f} ms".format(elapsed_ms))
+
+    elapsed_ms = _run_callbacks_concurrently([
+        lambda: app.list_files(accession, "", "MASSIVE", ""),
+        lambda: app.dataset_information(accession, "", "MASSIVE", ""),
+        lambda: app.list_metadata_options(accession, "", "MASSIVE", "", ""),
+    ])
+    print("dataset loading after: all upstream requests started at once {:.0f} ms".format(elapsed_ms))
+
+    # With the dataset index loaded, the task id of another dataset is known without asking MassIVE
+    utils._get_massive_dataset_index()
+    other_accession = "MSV000000008"
+
+    start_time = time.perf_counter()
+    _metadata_options_uncached(other_accession)
+    print("metadata options before: {:.0f} ms".format((time.perf_counter() - start_time) * 1000))
+
+    start_time = time.perf_counter()
+    utils._get_massive_metadata_options(other_accession)
+    print("metadata options after, dataset index loaded: {:.0f} ms".format((time.perf_counter() - start_time) * 1000))
+
+    start_time = time.perf_counter()
+    utils._get_massive_metadata_options(other_accession)
+    print("metadata options after, repeated: {:.0f} ms".format((time.perf_counter() - start_time) * 1000))
+
+def _write_synthetic_filename_csv(path, accession, file_count):
+    # Looks like the datasette export of the dataset cache filename table
+    extensions = [".mzML", ".mzXML", ".raw", ".txt", ".mgf", ".RAW", ".tsv", ".mzML"]
+
+    filename_df = pd.DataFrame()
+    filename_df["rowid"] = range(file_count)
+    filename_df["filepath"] = ["{}/ccms_peak/batch_{}/sample_{}{}".format(accession, i % 50, i, extensions[i % len(extensions)]) for i in range(file_count)]
+    filename_df["dataset"] = accession
+    filename_df["collection"] = "ccms_peak"
+    filename_df["is_update"] = 0
+    filename_df["update_name"] = ["update_{}".format(i % 3) for i in range(file_count)]
+    filename_df["create_time"] = "2021-06-01 12:00:00"
+    filename_df["size"] = [i * 1000 for i in range(file_count)]
+    filename_df["size_mb"] = [i % 500 for i in range(file_count)]
+    filename_df["spectra_ms1"] = [i % 3000 for i in range(file_count)]
+    filename_df["spectra_ms2"] = [i % 7000 for i in range(file_count)]
+    filename_df["instrument_vendor"] = "Thermo Fisher Scientific"
+    filename_df["instrument_model"] = "Q Exactive HF"
+    filename_df["file_descriptor"] = "f." + filename_df["filepath"]
+    filename_df["usi"] = "mzspec:" + accession + ":" + filename_df["filepath"]
+    filename_df["md5"] = ["{:032x}".format(i) for i in range(file_count)]
+    filename_df.to_csv(path, index=False)
+
+def _read_filename_csv_before(url):
+    # What the cached listing functions did before
+    all_files_df = pd.read_csv(url, sep=",")
+
+    all_files = list(all_files_df["filepath"])
+
+    acceptable_extensions = [".mzml", ".mzxml", ".cdf", ".raw"]
+
+    all_files = [filename for filename in all_files if os.path.splitext(filename)[-1].lower() in acceptable_extensions]
+
+    all_files_df = all_files_df[all_files_df["filepath"].isin(all_files)]
+
+    return all_files_df
+
+def _measure(function, *args):
+    import tracemalloc
+
+    start_time = time.perf_counter()
+    output = function(*args)
+    elapsed_time = time.perf_counter() - start_time
+
+    # Measuring memory separately, tracing slows everything down
+    tracemalloc.start()
+    function(*args)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return output, elapsed_time * 1000, peak_memory / 1024 / 1024
+
+def benchmark_datasette_listing(file_count=100000):
+    import tempfile
+    import filename_mirror
+
+    accession = "MSV000000015"
+    temp_folder = tempfile.mkdtemp()
+    csv_path = os.path.join(temp_folder, "filename_{}.csv".format(accession))
+    _write_synthetic_filename_csv(csv_path, accession, file_count)
+
+    filename_mirror.DATASET_FILES_URL = os.path.join(temp_folder, "filename_{}.csv")
+    filename_mirror.MIRROR_PATH = os.path.join(temp_folder, "no-mirror.sqlite")
+
+    files_df, elapsed_ms, peak_mb = _measure(_read_filename_csv_before, csv_path)
+    print("datasette listing before: {} files {:.0f} ms, peak memory {:.1f} MB".format(len(files_df), elapsed_ms, peak_mb))
+
+    files_df, elapsed_ms, peak_mb = _measure(filename_mirror.get_dataset_files, accession, [".mzml", ".mzxml", ".cdf", ".raw"])
+    print("datasette listing after: {} files {:.0f} ms, peak memory {:.1f} MB".format(len(files_df), elapsed_ms, peak_mb))
+
+def _start_hanging_upstream():
+    import socket
+
+    # Connections are queued by the kernel but never answered, like an upstream that hangs
+    listening_socket = socket.socket()
+    listening_socket.bind(("127.0.0.1", 0))
+    listening_socket.listen(1024)
+
+    return listening_socket, "http://127.0.0.1:{}".format(listening_socket.getsockname()[1])
+
+def _request_latencies(url, request_count):
+    import http_client
+
+    latencies = []
+    for i in range(request_count):
+        start_time = time.perf_counter()
+        try:
+            http_client.get(url)
+        except Exception:
+            pass
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+    return pd.Series(latencies)
+
+def benchmark_upstream_incident(request_count=40, read_timeout=0.5):
+    import http_client
+    import circuit_breaker
+
+    listening_socket, base_url = _start_hanging_upstream()
+
+    # The real read timeout is minutes, it is scaled down here so the benchmark is quick
+    http_client.DEFAULT_TIMEOUT = (http_client.CONNECT_TIMEOUT, read_timeout)
+
+    original_threshold = circuit_breaker.FAILURE_THRESHOLD
+    try:
+        for name, failure_threshold in [("without breaker", request_count + 1), ("with breaker", original_threshold)]:
+            circuit_breaker.reset()
+            circuit_breaker.FAILURE_THRESHOLD = failure_threshold
+
+            latencies = _request_latencies(base_url + "/files", request_count)
+            # The first requests still wait for the failures that open the breaker
+            print("upstream down {}: {} requests in {:.0f} ms, p50 {:.1f} ms, max after the first {} requests {:.1f} ms".format(name, request_count, latencies.sum(), latencies.quantile(0.5), original_threshold, latencies.iloc[original_threshold:].max()))
+    finally:
+        circuit_breaker.FAILURE_THRESHOLD = original_threshold
+        http_client.DEFAULT_TIMEOUT = (http_client.CONNECT_TIMEOUT, http_client.READ_TIMEOUT)
+        listening_socket.close()
+
+def _write_synthetic_ftp_tree(root_folder, depth, fanout, files_per_folder):
+    folders = [""]
+    level_folders = [""]
+    for level in range(depth):
+        level_folders = [os.path.join(folder, "d{}".format(i)) for folder in level_folders for i in range(fanout)]
+        folders += level_folders
+
+    file_count = 0
+    for folder in folders:
+        os.makedirs(os.path.join(root_folder, "MSV000000001", "ccms_peak", folder), exist_ok=True)
+        for i in range(files_per_folder):
+            with open(os.path.join(root_folder, "MSV000000001", "ccms_peak", folder, "{}.mzML".format(i)), "w") as file:
+                file.write("x")
+            file_count += 1
+
+    return len(folders), file_count
+
+def _start_ftp_server(root_folder, command_latency):
+    import logging
+    import threading
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    # The server logs every session otherwise
+    logging.getLogger("pyftpdlib").addHandler(logging.NullHandler())
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root_folder)
+
+    # Every command waits for a round trip, like a server across the internet
+    class _Handler(FTPHandler):
+        def pre_process_command(self, line, cmd, arg):
+            time.sleep(command_latency)
+            return super().pre_process_command(line, cmd, arg)
+
+    _Handler.authorizer = authorizer
+
+    server = ThreadedFTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+
+    return server, server.address[1]
+
+def _walk_ftp_before(port, directories):
+    import ftputil
+    import ftputil.session
+    import ming_proteosafe_library
+
+    session_factory = ftputil.session.session_factory(port=port)
+    massive_host = ftputil.FTPHost("127.0.0.1", "anonymous", "", session_factory=session_factory)
+
+    all_files = []
+    for directory in directories:
+        all_files += ming_proteosafe_library.get_all_files_in_dataset_folder_ftp("MSV000000001", directory.split("/")[-1], massive_host=massive_host)
+
+    massive_host.close()
+
+    return all_files
+
+def benchmark_ftp_listing(depth=4, fanout=4, files_per_folder=5, command_latency=0.01):
+    import tempfile
+    import ftp_listing
+
+    root_folder = tempfile.mkdtemp()
+    folder_count, file_count = _write_synthetic_ftp_tree(root_folder, depth, fanout, files_per_folder)
+
+    server, port = _start_ftp_server(root_folder, command_latency)
+    directories = ["MSV000000001/ccms_peak", "MSV000000001/peak", "MSV000000001/raw"]
+
+    try:
+        start_time = time.perf_counter()
+        files_before = _walk_ftp_before(port, directories)
+        print("ftp listing of {} folders, {} files, {:.0f} ms per command: ftputil walk {:.0f} ms".format(folder_count, file_count, command_latency * 1000, (time.perf_counter() - start_time) * 1000))
+
+        for connection_count in [1, 4, 8]:
+            start_time = time.perf_counter()
+            files_after = ftp_listing.walk_files("127.0.0.1", directories, port=port, connection_count=connection_count)
+            print("ftp listing of {} folders, {} files, {:.0f} ms per command: MLSD walk on {} connections {:.0f} ms".format(folder_count, file_count, command_latency * 1000, connection_count, (time.perf_counter() - start_time) * 1000))
+
+        assert sorted(files_before) == files_after
+    finally:
+        server.close_all()
+
+def _start_ranged_file_server(content):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start, end = 0, len(content) - 1
+            range_header = self.headers.get("Range")
+            if range_header is not None:
+                start, end = range_header.replace("bytes=", "").split("-")
+                if start == "":
+                    start, end = len(content) - int(end), len(content) - 1
+                else:
+                    start, end = int(start), min(int(end or len(content) - 1), len(content) - 1)
+
+            self.send_response(206 if range_header is not None else 200)
+            self.send_header("Content-Length", str(end + 1 - start))
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(content)))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            # No copy of the range, so only the client shows up in the measured memory
+            self.wfile.write(memoryview(content)[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+def _read_zip_member_before(url, member_filename):
+    import http_client
+    from remotezip import RemoteZip
+
+    # The whole member ends up in memory before anything can be sent
+    with RemoteZip(url, session=http_client.get_session()) as zip:
+        return len(zip.read(member_filename))
+
+def _stream_zip_member(url, member_filename):
+    import zenodo
+
+    zip_member = [zip_member for zip_member in zenodo._get_zip_index.__wrapped__(None, url) if zip_member["filename"] == member_filename][0]
+
+    return sum(len(chunk) for chunk in zenodo.open_zip_member(url, zip_member))
+
+def benchmark_zip_member(member_mb=64):
+    import io
+    import zipfile
+
+    line_count = member_mb * 1024 * 1024 // 32
+    spectra = "".join("{:>10} {:>20}\n".format(i, (i * 7919) % 1000003) for i in range(line_count)).encode("utf-8")
+
+    output_buffer = io.BytesIO()
+    with zipfile.ZipFile(output_buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("other.mzML", spectra[:1024])
+        zip_file.writestr("spectra.mzML", spectra)
+    zip_content = output_buffer.getvalue()
+    del spectra
+
+    server, base_url = _start_ranged_file_server(zip_content)
+    url = base_url + "/record.zip"
+
+    try:
+        for name, function in [("before", _read_zip_member_before), ("after", _stream_zip_member)]:
+            member_size, elapsed_ms, peak_mb = _measure(function, url, "spectra.mzML")
+            print("zip member {}: {:.0f} MB from a {:.1f} MB archive in {:.0f} ms, peak memory {:.1f} MB".format(name, member_size / 1024 / 1024, len(zip_content) / 1024 / 1024, elapsed_ms, peak_mb))
+    finally:
+        server.shutdown()
+
+def _synthetic_assay_table(assay_index, row_count, extra_column_count):
+    columns = ["Sample Name", "Protocol REF", "Parameter Value[Instrument]", "Parameter Value[Scan polarity]", "Raw Spectral Data File", "Derived Spectral Data File"]
+    columns += ["Parameter Value[Field {}]".format(i) for i in range(extra_column_count)]
+
+    lines = ["\t".join(columns)]
+    for i in range(row_count):
+        row = ["s{}_{}".format(assay_index, i), "Mass spectrometry", "Q Exactive", "positive", "FILES/s{}_{}.raw".format(assay_index, i), "FILES/s{}_{}.mzML".format(assay_index, i)]
+        row += ["value {}".format(j) for j in range(extra_column_count)]
+        lines.append("\t".join(row))
+
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def _start_latency_server(get_content, latency):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    request_paths = []
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            request_paths.append(path)
+
+            # Every round trip to the upstream takes a while
+            time.sleep(latency)
+            content = get_content(path)
+
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, "http://127.0.0.1:{}".format(server.server_address[1]), request_paths
+
+def _read_study_metadata_before(accession):
+    import re
+    import metabolights
+    import http_client
+
+    # What add_mtbls_metadata did before, one full table after the other and the columns aligned one by one
+    possible_assays, study_metadata_filename = metabolights.get_active_assays(accession)
+    assay_list = []
+    for assay_metadata in possible_assays:
+        assay_list.append(http_client.read_csv(os.path.join(metabolights.ASSAY_BASE_URL, accession, assay_metadata), headers={"Cache-Control": "no-store"}, sep="\t"))
+
+    all_columns = set().union(*(df.columns for df in assay_list))
+    for df in assay_list:
+        for col in all_columns:
+            if col not in df.columns:
+                df[col] = pd.NA
+
+    study_metadata_df = pd.concat(assay_list, ignore_index=True)
+    study_metadata_df.columns = [re.search(r'\[(.*?)\]', col).group(1) if "[" in col else col for col in study_metadata_df.columns]
+
+    return study_metadata_df
+
+def _read_study_metadata_after(accession):
+    import metabolights
+    import deadline
+
+    assay_futures = [deadline.submit(metabolights._assay_executor, metabolights._get_assay_metadata, accession, assay_filename, modification_time) for assay_filename, modification_time in metabolights._get_active_assay_versions(accession)]
+
+    return pd.concat([deadline.result(future) for future in assay_futures], join="outer", ignore_index=True)
+
+def benchmark_mtbls_assays(assay_count=24, row_count=500, extra_column_count=60, latency=0.1):
+    import tempfile
+    import metabolights
+    import dataset_cache
+
+    assay_tables = {"a_assay_{}.txt".format(i): _synthetic_assay_table(i, row_count, extra_column_count) for i in range(assay_count)}
+    study_files = [{"file": filename, "status": "active", "type": "metadata_assay", "timestamp": "20240101000000"} for filename in assay_tables]
+
+    def _get_content(path):
+        if path.endswith("/files"):
+            return json.dumps({"study": study_files}).encode("utf-8")
+        return assay_tables[path.split("/")[-1]]
+
+    server, base_url, request_paths = _start_latency_server(_get_content, latency)
+    metabolights.SWAGGER_API = base_url + "/ws"
+    metabolights.ASSAY_BASE_URL = base_url + "/studies"
+    dataset_cache.CACHE_DIR = tempfile.mkdtemp()
+    dataset_cache.clear_memory()
+
+    try:
+        for name, function in [("before", _read_study_metadata_before), ("after", _read_study_metadata_after)]:
+            start_time = time.perf_counter()
+            study_metadata_df = function("MTBLS1")
+            print("mtbls assays {}: {} assays, {} rows in {:.0f} ms".format(name, assay_count, len(study_metadata_df), (time.perf_counter() - start_time) * 1000))
+
+        # Nothing changed, so after a restart the parsed assays come from the disk cache
+        dataset_cache.clear_memory()
+        start_time = time.perf_counter()
+        _read_study_metadata_after("MTBLS1")
+        print("mtbls assays after, unchanged assays from disk: {:.0f} ms".format((time.perf_counter() - start_time) * 1000))
+    finally:
+        server.shutdown()
+
+def _synthetic_study_document(assay_count, row_count):
+    import io
+
+    study_assays = []
+    for i in range(assay_count):
+        assay_df = pd.read_csv(io.BytesIO(_synthetic_assay_table(i, row_count, 20)), sep="\t", dtype=str)
+        fields = {"{}_{}".format(index, header): {"index": index, "header": header} for index, header in enumerate(assay_df.columns)}
+        study_assays.append({"technology": "mass spectrometry", "assayTable": {"fields": fields, "data": assay_df.values.tolist()}})
+
+    return {"content": {"title": "Study", "description": "Description", "assays": study_assays}}
+
+def benchmark_mtbls_page_load(assay_count=12, row_count=500, latency=0.1):
+    import tempfile
+    import metabolights
+    import dataset_cache
+
+    accession = "MTBLS2"
+    study_document = json.dumps(_synthetic_study_document(assay_count, row_count)).encode("utf-8")
+    assay_tables = {"a_assay_{}.txt".format(i): _synthetic_assay_table(i, row_count, 20) for i in range(assay_count)}
+    study_files = [{"file": filename, "status": "active", "type": "metadata_assay", "timestamp": "20240101000000"} for filename in assay_tables]
+
+    def _get_content(path):
+        if path.endswith("/public/study/" + accession):
+            return study_document
+        if path.endswith("/files"):
+            return json.dumps({"study": study_files}).encode("utf-8")
+        if path.endswith("/title"):
+            return json.dumps({"title": "Study"}).encode("utf-8")
+        if path.endswith("/description"):
+            return json.dumps({"description": "Description"}).encode("utf-8")
+        return assay_tables[path.split("/")[-1]]
+
+    server, base_url, request_paths = _start_latency_server(_get_content, latency)
+    metabolights.SWAGGER_API = base_url + "/ws"
+    metabolights.ASSAY_BASE_URL = base_url + "/studies"
+    metabolights._get_mtbls_files_cached = lambda accession: pd.DataFrame()
+    dataset_cache.CACHE_DIR = tempfile.mkdtemp()
+    dataset_cache.clear_memory()
+
+    def _page_load_before():
+        # Study document for the files, the assay tables for the metadata, then the title and description one after the other
+        metabolights.http_client.get(metabolights.SWAGGER_API + "/studies/public/study/" + accession, headers={"Cache-Control": "no-store"}).json()
+        _read_study_metadata_before(accession)
+        metabolights.http_client.get(metabolights.SWAGGER_API + "/studies/{}/description".format(accession), headers={"Cache-Control": "no-store"}).json()
+        metabolights.http_client.get(metabolights.SWAGGER_API + "/studies/{}/title".format(accession), headers={"Cache-Control": "no-store"}).json()
+
+    def _page_load_after():
+        adapter = metabolights.MetabolightsAdapter()
+        adapter.add_metadata(adapter.list_files(accession), accession)
+        adapter.describe(accession)
+
+    try:
+        for name, page_load in [("before", _page_load_before), ("after", _page_load_after)]:
+            del request_paths[:]
+            start_time = time.perf_counter()
+            page_load()
+            print("mtbls page load {}: {} assays, {} requests in {:.0f} ms".format(name, assay_count, len(request_paths), (time.perf_counter() - start_time) * 1000))
+    finally:
+        server.shutdown()
+
+def _get_norman_files_before(dataset_accession):
+    import norman
+    from io import StringIO
+
+    # What _get_norman_files did before, the whole catalog for every lookup
+    norman_id = dataset_accession.replace("NORMAN-", "")
+    datasets = norman.http_client.get(norman.NORMAN_API + "/all", headers={"Cache-Control": "no-store"}).json()
+    internal_id = [dataset for dataset in datasets if dataset["uuid"] == norman_id][0]["internal_id"]
+
+    file_response = norman.http_client.get(norman.NORMAN_FILES_URL.format(internal_id), headers={"Cache-Control": "no-store"})
+
+    return norman.process_dataset_files(pd.read_csv(StringIO(file_response.text)), internal_id=internal_id, uuid=norman_id)
+
+def benchmark_norman_lookup(dataset_count=20000, lookup_count=10, latency=0.1):
+    import tempfile
+    import norman
+    import dataset_cache
+
+    catalog = json.dumps([{"uuid": "uuid-{}".format(i), "internal_id": i, "title": "Dataset {}".format(i), "description": "Description " * 50} for i in range(dataset_count)]).encode("utf-8")
+
+    def _get_content(path):
+        if path.endswith("/all"):
+            return catalog
+        internal_id = path.split("/")[2]
+        return "sample_id,data_independent,data_dependent,data_fullscan\n1,https://files.dsfp.norman-data.eu/sample/{0}/a.mzML,,\n".format(internal_id).encode("utf-8")
+
+    server, base_url, request_paths = _start_latency_server(_get_content, latency)
+    norman.NORMAN_API = base_url + "/api"
+    norman.NORMAN_FILES_URL = base_url + "/data/{}/files.csv"
+    dataset_cache.CACHE_DIR = tempfile.mkdtemp()
+    dataset_cache.clear_memory()
+
+    # Loaded once in the background, then refreshed by the dataset cache
+    norman._get_norman_catalog_if_loaded()
+    norman._catalog_future.result()
+
+    try:
+        for name, get_files in [("before", _get_norman_files_before), ("after", norman._get_norman_files)]:
+            del request_paths[:]
+            start_time = time.perf_counter()
+            for i in range(lookup_count):
+                get_files("NORMAN-uuid-{}".format(dataset_count - 1 - i))
+            print("norman lookup {}: {} datasets in the catalog, {} requests for {} lookups in {:.0f} ms".format(name, dataset_count, len(request_paths), lookup_count, (time.perf_counter() - start_time) * 1000))
+    finally:
+        server.shutdown()
+
+def main():
+    benchmark_norman_lookup()
+    benchmark_mtbls_page_load()
+    benchmark_mtbls_assays()
+    benchmark_zip_member()
+    benchmark_ftp_listing()
+    benchmark_upstream_incident()
+    benchmark_datasette_listing()
+    benchmark_dataset_loading()
+    benchmark_link_callbacks()
+    benchmark_list_files()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,37 @@
 import sys
 import os
+import tempfile
+import contextlib
 sys.path.insert(0, "..")
 import utils
 import metabolights
 import zenodo
 import norman
+import download_resolver
+import dataset_cache
+
+@contextlib.contextmanager
+def _patched(module, **attributes):
+    # Sets module attributes for the length of a test, putting the originals back afterwards
+    original_attributes = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+
+    try:
+        yield
+    finally:
+        for name, value in original_attributes.items():
+            setattr(module, name, value)
+
+@contextlib.contextmanager
+def _temp_dataset_cache():
+    # An empty dataset cache in its own folder
+    with _patched(dataset_cache, CACHE_DIR=tempfile.mkdtemp()):
+        dataset_cache.clear_memory()
+        try:
+            yield dataset_cache.CACHE_DIR
+        finally:
+            dataset_cache.clear_memory()
 
 def test_msv():
     #accession = "MSV000086206"
@@ -71,6 +98,1299 @@ def test_norman():
     print(files)
     
 
+def test_download_resolver():
+    import time
+
+    def _slow_fetch(usi):
+        time.sleep(0.5)
+        return "https://example.org/{}".format(usi.split(":")[-1])
+
+    persistent_cache_path = os.path.join(tempfile.mkdtemp(), "download-links.sqlite")
+    with _patched(download_resolver, _fetch_download_link=_slow_fetch, PERSISTENT_CACHE_PATH=persistent_cache_path):
+        usi_list = ["mzspec:MSV000000001:file{}.mzML".format(i) for i in range(20)]
+
+        # Nothing is resolved within a zero deadline, but the lookups keep going in the background
+        resolved_links, pending_usis = download_resolver.resolve_download_links(usi_list, deadline=0)
+        assert len(pending_usis) == len(usi_list)
+
+        start_time = time.time()
+        resolved_links, pending_usis = download_resolver.resolve_download_links(usi_list, deadline=5)
+        assert time.time() - start_time < 3
+        assert len(pending_usis) == 0
+        assert [usi for usi, _ in resolved_links] == usi_list
+
+        # Now everything comes from the cache
+        start_time = time.time()
+        resolved_links, pending_usis = download_resolver.resolve_download_links(usi_list)
+        assert time.time() - start_time < 0.1
+        assert len(resolved_links) == len(usi_list)
+
+        # Dropping the memory cache, the persistent cache still answers without the network
+        download_resolver._resolved_cache.clear()
+        download_resolver._fetch_download_link = None
+        resolved_links, pending_usis = download_resolver.resolve_download_links(usi_list, deadline=0)
+        assert len(resolved_links) == len(usi_list)
+
+def test_resolve_downloads_api():
+    import app
+
+    def _fetch(usi):
+        return "https://example.org/{}".format(usi.split(":")[-1])
+
+    persistent_cache_path = os.path.join(tempfile.mkdtemp(), "download-links.sqlite")
+    with _patched(download_resolver, _fetch_download_link=_fetch, PERSISTENT_CACHE_PATH=persistent_cache_path):
+        client = app.server.test_client()
+        usi_list = ["mzspec:MSV000000002:file{}.mzML".format(i) for i in range(5)]
+
+        r = client.post("/api/resolve_downloads", json={"usis": usi_list})
+        assert r.status_code == 200
+        assert r.json["pending"] == []
+        assert r.json["resolved"][usi_list[0]] == "https://example.org/file0.mzML"
+
+        r = client.get("/api/resolve_downloads", query_string={"usi": usi_list[:2]})
+        assert len(r.json["resolved"]) == 2
+
+def test_callback_components():
+    import app
+
+    layout_ids = set()
+    components = [app.app.layout]
+    while len(components) > 0:
+        component = components.pop()
+        if isinstance(component, (list, tuple)):
+            components.extend(component)
+            continue
+
+        if getattr(component, "id", None):
+            layout_ids.add(component.id)
+        if getattr(component, "children", None) is not None and not isinstance(component.children, str):
+            components.append(component.children)
+
+    # Every callback, the clientside ones too, is triggered by and reads components that are in the layout
+    for callback in app.app.callback_map.values():
+        for dependency in callback["inputs"] + callback["state"]:
+            assert dependency["id"] in layout_ids, dependency["id"]
+
+def test_usi_column():
+    import pandas as pd
+
+    filenames = ["ccms_peak/sample 1.mzML", "raw/sample2.RAW", "peak/nested/sample3.mzXML"]
+
+    for accession in ["MSV000086206", "9c8d2902db494db39a292c13cf442dac"]:
+        for private in [False, True]:
+            files_df = pd.DataFrame()
+            files_df["filename"] = filenames
+            files_df = utils._add_usi_column(files_df, accession, private=private)
+
+            expected_usis = []
+            for filename in filenames:
+                if private:
+                    usi = "mzspec:PRIVATE{}:{}".format(accession, filename)
+                else:
+                    usi = "mzspec:{}:{}".format(accession, filename)
+
+                if len(accession) == 32:
+                    usi = "mzspec:GNPS:TASK-{}-{}".format(accession, filename)
+
+                expected_usis.append(usi)
+
+            assert list(files_df["usi"]) == expected_usis
+
+def test_table_paging():
+    import io
+    import pandas as pd
+    import app
+
+    files_df = pd.DataFrame()
+    files_df["filename"] = ["sample_{}.mzML".format(i) for i in range(25)]
+    files_df["size_mb"] = list(range(25))
+    files_df = utils._add_usi_column(files_df, "MSV000000001")
+
+    page_data, page_count, selected_rows = app._get_table_page(files_df, 1, 10, [], "", [0, 12, 13])
+    assert page_count == 3
+    assert [row["id"] for row in page_data] == list(range(10, 20))
+    assert selected_rows == [2, 3]
+    assert "usi" not in page_data[0]
+
+    page_data, page_count, selected_rows = app._get_table_page(files_df, 0, 10, [{"column_id": "size_mb", "direction": "desc"}], "{size_mb} >= 20", [])
+    assert page_count == 1
+    assert [row["id"] for row in page_data] == [24, 23, 22, 21, 20]
+
+    page_data, page_count, selected_rows = app._get_table_page(files_df, 0, 10, [], '{filename} contains "_2"', [])
+    assert [row["filename"] for row in page_data] == ["sample_2.mzML"] + ["sample_{}.mzML".format(i) for i in range(20, 25)]
+
+    # Deselecting on one page keeps the selection on the others
+    selected_ids = app._update_selection([12], app._get_table_page(files_df, 1, 10, [], "", [])[0], [0, 12, 13])
+    assert selected_ids == [0, 12]
+    assert app._determine_usi_list(files_df, selected_ids) == ["mzspec:MSV000000001:sample_0.mzML", "mzspec:MSV000000001:sample_12.mzML"]
+
+    # Metadata with its own id column doesn't clash with the row ids
+    files_df["id"] = ["metadata_{}".format(i) for i in range(25)]
+    with _patched(app, _get_dataset_files=lambda accession, metadata_source, **kwargs: files_df):
+        dataset_files = {"accession": "MSV000000001", "dataset_password": "", "metadata_source": "REDU", "metadata_option": ""}
+        page_data, page_count, selected_rows = app._get_table_page(app._get_stored_files_df(dataset_files), 2, 10, [], "", [])
+        assert [row["id"] for row in page_data] == list(range(20, 25))
+        assert page_data[0]["metadata id"] == "metadata_20"
+
+        # The export has every filtered row, not just the current page
+        export = app._export_table(dataset_files, [{"column_id": "size_mb", "direction": "desc"}], "{size_mb} >= 5")
+        export_df = pd.read_csv(io.StringIO(export["content"]))
+        assert export["filename"] == "MSV000000001_files.csv"
+        assert list(export_df["size_mb"]) == list(range(24, 4, -1))
+
+def test_dataset_cache():
+    import pandas as pd
+
+    call_counts = {"files": 0, "description": 0}
+
+    @dataset_cache.memoize(ttl_function=lambda accession: (60, 60) if accession.startswith("MSV") else (-1, -1))
+    def _cached_files(accession):
+        call_counts["files"] += 1
+        files_df = pd.DataFrame()
+        files_df["filename"] = ["a.mzML", "b.mzML"]
+        files_df["size_mb"] = [1, 2]
+        return files_df
+
+    @dataset_cache.memoize()
+    def _cached_description(accession):
+        call_counts["description"] += 1
+        return "Title", "Description"
+
+    with _temp_dataset_cache():
+        files_df = _cached_files("MSV000000001")
+        assert _cached_files("MSV000000001") is files_df
+        assert call_counts["files"] == 1
+
+        # Dropping the memory tier, we read back the parquet from disk
+        dataset_cache.clear_memory()
+        assert _cached_files("MSV000000001").equals(files_df)
+        assert call_counts["files"] == 1
+
+        assert _cached_description("MSV000000001") == ("Title", "Description")
+        dataset_cache.clear_memory()
+        assert _cached_description("MSV000000001") == ("Title", "Description")
+        assert call_counts["description"] == 1
+
+        # Already expired entries are always fetched again
+        _cached_files("MTBLS1")
+        _cached_files("MTBLS1")
+        assert call_counts["files"] == 3
+
+        # Pruning goes by the modification times, which are the expirations, without reading any entry
+        def _count_entries():
+            return sum(len([filename for filename in files if filename.endswith(".parquet")]) for root, dirs, files in os.walk(dataset_cache.CACHE_DIR))
+
+        assert _count_entries() == 2
+        with _patched(dataset_cache, _read_disk=None):
+            dataset_cache.prune_disk()
+        assert _count_entries() == 1
+
+        dataset_cache.clear_memory()
+        _cached_files("MSV000000001")
+        assert call_counts["files"] == 3
+
+def test_dataset_cache_stale_while_revalidate():
+    import time
+
+    call_counts = {"description": 0}
+
+    # Always past the soft TTL, but well within the hard TTL
+    @dataset_cache.memoize(ttl_function=lambda accession: (-1, 60))
+    def _cached_description(accession):
+        call_counts["description"] += 1
+        if call_counts["description"] > 1:
+            time.sleep(0.5)
+        return "Title {}".format(call_counts["description"]), "Description"
+
+    with _temp_dataset_cache():
+        assert _cached_description("MSV000000005") == ("Title 1", "Description")
+
+        # The stale value comes back right away while the refresh runs in the background
+        start_time = time.time()
+        assert _cached_description("MSV000000005") == ("Title 1", "Description")
+        assert _cached_description("MSV000000005") == ("Title 1", "Description")
+        assert time.time() - start_time < 0.2
+
+        time.sleep(1)
+        assert call_counts["description"] == 2
+        assert _cached_description("MSV000000005")[0] == "Title 2"
+
+        # Letting the refresh started by the last call finish in this cache folder
+        time.sleep(1)
+
+def _slow_dataset_files(accession, metadata_source, dataset_password="", metadata_option=None):
+    import time
+    import pandas as pd
+
+    # Recording every upstream fetch in a file, so we can count them across processes
+    with open(os.path.join(dataset_cache.CACHE_DIR, "upstream_fetches.txt"), "a") as fetches_file:
+        fetches_file.write("{}\n".format(accession))
+
+    time.sleep(1)
+
+    files_df = pd.DataFrame()
+    files_df["filename"] = ["a.mzML", "b.mzML"]
+    return files_df
+
+def _get_dataset_files_in_process(accession):
+    import app
+    app._get_dataset_files(accession, "DEFAULT")
+
+def test_dataset_cache_single_flight():
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor
+    import app
+
+    with _temp_dataset_cache(), _patched(utils, get_dataset_files=_slow_dataset_files):
+        # Many threads in this process
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            all_files_df = list(executor.map(lambda i: app._get_dataset_files("MSV000000003", "DEFAULT"), range(16)))
+        assert all(len(files_df) == 2 for files_df in all_files_df)
+
+        # Several worker processes, without any shared memory
+        fork_context = multiprocessing.get_context("fork")
+        all_processes = [fork_context.Process(target=_get_dataset_files_in_process, args=("MSV000000004",)) for i in range(6)]
+        for process in all_processes:
+            process.start()
+        for process in all_processes:
+            process.join()
+            assert process.exitcode == 0
+
+        with open(os.path.join(dataset_cache.CACHE_DIR, "upstream_fetches.txt")) as fetches_file:
+            upstream_fetches = fetches_file.read().split()
+
+        assert upstream_fetches.count("MSV000000003") == 1
+        assert upstream_fetches.count("MSV000000004") == 1
+
+class _StubResponse:
+    def __init__(self, json_data):
+        self.json_data = json_data
+
+    def json(self):
+        return self.json_data
+
+class _StubMassiveRequests:
+    # Answers the MassIVE metadata lookups after a delay, counting the calls
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        import time
+
+        self.urls.append(url)
+        time.sleep(0.3)
+
+        if "massiveinformation" in url:
+            return _StubResponse({"task": "0123456789abcdef0123456789abcdef"})
+        return _StubResponse({"blockData": [{"File_descriptor": "f.MSV000000006/metadata/metadata.tsv"}]})
+
+def test_dataset_loader():
+    import time
+    import pandas as pd
+    import dataset_loader
+    import ming_proteosafe_library
+
+    def _slow_files_cached(accession):
+        time.sleep(0.6)
+        all_files_df = pd.DataFrame()
+        all_files_df["filepath"] = ["{}/ccms_peak/a.mzML".format(accession), "{}/ccms_peak/b.mzML".format(accession)]
+        return all_files_df
+
+    def _slow_metadata(accession, metadata_option=None):
+        metadata_list = utils._get_massive_metadata_options(accession)
+        time.sleep(0.3)
+        metadata_df = pd.DataFrame()
+        metadata_df["filename"] = ["a.mzML", "b.mzML"]
+        metadata_df["ATTRIBUTE_Group"] = ["G1", "G2"]
+        metadata_df["metadata_file"] = metadata_list[0]["File_descriptor"]
+        return metadata_df
+
+    def _slow_description(accession):
+        time.sleep(0.6)
+        return "Title", "Description"
+
+    stub_requests = _StubMassiveRequests()
+    stub_utils = {
+        "http_client": stub_requests,
+        "_massive_index_future": None,
+        "_get_massive_files_cached": _slow_files_cached,
+        "_get_massive_metadata": _slow_metadata,
+        "_get_massive_dataset_information": _slow_description,
+    }
+
+    with _temp_dataset_cache(), _patched(utils, **stub_utils), _patched(ming_proteosafe_library, get_all_datasets=lambda: []):
+        start_time = time.time()
+        dataset_loader.prefetch("MSV000000006", "MASSIVE", dataset_password="", metadata_option="")
+        dataset_loader.prefetch("MSV000000006", "MASSIVE", dataset_password="", metadata_option="")
+
+        files_df = dataset_loader.get_dataset_files("MSV000000006", "MASSIVE", dataset_password="", metadata_option="")
+        metadata_list = dataset_loader.get_metadata_options("MSV000000006")
+        dataset_title, dataset_description = dataset_loader.get_dataset_description("MSV000000006")
+        elapsed_time = time.time() - start_time
+
+        assert list(files_df["ATTRIBUTE_Group"]) == ["G1", "G2"]
+        assert metadata_list[0]["File_descriptor"] == "f.MSV000000006/metadata/metadata.tsv"
+        assert dataset_title == "Title"
+
+        # One lookup of the metadata options shared by everyone, and everything loaded side by side
+        assert len(stub_requests.urls) == 2
+        assert elapsed_time < 1.2
+
+def test_massive_listing_deadline():
+    import time
+    import threading
+    import pandas as pd
+    import deadline
+
+    release = threading.Event()
+
+    def _hung_gnpsdata(dataset_accession):
+        release.wait(30)
+        return []
+
+    with _patched(utils, _get_massive_files_cached=lambda accession: pd.DataFrame(), _get_massive_files_gnpsdata=_hung_gnpsdata):
+        # A hung gnpsdata listing only holds the request until the end of its budget
+        start_time = time.time()
+        try:
+            with deadline.budget(0.5):
+                utils._get_massive_files("MSV000000008")
+            assert False
+        except deadline.DeadlineExceeded:
+            pass
+        finally:
+            release.set()
+        assert time.time() - start_time < 2
+
+def test_massive_dataset_index():
+    import time
+    import ming_proteosafe_library
+
+    def _slow_all_datasets():
+        time.sleep(0.5)
+        return [{"dataset": "MSV000000009", "task": "0123456789abcdef0123456789abcdef"}]
+
+    stub_requests = _StubMassiveRequests()
+
+    with _temp_dataset_cache(), _patched(utils, http_client=stub_requests, _massive_index_future=None), _patched(ming_proteosafe_library, get_all_datasets=_slow_all_datasets):
+        # The index is still loading, so the task id comes from MassIVE directly
+        assert len(utils._get_massive_metadata_options("MSV000000009")) == 1
+        assert len(stub_requests.urls) == 2
+        assert "massiveinformation" in stub_requests.urls[0]
+        assert "_=" not in stub_requests.urls[0]
+
+        # Repeated lookups don't go upstream again
+        utils._get_massive_metadata_options("MSV000000009")
+        assert len(stub_requests.urls) == 2
+
+        # Once the index is loaded, only the metadata list is requested
+        time.sleep(1)
+        dataset_cache.clear_memory()
+        dataset_cache.CACHE_DIR = tempfile.mkdtemp()
+        stub_requests.urls = []
+        utils._get_massive_dataset_index()
+
+        utils._get_massive_metadata_options("MSV000000009")
+        assert len(stub_requests.urls) == 1
+        assert "task=0123456789abcdef0123456789abcdef" in stub_requests.urls[0]
+
+        # Datasets missing from the index still work
+        utils._get_massive_metadata_options("MSV000000010")
+        assert len(stub_requests.urls) == 3
+
+def test_redu_snapshot():
+    import time
+    import pandas as pd
+    import redu_snapshot
+
+    dump_reads = []
+    def _stub_redu_dump():
+        dump_reads.append(time.time())
+        time.sleep(0.5)
+        redu_df = pd.DataFrame()
+        redu_df["ATTRIBUTE_DatasetAccession"] = ["MSV000000012", "MSV000000011", "MSV000000012", "MSV000000011"]
+        redu_df["filename"] = ["f.MSV000000012/a.mzML", "f.MSV000000011/a.mzML", "f.MSV000000012/b.mzML", "f.MSV000000011/b.mzML"]
+        redu_df["MassSpectrometer"] = "Q Exactive"
+        redu_df["SampleType"] = ["plant", "animal", "plant", "animal"]
+        redu_df["SampleTypeSub1"] = "leaf"
+        return redu_df
+
+    snapshot_path = os.path.join(tempfile.mkdtemp(), "redu.arrow")
+
+    with _temp_dataset_cache(), _patched(redu_snapshot, SNAPSHOT_PATH=snapshot_path, _read_redu_dump=_stub_redu_dump):
+        # Without a snapshot the request doesn't wait for the dump, the first one is built in the background
+        start_time = time.time()
+        assert len(redu_snapshot.get_dataset_metadata("MSV000000012")) == 0
+        assert time.time() - start_time < 0.3
+        redu_snapshot._refresh_future.result()
+
+        redu_metadata_df = redu_snapshot.get_dataset_metadata("MSV000000012")
+        assert list(redu_metadata_df["filename"]) == ["f.MSV000000012/a.mzML", "f.MSV000000012/b.mzML"]
+        assert list(redu_snapshot.get_dataset_metadata("MSV000000011")["SampleType"]) == ["animal", "animal"]
+        assert len(redu_snapshot.get_dataset_metadata("MSV000000013")) == 0
+        assert len(dump_reads) == 1
+
+        files_df = pd.DataFrame()
+        files_df["filename"] = ["MSV000000012/a.mzML", "MSV000000012/c.mzML"]
+        files_df = utils._add_redu_metadata(files_df, "MSV000000012", redu_metadata_df=redu_metadata_df)
+        assert list(files_df["ReDU Metadata"]) == ["Yes", "No"]
+
+        # An old snapshot is still served while the new one is built in the background
+        old_time = time.time() - redu_snapshot.SNAPSHOT_TTL - 60
+        os.utime(redu_snapshot.SNAPSHOT_PATH, (old_time, old_time))
+        assert len(redu_snapshot.get_dataset_metadata("MSV000000012")) == 2
+        redu_snapshot._refresh_future.result()
+        assert len(dump_reads) == 2
+
+def test_filename_mirror():
+    import time
+    import pandas as pd
+    import filename_mirror
+
+    temp_folder = tempfile.mkdtemp()
+
+    # The datasette exports, as local files
+    filename_df = pd.DataFrame()
+    filename_df["rowid"] = [1, 2, 3, 4]
+    filename_df["dataset"] = ["MSV000000014", "MTBLS14", "MSV000000014", "ST000014"]
+    filename_df["filepath"] = ["MSV000000014/ccms_peak/b.mzML", "MTBLS14/a.mzML", "MSV000000014/ccms_peak/a.mzML", "ST000014/a.mzML"]
+    filename_df["collection"] = ["ccms_peak", "", "ccms_peak", ""]
+    filename_df["size_mb"] = [10, 20, 30, 40]
+    filename_df.to_csv(os.path.join(temp_folder, "sync_0.csv"), index=False)
+    filename_df.iloc[:0].to_csv(os.path.join(temp_folder, "sync_4.csv"), index=False)
+    filename_df[filename_df["dataset"] == "ST000015"].to_csv(os.path.join(temp_folder, "dataset_ST000015.csv"), index=False)
+    filename_df[filename_df["dataset"] == "ST000014"].assign(dataset="ST000016").to_csv(os.path.join(temp_folder, "dataset_ST000016.csv"), index=False)
+
+    local_urls = {
+        "SYNC_URL": os.path.join(temp_folder, "sync_{}.csv"),
+        "DATASET_FILES_URL": os.path.join(temp_folder, "dataset_{}.csv"),
+        "MIRROR_PATH": os.path.join(temp_folder, "filename-mirror.sqlite"),
+    }
+
+    with _temp_dataset_cache(), _patched(filename_mirror, **local_urls):
+        # Without a mirror we go to the dataset cache
+        assert not filename_mirror.is_enabled()
+        assert len(filename_mirror.get_dataset_files("ST000015")) == 0
+
+        filename_mirror.sync_mirror()
+        assert filename_mirror.is_enabled()
+
+        files_df = filename_mirror.get_dataset_files("MSV000000014")
+        assert list(files_df["filepath"]) == ["MSV000000014/ccms_peak/a.mzML", "MSV000000014/ccms_peak/b.mzML"]
+        assert list(files_df["size_mb"]) == [30, 10]
+        assert len(utils._get_massive_files_cached("MSV000000014")) == 2
+        assert len(filename_mirror.get_dataset_files("MTBLS14")) == 1
+
+        # Syncing again only asks for the new rows
+        os.remove(os.path.join(temp_folder, "sync_0.csv"))
+        filename_mirror.sync_mirror()
+        assert len(filename_mirror.get_dataset_files("ST000014")) == 1
+
+        # Datasets missing from the mirror are added to it when they are first looked up
+        assert len(filename_mirror.get_dataset_files("ST000016")) == 1
+        os.remove(os.path.join(temp_folder, "dataset_ST000016.csv"))
+        assert len(filename_mirror.get_dataset_files("ST000016")) == 1
+
+        # While the upstream is down, lookups back off instead of each starting another sync
+        sync_attempts = []
+
+        def _failing_sync():
+            sync_attempts.append(time.time())
+            raise OSError("Upstream is down")
+
+        connection = filename_mirror._connect()
+        filename_mirror._set_sync_state(connection, "last_sync", 0)
+
+        with _patched(filename_mirror, sync_mirror=_failing_sync):
+            for i in range(5):
+                filename_mirror.get_dataset_files("MSV000000014")
+                filename_mirror._sync_future.result()
+            assert len(sync_attempts) == 1
+
+            filename_mirror._set_sync_state(connection, "last_attempt", time.time() - filename_mirror.SYNC_RETRY_BACKOFF)
+            for i in range(5):
+                filename_mirror.get_dataset_files("MSV000000014")
+                filename_mirror._sync_future.result()
+            assert len(sync_attempts) == 2
+        connection.close()
+
+def test_repository_registry():
+    import time
+    import threading
+    import pandas as pd
+    import deadline
+    import repositories
+
+    # Every accession goes to exactly one repository
+    assert repositories.get_adapter("MSV000086206").name == "MassIVE"
+    assert repositories.get_adapter("MTBLS1842").name == "MetaboLights"
+    assert repositories.get_adapter("PXD005011").name == "PRIDE"
+    assert repositories.get_adapter("ST001709").name == "Metabolomics Workbench"
+    assert repositories.get_adapter("ZENODO-4989929").name == "Zenodo"
+    assert repositories.get_adapter("NORMAN-27df0a3e-3578-4a30-b9e4-1505f9da010d").name == "NORMAN"
+    assert repositories.get_adapter("9c8d2902db494db39a292c13cf442dac").name == "GNPS Task"
+    assert repositories.get_adapter("MSTBLS1") is None
+    assert repositories.get_adapter("xMSV000086206") is None
+    assert utils.get_dataset_description("ABC") == ("Dataset Title - Invalid Accession", "Error Description - Invalid Accession")
+
+    assert dataset_cache.get_repository_ttl("MSV000086206") == (6 * 3600, 7 * 86400)
+    assert dataset_cache.get_repository_ttl("9c8d2902db494db39a292c13cf442dac") == (30 * 86400, 90 * 86400)
+    assert utils.get_usi_prefix("9c8d2902db494db39a292c13cf442dac") == "mzspec:GNPS:TASK-9c8d2902db494db39a292c13cf442dac-"
+    assert utils.get_gnps_path_prefix("9c8d2902db494db39a292c13cf442dac") == "f."
+    assert repositories.has_capability("ST001709", repositories.CAPABILITY_METADATA_OPTIONS)
+    assert not repositories.has_capability("PXD005011", repositories.CAPABILITY_METADATA_OPTIONS)
+
+    # A new repository only has to register itself to get the concurrency limit and timings
+    calls = {"running": 0, "max_running": 0}
+    calls_lock = threading.Lock()
+
+    class _StubAdapter(repositories.RepositoryAdapter):
+        name = "Stub"
+        accession_pattern = r"^STUB\d+$"
+        max_concurrency = 2
+
+        def list_files(self, accession, dataset_password=""):
+            with calls_lock:
+                calls["running"] += 1
+                calls["max_running"] = max(calls["max_running"], calls["running"])
+            time.sleep(0.1)
+            with calls_lock:
+                calls["running"] -= 1
+
+            files_df = pd.DataFrame()
+            files_df["filename"] = ["a.mzML"]
+            return files_df
+
+        def describe(self, accession):
+            return "Stub", "Stub Description"
+
+    timings = []
+    stub_adapter = repositories.register(_StubAdapter())
+    repositories.add_timing_hook(lambda *args: timings.append(args))
+
+    try:
+        all_threads = [threading.Thread(target=utils.get_dataset_files, args=("STUB1", "")) for i in range(6)]
+        for thread in all_threads:
+            thread.start()
+        for thread in all_threads:
+            thread.join()
+
+        assert calls["max_running"] == 2
+        assert utils.get_dataset_description("STUB1") == ("Stub", "Stub Description")
+        assert [timing[:3] for timing in timings].count(("Stub", "list_files", "STUB1")) == 6
+        assert timings[-1][:3] == ("Stub", "describe", "STUB1")
+
+        # Waiting for a slot stops at the end of the request budget
+        for i in range(stub_adapter.max_concurrency):
+            stub_adapter.semaphore.acquire()
+        try:
+            start_time = time.time()
+            with deadline.budget(0.2):
+                try:
+                    repositories.describe("STUB1")
+                    assert False
+                except deadline.DeadlineExceeded:
+                    pass
+            assert time.time() - start_time < 1
+        finally:
+            for i in range(stub_adapter.max_concurrency):
+                stub_adapter.semaphore.release()
+    finally:
+        repositories._adapters.remove(stub_adapter)
+        repositories._timing_hooks.clear()
+
+@contextlib.contextmanager
+def _stub_server(handle_get):
+    import threading
+    import http.server
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            # (status code, body) or (status code, body, headers)
+            response = handle_get(self)
+            status_code, body = response[:2]
+            headers = response[2] if len(response) > 2 else {}
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            self.send_response(status_code)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_address[1])
+    finally:
+        server.shutdown()
+
+@contextlib.contextmanager
+def _unaccepting_server():
+    import time
+    import socket
+
+    # Once its backlog is full, new connections are never accepted and time out
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+
+    backlog = []
+    for i in range(3):
+        backlog_socket = socket.socket()
+        backlog_socket.setblocking(False)
+        backlog_socket.connect_ex(listener.getsockname())
+        backlog.append(backlog_socket)
+    time.sleep(0.2)
+
+    try:
+        yield "http://127.0.0.1:{}".format(listener.getsockname()[1])
+    finally:
+        for backlog_socket in backlog + [listener]:
+            backlog_socket.close()
+
+def test_http_client():
+    import http_client
+
+    client_ports = set()
+    failures = {"/flaky": 2}
+
+    def _handle_get(handler):
+        client_ports.add(handler.client_address[1])
+
+        if failures.get(handler.path, 0) > 0:
+            failures[handler.path] -= 1
+            return 503, "busy"
+
+        if handler.path.startswith("/files.csv"):
+            return 200, "filepath,size_mb\na.mzML,1\nb.mzML,2\n"
+        if handler.path.startswith("/files.json"):
+            return 200, '[{"filename": "a.mzML"}, {"filename": "b.mzML"}]'
+
+        return 200, "ok"
+
+    with _stub_server(_handle_get) as base_url, _patched(http_client, _session=None, RETRY_BACKOFF=0):
+        # One kept alive connection for many requests
+        for i in range(10):
+            assert http_client.get(base_url + "/ping?i={}".format(i)).text == "ok"
+        assert len(client_ports) == 1
+
+        # Overloaded upstreams are retried
+        assert http_client.get(base_url + "/flaky").text == "ok"
+
+        assert list(http_client.read_csv(base_url + "/files.csv")["size_mb"]) == [1, 2]
+        assert sum(len(files_df) for files_df in http_client.read_csv(base_url + "/files.csv?chunked", chunksize=1)) == 2
+        assert list(http_client.read_json(base_url + "/files.json")["filename"]) == ["a.mzML", "b.mzML"]
+
+def test_read_csv_skips_response_cache():
+    import requests_cache
+    import http_client
+
+    request_count = {"files": 0}
+
+    def _handle_get(handler):
+        request_count["files"] += 1
+        return 200, "filepath,size_mb\n" + "".join("{}.mzML,{}\n".format(i, i) for i in range(1000))
+
+    with _stub_server(_handle_get) as base_url, _patched(http_client, _session=None):
+        # The app installs the response cache globally, so the shared session is a cached one
+        assert requests_cache.is_installed()
+        assert hasattr(http_client.get_session(), "cache")
+
+        url = base_url + "/filename.csv?_stream=on"
+        for i in range(2):
+            assert sum(len(files_df) for files_df in http_client.read_csv(url, chunksize=100)) == 1000
+
+        # Streamed from the upstream every time, never stored
+        assert request_count["files"] == 2
+        assert not http_client.get_session().cache.contains(url=url)
+
+def test_request_deadline():
+    import time
+    import threading
+    import app
+    import deadline
+    import http_client
+    import dataset_cache
+    import filename_mirror
+
+    # An upstream that accepts connections but never answers
+    release = threading.Event()
+
+    def _handle_get(handler):
+        release.wait(30)
+        return 200, "filepath\n"
+
+    missing_mirror_path = os.path.join(tempfile.mkdtemp(), "missing-mirror.sqlite")
+
+    with _stub_server(_handle_get) as base_url, _temp_dataset_cache(), _patched(http_client, _session=None), \
+            _patched(filename_mirror, MIRROR_PATH=missing_mirror_path, DATASET_FILES_URL=base_url + "/filename.csv?dataset={}"), \
+            _patched(deadline, REQUEST_BUDGET=1), _patched(app, _prefetch_dataset=lambda *args: None):
+        try:
+            # A single upstream call
+            start_time = time.time()
+            with deadline.budget(0.5):
+                try:
+                    http_client.get(base_url + "/hang")
+                    assert False
+                except deadline.DeadlineExceeded:
+                    pass
+            assert time.time() - start_time < 2
+
+            # A callback, with the budget every request gets
+            start_time = time.time()
+            with deadline.budget(deadline.REQUEST_BUDGET):
+                file_summary, dataset_files, _, _, _, _ = app.list_files("MSV000000001", "", "DEFAULT", "")
+            assert time.time() - start_time < 3
+            assert dataset_files is None
+            assert "Timeout" in file_summary.children
+
+            # The API returns a structured error
+            start_time = time.time()
+            response = app.server.test_client().get("/api/datasets/MSV000000002/files")
+            assert time.time() - start_time < 3
+            assert response.status_code == 504
+            assert response.get_json()["error"] == "timeout"
+
+            # Nothing is left behind for the next request
+            assert deadline.remaining() is None
+        finally:
+            release.set()
+
+def test_connect_timeout_within_deadline():
+    import time
+    import requests
+    import deadline
+    import http_client
+    import circuit_breaker
+
+    with _unaccepting_server() as base_url, _patched(http_client, _session=None, RETRY_BACKOFF=0), _patched(circuit_breaker, _breakers={}):
+        # A connect timeout the budget didn't shorten is the host failing, so it is retried and raised as it is
+        start_time = time.time()
+        with deadline.budget(45):
+            try:
+                http_client.get(base_url + "/files", timeout=(0.5, 120))
+                assert False
+            except deadline.DeadlineExceeded:
+                assert False
+            except requests.ConnectTimeout:
+                pass
+            assert deadline.remaining() > 40
+        assert time.time() - start_time >= 0.5 * (http_client.MAX_RETRIES + 1)
+
+def test_circuit_breaker_connect_timeouts():
+    import requests
+    import deadline
+    import http_client
+    import circuit_breaker
+
+    with _unaccepting_server() as base_url, _patched(http_client, _session=None, RETRY_BACKOFF=0), _patched(circuit_breaker, _breakers={}):
+        # A call that fails without the time to retry still counts as a failure
+        with _patched(http_client, RETRY_BACKOFF=1), deadline.budget(0.7):
+            try:
+                http_client.get(base_url + "/files", timeout=(0.5, 120))
+                assert False
+            except requests.ConnectTimeout:
+                pass
+        assert circuit_breaker.get_status()["127.0.0.1"]["failure_count"] == 1
+
+        # Blackholed connections within a request open the breaker
+        with deadline.budget(45):
+            for i in range(circuit_breaker.FAILURE_THRESHOLD - 1):
+                try:
+                    http_client.get(base_url + "/files", timeout=(0.2, 120))
+                    assert False
+                except requests.ConnectTimeout:
+                    pass
+
+            assert circuit_breaker.get_status()["127.0.0.1"]["state"] == circuit_breaker.STATE_OPEN
+            try:
+                http_client.get(base_url + "/files", timeout=(0.2, 120))
+                assert False
+            except circuit_breaker.CircuitOpenError:
+                pass
+
+def test_circuit_breaker():
+    import time
+    import requests
+    import app
+    import http_client
+    import circuit_breaker
+
+    upstream = {"is_down": True, "requests": 0}
+
+    def _handle_get(handler):
+        upstream["requests"] += 1
+        if upstream["is_down"]:
+            return 503, "down"
+        return 200, "ok"
+
+    with _stub_server(_handle_get) as base_url, _patched(http_client, _session=None, RETRY_BACKOFF=0), _patched(circuit_breaker, RESET_TIMEOUT=0.5, _breakers={}):
+        # A call is one failure however many times it was retried, so it takes FAILURE_THRESHOLD calls to open it
+        for i in range(circuit_breaker.FAILURE_THRESHOLD):
+            assert circuit_breaker.get_status().get("127.0.0.1", {"state": circuit_breaker.STATE_CLOSED})["state"] == circuit_breaker.STATE_CLOSED
+            assert http_client.get(base_url + "/down?i={}".format(i)).status_code == 503
+        assert upstream["requests"] == circuit_breaker.FAILURE_THRESHOLD * (http_client.MAX_RETRIES + 1)
+        opening_requests = upstream["requests"]
+
+        # Now we fail fast, without calling the upstream, as a connection error so the fallbacks kick in
+        start_time = time.time()
+        for i in range(100):
+            try:
+                http_client.get(base_url + "/down?open={}".format(i))
+                assert False
+            except requests.ConnectionError as error:
+                assert isinstance(error, circuit_breaker.CircuitOpenError)
+        assert time.time() - start_time < 1
+        assert upstream["requests"] == opening_requests
+
+        upstream_status = app.server.test_client().get("/api/status").get_json()["upstreams"]["127.0.0.1"]
+        assert upstream_status["state"] == circuit_breaker.STATE_OPEN
+
+        # After the reset timeout a single probe goes through, and it closes the breaker once the upstream is back
+        upstream["is_down"] = False
+        time.sleep(circuit_breaker.RESET_TIMEOUT)
+        assert http_client.get(base_url + "/up").text == "ok"
+        assert circuit_breaker.get_status()["127.0.0.1"]["state"] == circuit_breaker.STATE_CLOSED
+
+@contextlib.contextmanager
+def _ftp_server(root_folder, users={}, handler_attributes={}):
+    import threading
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root_folder)
+    for user, (password, home_folder) in users.items():
+        authorizer.add_user(user, password, home_folder)
+
+    # No penalty for failed logins, we test those
+    handler = type("_Handler", (FTPHandler,), dict(handler_attributes, authorizer=authorizer, auth_failed_timeout=0))
+
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+
+    try:
+        yield server.address[1]
+    finally:
+        server.close_all()
+
+def test_ftp_listing():
+    import ftplib
+    import ftp_listing
+    from pyftpdlib.handlers import FTPHandler
+
+    root_folder = tempfile.mkdtemp()
+    expected_files = []
+    for filepath in ["MSV000000001/ccms_peak/a/b/c/1.mzML", "MSV000000001/ccms_peak/a/2 with space.mzML", "MSV000000001/ccms_peak/d/3.mzXML", "MSV000000001/peak/4.raw", "MSV000000001/other/5.mzML"]:
+        os.makedirs(os.path.dirname(os.path.join(root_folder, filepath)), exist_ok=True)
+        with open(os.path.join(root_folder, filepath), "w") as file:
+            file.write("x")
+        if "/other/" not in filepath:
+            expected_files.append(filepath)
+
+    directories = ["MSV000000001/ccms_peak", "MSV000000001/peak", "MSV000000001/raw"]
+
+    # With MLSD, and with a server that only knows LIST
+    without_mlsd = {"proto_cmds": {command: info for command, info in FTPHandler.proto_cmds.items() if command not in ("MLSD", "MLST")}}
+    for handler_attributes in [{}, without_mlsd]:
+        with _ftp_server(root_folder, users={"MSV000000001": ("secret", os.path.join(root_folder, "MSV000000001"))}, handler_attributes=handler_attributes) as port:
+            assert ftp_listing.walk_files("127.0.0.1", directories, port=port) == sorted(expected_files)
+
+            # Private datasets log in to their own folder
+            private_files = ftp_listing.walk_files("127.0.0.1", ["ccms_peak", "peak", "raw"], user="MSV000000001", password="secret", port=port, connection_count=2)
+            assert private_files == sorted(filepath.replace("MSV000000001/", "") for filepath in expected_files)
+
+            try:
+                ftp_listing.walk_files("127.0.0.1", directories, user="MSV000000001", password="wrong", port=port)
+                assert False
+            except ftplib.error_perm:
+                pass
+
+def test_private_cache():
+    import time
+    from collections import OrderedDict
+    import pandas as pd
+    import app
+    import private_cache
+    import dataset_loader
+
+    password = "hunter2-private-password"
+    ftp_walks = []
+    metadata_fetches = []
+
+    def _stub_ftp_listing(dataset_accession, dataset_password=""):
+        ftp_walks.append(dataset_accession)
+        return pd.DataFrame({"filepath": ["ccms_peak/a.mzML", "ccms_peak/b.mzML"]})
+
+    def _stub_metadata(accession, metadata_option=None):
+        metadata_fetches.append(accession)
+        return pd.DataFrame({"filename": ["a.mzML", "b.mzML"], "ATTRIBUTE_Group": ["G1", "G2"]})
+
+    private_cache_dir = tempfile.mkdtemp()
+    empty_private_cache = {"CACHE_DIR": private_cache_dir, "SECRET_PATH": os.path.join(private_cache_dir, "secret"), "_secret": None, "_memory_cache": OrderedDict()}
+
+    with _temp_dataset_cache(), _patched(private_cache, **empty_private_cache), _patched(utils, _get_massive_files_ftp=_stub_ftp_listing, _get_massive_metadata=_stub_metadata):
+        # Repeat visits don't walk the FTP again, also after a restart when only the disk is left
+        for i in range(3):
+            files_df = dataset_loader.get_dataset_files("MSV000000020", "DEFAULT", dataset_password=password)
+            assert list(files_df["filename"]) == ["ccms_peak/a.mzML", "ccms_peak/b.mzML"]
+        private_cache._memory_cache.clear()
+        assert len(dataset_loader.get_dataset_files("MSV000000020", "DEFAULT", dataset_password=password)) == 2
+        assert len(ftp_walks) == 1
+
+        # Another password is another entry
+        dataset_loader.get_dataset_files("MSV000000020", "DEFAULT", dataset_password="other-password")
+        assert len(ftp_walks) == 2
+
+        # The listing with its metadata is cached too, so the table callbacks don't download the metadata again
+        dataset_files = {"accession": "MSV000000020", "dataset_password": password, "metadata_source": "MASSIVE", "metadata_option": ""}
+        for i in range(5):
+            page_data, page_count, selected_rows = app._get_table_page(app._get_stored_files_df(dataset_files), 0, 10, [], "", [])
+            assert page_data[0]["ATTRIBUTE_Group"] == "G1"
+        private_cache._memory_cache.clear()
+        app._get_stored_files_df(dataset_files)
+        assert len(metadata_fetches) == 1
+        assert len(ftp_walks) == 2
+
+        # Neither the password nor the accession are anywhere on disk, and the listing is encrypted
+        assert oct(os.stat(private_cache.SECRET_PATH).st_mode & 0o777) == "0o600"
+        for cache_folder in [dataset_cache.CACHE_DIR, private_cache.CACHE_DIR]:
+            for root, dirs, files in os.walk(cache_folder):
+                for filename in files:
+                    assert "MSV000000020" not in filename and password not in filename
+                    with open(os.path.join(root, filename), "rb") as cached_file:
+                        content = cached_file.read()
+                    assert password.encode() not in content
+                    assert b"a.mzML" not in content
+
+        # Entries past the TTL are removed
+        private_cache.prune_disk(now=time.time() + private_cache.CACHE_TTL + 1)
+        assert len([filename for filename in os.listdir(private_cache.CACHE_DIR) if filename.endswith(".bin")]) == 0
+
+def _ranged_response(handler, content):
+    range_header = handler.headers.get("Range")
+    if range_header is None:
+        return 200, content
+
+    start, end = range_header.replace("bytes=", "").split("-")
+    if start == "":
+        start, end = max(len(content) - int(end), 0), len(content) - 1
+    else:
+        start, end = int(start), min(int(end or len(content) - 1), len(content) - 1)
+
+    return 206, content[start:end + 1], {"Content-Range": "bytes {}-{}/{}".format(start, end, len(content)), "Accept-Ranges": "bytes"}
+
+def _zip_content(filenames):
+    import io
+    import zipfile
+
+    output_buffer = io.BytesIO()
+    with zipfile.ZipFile(output_buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for filename in filenames:
+            zip_file.writestr(filename, "spectra of {}".format(filename) * 100)
+
+    return output_buffer.getvalue()
+
+def test_zenodo_zip_listing():
+    import json
+    import time
+    import zenodo
+    import http_client
+
+    zip_files = {
+        "/files/first.zip": _zip_content(["first/a.mzML", "first/b.mzXML", "__MACOSX/first/a.mzML", "first/readme.txt"]),
+        "/files/second.zip": _zip_content(["second/c.raw"]),
+    }
+    requests_per_path = {}
+
+    def _handle_get(handler):
+        path = handler.path.split("?")[0]
+        requests_per_path[path] = requests_per_path.get(path, 0) + 1
+
+        # Every request to the upstream takes a while
+        time.sleep(0.3)
+
+        if path.startswith("/records/"):
+            record_id = path.split("/")[-1]
+            record = {
+                "metadata": {"title": "Record {}".format(record_id), "description": "Stub record"},
+                "files": [
+                    {"key": "top.mzML", "checksum": "md5:0", "links": {"self": base_url + "/files/top.mzML"}},
+                    {"key": "first.zip", "checksum": "md5:1", "links": {"self": base_url + "/files/first.zip"}},
+                    {"key": "second.zip", "checksum": "md5:2", "links": {"self": base_url + "/files/second.zip"}},
+                ]
+            }
+            return 200, json.dumps(record)
+
+        return _ranged_response(handler, zip_files[path])
+
+    with _stub_server(_handle_get) as base_url, _temp_dataset_cache(), _patched(zenodo, RECORD_URL=base_url + "/records/{}"), _patched(http_client, _session=None):
+        adapter = zenodo.ZenodoAdapter()
+        expected_files = ["top.mzML", "first.zip-first/a.mzML", "first.zip-first/b.mzXML", "second.zip-second/c.raw"]
+
+        start_time = time.time()
+        assert list(adapter.list_files("ZENODO-1")["filename"]) == expected_files
+        elapsed_time = time.time() - start_time
+
+        # The description comes from the same record
+        assert adapter.describe("ZENODO-1")[0] == "Record 1"
+        assert requests_per_path["/records/1"] == 1
+
+        # The zips are read at the same time, not one after the other
+        zip_requests = requests_per_path["/files/first.zip"] + requests_per_path["/files/second.zip"]
+        assert elapsed_time < 0.3 * (1 + zip_requests) - 0.15
+
+        # Another record, or the same after a restart, with the same archives doesn't read them again
+        dataset_cache.clear_memory()
+        assert list(adapter.list_files("ZENODO-2")["filename"]) == expected_files
+        assert requests_per_path["/files/first.zip"] + requests_per_path["/files/second.zip"] == zip_requests
+
+def test_zenodo_zip_member():
+    import io
+    import json
+    import random
+    import zipfile
+    import app
+    import http_client
+
+    random.seed(0)
+    # Compressible but not trivially, and bigger than a streaming chunk once inflated
+    spectra = "".join("{} {:.4f}\n".format(i, random.random()) for i in range(200000)).encode("utf-8")
+
+    output_buffer = io.BytesIO()
+    with zipfile.ZipFile(output_buffer, "w") as zip_file:
+        zip_file.writestr("first/a.mzML", spectra, compress_type=zipfile.ZIP_DEFLATED)
+        zip_file.writestr("first/b.mzML", spectra[:1000], compress_type=zipfile.ZIP_STORED)
+        zip_file.writestr("first/c.mzML", spectra, compress_type=zipfile.ZIP_BZIP2)
+        zip_file.writestr("first/d.mzML", spectra, compress_type=zipfile.ZIP_LZMA)
+    zip_content = output_buffer.getvalue()
+
+    zip_requests = []
+
+    def _handle_get(handler):
+        path = handler.path.split("?")[0]
+
+        if path.startswith("/records/"):
+            record = {
+                "metadata": {"title": "Record", "description": "Stub record"},
+                "files": [{"key": "first.zip", "checksum": "md5:member", "links": {"self": base_url + "/files/first.zip"}}]
+            }
+            return 200, json.dumps(record)
+
+        zip_requests.append(handler.headers.get("Range"))
+        return _ranged_response(handler, zip_content)
+
+    with _stub_server(_handle_get) as base_url, _temp_dataset_cache(), _patched(zenodo, RECORD_URL=base_url + "/records/{}"), _patched(http_client, _session=None):
+        client = app.server.test_client()
+
+        for member_filename, expected_content in [("first/a.mzML", spectra), ("first/b.mzML", spectra[:1000]), ("first/c.mzML", spectra)]:
+            r = client.get("/api/zenodo/ZENODO-3/member", query_string={"zip": "first.zip", "member": member_filename})
+            assert r.status_code == 200
+            assert r.is_streamed
+            assert int(r.headers["Content-Length"]) == len(expected_content)
+            assert r.get_data() == expected_content
+
+        # Only ranges of the archive are read, never all of it
+        assert None not in zip_requests
+
+        r = client.get("/api/zenodo/ZENODO-3/member", query_string={"zip": "first.zip", "member": "first/d.mzML"})
+        assert r.status_code == 501
+
+        r = client.get("/api/zenodo/ZENODO-3/member", query_string={"zip": "first.zip", "member": "first/missing.mzML"})
+        assert r.status_code == 404
+
+def test_mtbls_assay_metadata():
+    import json
+    import time
+    import pandas as pd
+    import http_client
+
+    assay_tables = {
+        "a_first.txt": "Sample Name\tParameter Value[Instrument]\tComment[Instrument]\tParameter Value[Scan polarity]\tRaw Spectral Data File\tDerived Spectral Data File\tProtocol REF\n"
+                       "s1\tQ Exactive\tignored\tpositive\tFILES/s1.raw\tFILES/s1.mzML\tMS\n",
+        "a_second.txt": "Sample Name\tParameter Value[Instrument manufacturer]\tRaw Spectral Data File\tDerived Spectral Data File\n"
+                        "s2\tThermo\tFILES/s2.raw\t\n",
+        "a_third.txt": "Sample Name\tParameter Value[Instrument]\tRaw Spectral Data File\tDerived Spectral Data File\n"
+                       "s3\tTimsTOF\tFILES/s3.d\t\n",
+    }
+    timestamps = {filename: "20240101000000" for filename in assay_tables}
+    requests_per_path = {}
+
+    def _handle_get(handler):
+        path = handler.path.split("?")[0]
+        requests_per_path[path] = requests_per_path.get(path, 0) + 1
+
+        # No study document, so the assay tables are downloaded one by one
+        if "/public/study/" in path:
+            return 404, ""
+
+        if path.endswith("/files"):
+            study_files = [{"file": "s_study.txt", "status": "active", "type": "metadata_sample"}]
+            study_files += [{"file": filename, "status": "active", "type": "metadata_assay", "timestamp": timestamps[filename]} for filename in assay_tables]
+            return 200, json.dumps({"study": study_files})
+
+        # Every assay takes a while to download
+        time.sleep(0.3)
+        return 200, assay_tables[path.split("/")[-1]]
+
+    with _stub_server(_handle_get) as base_url, _temp_dataset_cache(), _patched(http_client, _session=None), \
+            _patched(metabolights, SWAGGER_API=base_url + "/ws", ASSAY_BASE_URL=base_url + "/studies"):
+        files_df = pd.DataFrame({"filename": ["FILES/s1.mzML", "FILES/s2.raw", "FILES/s3.d", "FILES/other.mzML"]})
+
+        start_time = time.time()
+        metadata_df = metabolights.add_mtbls_metadata(files_df.copy(), "MTBLS1")
+        elapsed_time = time.time() - start_time
+
+        assert list(metadata_df.columns) == ["filename", "Instrument", "Instrument manufacturer", "Scan polarity"]
+        assert list(metadata_df["Instrument"].fillna("")) == ["Q Exactive", "", "TimsTOF", ""]
+        assert list(metadata_df["Instrument manufacturer"].fillna("")) == ["", "Thermo", "", ""]
+        assert metadata_df["Scan polarity"].iloc[0] == "positive"
+
+        # The assays are downloaded at the same time
+        assert elapsed_time < 0.3 * 2
+
+        # Assays that didn't change are not downloaded again, even after a restart
+        dataset_cache.clear_memory()
+        http_client.get_session().cache.delete(urls=[metabolights.SWAGGER_API + "/studies/MTBLS1/files?include_raw_data=false"])
+        timestamps["a_third.txt"] = "20250101000000"
+        assay_tables["a_third.txt"] = assay_tables["a_third.txt"].replace("TimsTOF", "timsTOF Pro")
+
+        metadata_df = metabolights.add_mtbls_metadata(files_df.copy(), "MTBLS1")
+        assert metadata_df["Instrument"].iloc[2] == "timsTOF Pro"
+        assert requests_per_path["/studies/MTBLS1/a_first.txt"] == 1
+        assert requests_per_path["/studies/MTBLS1/a_third.txt"] == 2
+
+def test_mtbls_study_document():
+    import json
+    import pandas as pd
+    import http_client
+
+    def _assay(technology, headers, data):
+        # The fields are not in column order in the document
+        fields = {"{}_{}".format(index, header): {"index": index, "header": header, "description": ""} for index, header in reversed(list(enumerate(headers)))}
+        return {"technology": technology, "assayTable": {"fields": fields, "data": data}}
+
+    study_document = {
+        "content": {
+            "title": "Stub study",
+            "description": "Stub description",
+            "assays": [
+                _assay("mass spectrometry",
+                    ["Sample Name", "Parameter Value[Instrument]", "Term Source REF", "Term Source REF", "Raw Spectral Data File", "Derived Spectral Data File"],
+                    [["s1", "Q Exactive", "MS", "MS", "FILES/s1.raw", "FILES/s1.mzML"], ["s2", "Q Exactive", "MS", "MS", "FILES/s2.raw", ""]]),
+                _assay("mass spectrometry",
+                    ["Sample Name", "Parameter Value[Scan polarity]", "Raw Spectral Data File"],
+                    [["s3", "negative", "FILES/s3.d"]]),
+                _assay("NMR spectroscopy",
+                    ["Sample Name", "Free Induction Decay Data File"],
+                    [["s4", "FILES/s4.zip"]]),
+            ]
+        }
+    }
+    requests_per_path = {}
+
+    def _handle_get(handler):
+        path = handler.path.split("?")[0]
+        requests_per_path[path] = requests_per_path.get(path, 0) + 1
+
+        if path == "/ws/studies/public/study/MTBLS2":
+            return 200, json.dumps(study_document)
+
+        return 404, ""
+
+    with _stub_server(_handle_get) as base_url, _temp_dataset_cache(), _patched(http_client, _session=None), \
+            _patched(metabolights, SWAGGER_API=base_url + "/ws", ASSAY_BASE_URL=base_url + "/studies", _get_mtbls_files_cached=lambda accession: pd.DataFrame()):
+        adapter = metabolights.MetabolightsAdapter()
+
+        files_df = adapter.list_files("MTBLS2")
+        assert sorted(files_df["filename"]) == ["FILES/s1.mzML", "FILES/s1.raw", "FILES/s2.raw", "FILES/s3.d"]
+
+        assert adapter.describe("MTBLS2") == ("Stub study", "Stub description")
+
+        metadata_df = adapter.add_metadata(files_df, "MTBLS2")
+        assert list(metadata_df.columns) == ["filename", "Instrument", "Scan polarity"]
+        assert metadata_df.set_index("filename")["Instrument"]["FILES/s2.raw"] == "Q Exactive"
+        assert metadata_df.set_index("filename")["Scan polarity"]["FILES/s3.d"] == "negative"
+
+        # Everything came from the one study document
+        assert requests_per_path == {"/ws/studies/public/study/MTBLS2": 1}
+
+def test_norman_catalog():
+    import json
+    import threading
+    import http_client
+
+    catalog = [{"uuid": "uuid-{}".format(i), "internal_id": 100 + i, "title": "Dataset {}".format(i), "description": "Stub"} for i in range(3)]
+    new_dataset = {"uuid": "uuid-new", "internal_id": 200, "title": "New dataset", "description": "Not in the catalog yet"}
+    requests_per_path = {}
+    catalog_event = threading.Event()
+
+    def _handle_get(handler):
+        path = handler.path.split("?")[0]
+        requests_per_path[path] = requests_per_path.get(path, 0) + 1
+
+        if path == "/api/all":
+            # The catalog only loads once the test lets it
+            catalog_event.wait(10)
+            return 200, json.dumps(catalog)
+        if path.startswith("/api/items/"):
+            datasets = {dataset["uuid"]: dataset for dataset in catalog + [new_dataset]}
+            if path.split("/")[-1] not in datasets:
+                return 404, ""
+            return 200, json.dumps(datasets[path.split("/")[-1]])
+
+        internal_id = path.split("/")[2]
+        return 200, "sample_id,data_independent,data_dependent,data_fullscan\n" \
+                    "1,https://files.dsfp.norman-data.eu/sample/{0}/a.mzML,,https://files.dsfp.norman-data.eu/sample/{0}/b.raw\n".format(internal_id)
+
+    def _count_requests(function, *args):
+        # Upstream requests made for this call, not counting the catalog loading in the background
+        request_count = sum(requests_per_path.values()) - requests_per_path.get("/api/all", 0)
+        output = function(*args)
+        return output, sum(requests_per_path.values()) - requests_per_path.get("/api/all", 0) - request_count
+
+    with _stub_server(_handle_get) as base_url, _temp_dataset_cache(), _patched(http_client, _session=None), \
+            _patched(norman, NORMAN_API=base_url + "/api", NORMAN_FILES_URL=base_url + "/data/{}/files.csv", _catalog_future=None):
+        # While the catalog is loading, only the dataset itself is asked for
+        files_df, request_count = _count_requests(norman._get_norman_files, "NORMAN-uuid-0")
+        assert list(files_df["filename"]) == ["a.mzML", "b.raw"]
+        assert request_count == 2
+
+        catalog_event.set()
+        norman._catalog_future.result()
+        assert requests_per_path["/api/all"] == 1
+
+        # Once loaded, only the files of the dataset are downloaded
+        for i in range(1, 3):
+            files_df, request_count = _count_requests(norman._get_norman_files, "NORMAN-uuid-{}".format(i))
+            assert list(files_df["usi"]) == ["mzspec:NORMAN-uuid-{0}:sample/{1}/a.mzML".format(i, 100 + i), "mzspec:NORMAN-uuid-{0}:sample/{1}/b.raw".format(i, 100 + i)]
+            assert request_count == 1
+
+        # The description comes from the catalog as well
+        information, request_count = _count_requests(norman._get_norman_dataset_information, "NORMAN-uuid-2")
+        assert information == ("Dataset 2", "Stub")
+        assert request_count == 0
+
+        # Datasets newer than the catalog are still found
+        files_df, request_count = _count_requests(norman._get_norman_files, "NORMAN-uuid-new")
+        assert len(files_df) == 2
+        assert request_count == 2
+
+        try:
+            norman._get_norman_files("NORMAN-uuid-missing")
+            assert False
+        except ValueError:
+            pass
+
+        assert requests_per_path["/api/all"] == 1
 
 def main():
     #test_msv()
@@ -1,6 +1,8 @@
 
 import pandas as pd
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import metabolights
 import zenodo
@@ -8,10 +10,29 @@ import norman
 import workbench
 import pxd
 
-import requests
 import requests_cache
 requests_cache.install_cache('requests_cache', expire_after=86400)
 
+import dataset_cache
+import redu_snapshot
+import filename_mirror
+import repositories
+import http_client
+import deadline
+import circuit_breaker
+import ftp_listing
+import private_cache
+
+# Names of the circuit breakers for the MassIVE listings that don't go through http_client
+MASSIVE_HOST = "massive.ucsd.edu"
+MASSIVE_FTP_BREAKER = "ftp://massive.ucsd.edu"
+
+# Independent upstream requests for a dataset are issued on this pool at the same time
+_fetch_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="dataset-fetch")
+
+# gnpsdata takes no timeout, so its listings run here and we only wait for them within the deadline
+_gnpsdata_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gnpsdata")
+
 def get_dataset_files(accession, metadata_source, dataset_password="", metadata_option=None):
     """This gives a pandas dataframe with files and appended metadata
 
@@ -23,47 +44,34 @@ def get_dataset_files(accession, metadata_source, dataset_password="", metadata_
         [type]: [description]
     """
 
-    file_df = pd.DataFrame()
+    files_df = repositories.get_dataset_files(accession, metadata_source, dataset_password=dataset_password, metadata_option=metadata_option)
 
-    if "MSV" in accession:
-        files_df = _get_massive_files(accession, dataset_password=dataset_password)
+    files_df = _add_usi_column(files_df, accession, private=len(dataset_password) > 0)
 
-        if metadata_source == "REDU":
-            files_df = _add_redu_metadata(files_df, accession)
-        elif metadata_source == "MASSIVE":
-            files_df = _add_massive_metadata(files_df, accession, metadata_option=metadata_option)
-    elif "MTBLS" in accession:
-        files_df = metabolights._get_mtbls_files(accession)
-        files_df = metabolights.add_mtbls_metadata(files_df, accession)
-
-    elif "PXD" in accession:
-        all_files = pxd._get_pxd_files(accession)
-        files_df = pd.DataFrame(all_files)
-
-    elif "ST" in accession:
-        files_df = workbench._get_metabolomicsworkbench_files(accession)
-
-        #if metadata_source == "REDU":
-        #    files_df = _add_redu_metadata(files_df, msv_accession)
-        #elif metadata_source == "MASSIVE":
-        #    files_df = _add_massive_metadata(files_df, msv_accession, metadata_option=metadata_option)
-    
-    elif "ZENODO" in accession:
-        all_files = zenodo._get_zenodo_files(accession)
-        files_df = pd.DataFrame()
-        files_df["filename"] = all_files
-    
-    elif "NORMAN" in accession:
-        # This gets all the metadata as well
-        files_df = norman._get_norman_files(accession)
+    return files_df   
 
-    elif len(accession) == 32:
-        # We're likely looking at a uuid from GNPS, lets hit the API
-        all_files = _get_gnps_task_files(accession)
-        files_df = pd.DataFrame(all_files)
-        files_df = _add_task_metadata(files_df, accession)
+def get_usi_prefix(accession, private=False):
+    adapter = repositories.get_adapter(accession) or repositories.RepositoryAdapter
 
-    return files_df   
+    if private:
+        return adapter.private_usi_prefix_format.format(accession)
+
+    return adapter.usi_prefix_format.format(accession)
+
+def get_gnps_path_prefix(accession):
+    adapter = repositories.get_adapter(accession) or repositories.RepositoryAdapter
+
+    return adapter.gnps_path_prefix_format.format(accession)
+
+def _add_usi_column(files_df, accession, private=False):
+    # Some repositories already give us the USIs
+    if "usi" in files_df or "filename" not in files_df:
+        return files_df
+
+    # Building all the USIs at once for the whole dataset
+    files_df["usi"] = get_usi_prefix(accession, private=private) + files_df["filename"].map(str)
+
+    return files_df
 
 def get_dataset_description(accession):
     """Getting title and description of a dataset
@@ -75,37 +83,17 @@ def get_dataset_description(accession):
         [type]: [description]
     """
 
-    dataset_title = "Dataset Title - Invalid Accession"
-    dataset_description = "Error Description - Invalid Accession"
+    if repositories.get_adapter(accession) is None:
+        return "Dataset Title - Invalid Accession", "Error Description - Invalid Accession"
 
-    if "MSV" in accession:
-        dataset_title, dataset_description = _get_massive_dataset_information(accession)
+    dataset_title, dataset_description = repositories.describe(accession)
 
-    if "MTBLS" in accession:
-        dataset_title, dataset_description = metabolights._get_mtbls_dataset_information(accession)
-
-    if "PXD" in accession:
-        dataset_title, dataset_description = pxd._get_pxd_dataset_information(accession)
-    
-    if "ST" in accession:
-        dataset_title, dataset_description = workbench._get_metabolomicsworkbench_dataset_information(accession)
-
-    if "ZENODO" in accession:
-        dataset_title, dataset_description = zenodo._get_zenodo_dataset_information(accession)
-    
-    if "NORMAN" in accession:
-        dataset_title, dataset_description = norman._get_norman_dataset_information(accession)
-
-    elif len(accession) == 32:
-        # We're likely looking at a uuid from GNPS, lets hit the API
-        dataset_title, dataset_description = _get_gnps_task_information(accession)
-
-    return  dataset_title, dataset_description
+    return dataset_title, dataset_description
 
 
 def _get_gnps_task_files(gnps_task):
     url = "https://gnps.ucsd.edu/ProteoSAFe/ManageParameters?task={}".format(gnps_task)
-    r = requests.get(url)
+    r = http_client.get(url)
     import xmltodict
     r_json = xmltodict.parse(r.text)
 
@@ -117,7 +105,7 @@ def _get_gnps_task_files(gnps_task):
 
     acceptable_extensions = [".mzml", ".mzxml", ".cdf", ".raw", ".mgf"]
 
-    all_files = [filename for filename in all_files if os.path.splitext(filename)[1].lower() in acceptable_extensions]
+    all_files = [filename for filename in all_files if repositories.has_acceptable_extension(filename, acceptable_extensions)]
 
     output_list = []
     for filename in all_files:
@@ -129,33 +117,41 @@ def _get_gnps_task_files(gnps_task):
 
 def _get_gnps_task_information(accession):
     url = "https://gnps.ucsd.edu/ProteoSAFe/status_json.jsp?task={}".format(accession)
-    r = requests.get(url)
+    r = http_client.get(url)
     task_information = r.json()
 
     return task_information["description"], "ProteoSAFe Task {} - Workflow {} - Version {} - User {}".format(accession, task_information["workflow"], task_information["workflow_version"], task_information["user"])
 
 def _get_massive_files(dataset_accession, dataset_password=""):
+    # Private datasets are only on FTP, their listing is cached encrypted with the password
+    if len(dataset_password) > 0:
+        all_files_df = private_cache.get_listing(dataset_accession, dataset_password, lambda: _get_massive_files_ftp(dataset_accession, dataset_password=dataset_password))
+        return repositories.shape_cached_files(all_files_df)
+
     all_files_df = pd.DataFrame()
 
     # Trying to use the file cache
     try:
         all_files_df = _get_massive_files_cached(dataset_accession)
+    except deadline.DeadlineExceeded:
+        raise
     except:
         pass
 
     # Trying to use the HTTPS endpoint
     if len(all_files_df) == 0:
         try:
-            from gnpsdata import publicdata
-            all_files = publicdata.get_massive_public_dataset_filelist(dataset_accession)
+            all_files = deadline.result(deadline.submit(_gnpsdata_executor, _get_massive_files_gnpsdata, dataset_accession))
 
             acceptable_extensions = [".mzml", ".mzxml", ".cdf", ".raw", ".mgf"]
 
-            all_files = [fileobj for fileobj in all_files if os.path.splitext(fileobj["file_descriptor"])[1].lower() in acceptable_extensions]
+            all_files = [fileobj for fileobj in all_files if repositories.has_acceptable_extension(fileobj["file_descriptor"], acceptable_extensions)]
 
             all_files_df = pd.DataFrame(all_files)
             all_files_df["filepath"] = all_files_df["file_descriptor"].apply(lambda x: x.replace("f.", ""))
 
+        except deadline.DeadlineExceeded:
+            raise
         except:
             pass
 
@@ -164,41 +160,38 @@ def _get_massive_files(dataset_accession, dataset_password=""):
 
     all_files_df["filepath"] = all_files_df["filepath"].apply(lambda x: x.replace(dataset_accession + "/", "") )
     
-    files_df = pd.DataFrame()
-    files_df["filename"] = all_files_df["filepath"]
+    return repositories.shape_cached_files(all_files_df)
 
-    # Adding more information if possible
-    if "collection" in all_files_df:
-        files_df["collection"] = all_files_df["collection"]
-        
-    if "update_name" in all_files_df:
-        files_df["update_name"] = all_files_df["update_name"]
 
-    if "size_mb" in all_files_df:
-        files_df["size_mb"] = all_files_df["size_mb"]
-        files_df["ms2"] = all_files_df["spectra_ms2"]
-        files_df["Vendor"] = all_files_df["instrument_vendor"]
-        files_df["Model"] = all_files_df["instrument_model"]
+def _get_massive_files_gnpsdata(dataset_accession):
+    from gnpsdata import publicdata
 
-    return files_df
+    with circuit_breaker.guard(MASSIVE_HOST, is_failure=circuit_breaker.is_network_error):
+        return publicdata.get_massive_public_dataset_filelist(dataset_accession)
+
+def _is_ftp_failure(error):
+    import ftplib
 
+    # A wrong password is an answer from a working server, a dropped connection or "service not available" is not
+    return circuit_breaker.is_network_error(error) or isinstance(error, (EOFError, ftplib.error_temp))
 
 def _get_massive_files_ftp(dataset_accession, dataset_password=""):
-    import ftputil
-    import ming_proteosafe_library
+    folder_prefixes = ["ccms_peak", "peak", "raw"]
 
+    # Private datasets log in to their own folder
     if len(dataset_password) > 0:
-        massive_host = ftputil.FTPHost("massive.ucsd.edu", dataset_accession, dataset_password)
+        user = dataset_accession
+        directories = folder_prefixes
     else:
-        massive_host = ftputil.FTPHost("massive.ucsd.edu", "anonymous", "")
+        user = "anonymous"
+        directories = [dataset_accession + "/" + folder_prefix for folder_prefix in folder_prefixes]
 
-    all_files = ming_proteosafe_library.get_all_files_in_dataset_folder_ftp(dataset_accession, "ccms_peak", massive_host=massive_host, dataset_password=dataset_password)
-    all_files += ming_proteosafe_library.get_all_files_in_dataset_folder_ftp(dataset_accession, "peak", massive_host=massive_host, dataset_password=dataset_password)
-    all_files += ming_proteosafe_library.get_all_files_in_dataset_folder_ftp(dataset_accession, "raw", massive_host=massive_host, dataset_password=dataset_password)
+    with circuit_breaker.guard(MASSIVE_FTP_BREAKER, is_failure=_is_ftp_failure):
+        all_files = ftp_listing.walk_files(MASSIVE_HOST, directories, user=user, password=dataset_password)
 
     acceptable_extensions = [".mzml", ".mzxml", ".cdf", ".raw"]
 
-    all_files = [filename for filename in all_files if os.path.splitext(filename)[1].lower() in acceptable_extensions]
+    all_files = [filename for filename in all_files if repositories.has_acceptable_extension(filename, acceptable_extensions)]
 
     all_files_df = pd.DataFrame()
     all_files_df["filepath"] = all_files
@@ -207,23 +200,15 @@ def _get_massive_files_ftp(dataset_accession, dataset_password=""):
 
 def _get_massive_files_cached(dataset_accession):
 
-    url = "https://datasetcache.gnps2.org/datasette/database/filename.csv?_sort=filepath&dataset__exact={}&_size=max".format(dataset_accession)
-
-    all_files_df = pd.read_csv(url, sep=",")
-
-    all_files = list(all_files_df["filepath"])
-
     acceptable_extensions = [".mzml", ".mzxml", ".cdf", ".raw"]
-    
-    all_files = [filename for filename in all_files if os.path.splitext(filename)[-1].lower() in acceptable_extensions]
 
-    all_files_df = all_files_df[all_files_df["filepath"].isin(all_files)]
+    all_files_df = filename_mirror.get_dataset_files(dataset_accession, acceptable_extensions=acceptable_extensions)
 
     return all_files_df
 
 def _get_massive_dataset_information(dataset_accession):
     url = "http://massive.ucsd.edu/ProteoSAFe/proxi/v0.1/datasets/{}".format(dataset_accession)
-    r = requests.get(url)
+    r = http_client.get(url)
     dataset_information = r.json()
 
     return dataset_information["title"], dataset_information["summary"]
@@ -231,9 +216,9 @@ def _get_massive_dataset_information(dataset_accession):
 def _accession_to_msv_accession(accession):
     msv_accession = accession
 
-    if "ST" in accession:
+    if isinstance(repositories.get_adapter(accession), workbench.WorkbenchAdapter):
         url = "https://massive.ucsd.edu/ProteoSAFe/QueryDatasets?task=N%2FA&file=&pageSize=30&offset=0&query=%257B%2522full_search_input%2522%253A%2522%2522%252C%2522table_sort_history%2522%253A%2522createdMillis_dsc%2522%252C%2522query%2522%253A%257B%257D%252C%2522title_input%2522%253A%2522{}%2522%257D&target=&_=1606254845533".format(accession)
-        r = requests.get(url)
+        r = http_client.get(url)
         data_json = r.json()
 
         msv_accession = data_json["row_data"][0]["dataset"]
@@ -243,12 +228,11 @@ def _accession_to_msv_accession(accession):
 
 
 
-def _add_redu_metadata(files_df, accession):
-
+def _get_redu_metadata(accession):
     try:
         # Lets try doing this the fast way with using the server side filtering to a dataset
         url = "https://redu.gnps2.org/attribute/ATTRIBUTE_DatasetAccession/attributeterm/{}/files".format(accession)
-        redu_metadata_df = pd.read_json(url)
+        redu_metadata_df = http_client.read_json(url)
 
         # checking if empty, if yes, then we'll add a column called filename
         if len(redu_metadata_df) == 0:
@@ -257,12 +241,17 @@ def _add_redu_metadata(files_df, accession):
             redu_metadata_df["MassSpectrometer"] = []
             redu_metadata_df["SampleType"] = []
             redu_metadata_df["SampleTypeSub1"] = []
+    except deadline.DeadlineExceeded:
+        raise
     except:
-        redu_metadata_df = pd.read_csv("https://redu.gnps2.org/dump", sep='\t')
+        # Reading just this dataset from the local copy of the full ReDU table
+        redu_metadata_df = redu_snapshot.get_dataset_metadata(accession)
 
-        # filtering by dataset
-        redu_metadata_df = redu_metadata_df[redu_metadata_df["ATTRIBUTE_DatasetAccession"] == accession]
+    return redu_metadata_df
 
+def _add_redu_metadata(files_df, accession, redu_metadata_df=None):
+    if redu_metadata_df is None:
+        redu_metadata_df = _get_redu_metadata(accession)
 
     # Making sure the filenames match
     files_df["filename"] = "f." + files_df["filename"]
@@ -280,22 +269,69 @@ def _add_redu_metadata(files_df, accession):
     return files_df
 
 
+# Task ids of MassIVE datasets never change, the bulk index is refreshed daily to pick up new datasets
+MASSIVE_INDEX_TTL = (86400, 30 * 86400)
+MASSIVE_TASK_TTL = (30 * 86400, 90 * 86400)
+
+_massive_index_lock = threading.Lock()
+_massive_index_future = None
+
+@dataset_cache.memoize(ttl_function=lambda *args: MASSIVE_INDEX_TTL)
+def _get_massive_dataset_index():
+    import ming_proteosafe_library
+
+    all_datasets = ming_proteosafe_library.get_all_datasets()
+
+    return {dataset["dataset"]: dataset["task"] for dataset in all_datasets}
+
+def _get_massive_dataset_index_if_loaded():
+    global _massive_index_future
+
+    # The first load of the whole index is slow, so it happens in the background and we don't wait for it
+    with _massive_index_lock:
+        if _massive_index_future is None or (_massive_index_future.done() and _massive_index_future.exception() is not None):
+            _massive_index_future = _fetch_executor.submit(_get_massive_dataset_index)
+
+        if not _massive_index_future.done():
+            return None
+
+    # Once loaded it comes from the dataset cache, which also refreshes it in the background
+    try:
+        return _get_massive_dataset_index()
+    except:
+        return None
+
+@dataset_cache.memoize(ttl_function=lambda *args: MASSIVE_TASK_TTL)
+def _get_massive_dataset_task_uncached(accession):
+    dataset_information = http_client.get("https://massive.ucsd.edu/ProteoSAFe/MassiveServlet?function=massiveinformation&massiveid={}".format(accession)).json()
+
+    return dataset_information["task"]
+
+def _get_massive_dataset_task(accession):
+    massive_index = _get_massive_dataset_index_if_loaded()
+
+    if massive_index is not None and accession in massive_index:
+        return massive_index[accession]
+
+    # Not in the index yet, e.g. a new dataset, so we ask for just this one
+    return _get_massive_dataset_task_uncached(accession)
+
+@dataset_cache.memoize()
 def _get_massive_metadata_options(accession):
-    dataset_information = requests.get("https://massive.ucsd.edu/ProteoSAFe/MassiveServlet?function=massiveinformation&massiveid={}&_=1601057558273".format(accession)).json()
-    dataset_task = dataset_information["task"]
+    dataset_task = _get_massive_dataset_task(accession)
 
     url = "https://massive.ucsd.edu/ProteoSAFe/result_json.jsp?task={}&view=view_metadata_list".format(dataset_task)
-    metadata_list = requests.get("https://massive.ucsd.edu/ProteoSAFe/result_json.jsp?task={}&view=view_metadata_list".format(dataset_task)).json()["blockData"]
+    metadata_list = http_client.get(url).json()["blockData"]
 
     return metadata_list
 
-def _add_massive_metadata(files_df, accession, metadata_option=None):
+def _get_massive_metadata(accession, metadata_option=None):
     try:
         # Getting massive task from accession
         metadata_list = _get_massive_metadata_options(accession)
 
         if len(metadata_list) == 0:
-            return files_df
+            return None
         
         if metadata_option is not None and len(metadata_option) > 0:
             metadata_filename = [metadata_file["File_descriptor"] for metadata_file in metadata_list if metadata_file["File_descriptor"] == metadata_option][0]
@@ -305,10 +341,25 @@ def _add_massive_metadata(files_df, accession, metadata_option=None):
         #ftp_url = "ftp://massive.ucsd.edu/{}".format(metadata_filename.replace("f.", ""))
         http_url = "https://proteomics2.ucsd.edu/ProteoSAFe/DownloadResultFile?file={}&block=main".format(metadata_filename)
 
-        metadata_df = pd.read_csv(http_url, sep=None)
+        metadata_df = http_client.read_csv(http_url, sep=None)
         # Clean the filename path
         metadata_df["filename"] = metadata_df["filename"].apply(lambda x: os.path.basename(x))
+    except deadline.DeadlineExceeded:
+        # Not the same as having no metadata, so the files without it don't end up in the cache
+        raise
+    except:
+        return None
+
+    return metadata_df
+
+def _add_massive_metadata(files_df, accession, metadata_option=None, metadata_df=None):
+    if metadata_df is None:
+        metadata_df = _get_massive_metadata(accession, metadata_option=metadata_option)
+
+    if metadata_df is None:
+        return files_df
 
+    try:
         files_df["fullfilename"] = files_df["filename"]
         files_df["filename"] = files_df["filename"].apply(lambda x: os.path.basename(x))
         files_df = files_df.merge(metadata_df, how="left", on="filename")
@@ -324,7 +375,7 @@ def _add_task_metadata(files_df, task):
     try:
         # Trying to get classical network metadata
         url = "https://gnps.ucsd.edu/ProteoSAFe/result_json.jsp?task={}&view=view_metadata".format(task)
-        metadata_df = pd.DataFrame(requests.get(url).json()["blockData"])
+        metadata_df = pd.DataFrame(http_client.get(url).json()["blockData"])
 
         files_df["fullfilename"] = files_df["filename"]
         files_df["filename"] = files_df["fullfilename"].apply(lambda x: os.path.basename(x))
@@ -342,7 +393,7 @@ def _add_task_metadata(files_df, task):
 
 def get_accession_from_doi(doi):
     url = "https://doi.org/{}".format(doi)
-    r = requests.get(url)
+    r = http_client.get(url)
     
     # we are going to parse result with bs4
     from bs4 import BeautifulSoup
@@ -355,4 +406,54 @@ def get_accession_from_doi(doi):
     
     return accession
 
-    
\ No newline at end of file
+    
+
+
+class MassiveAdapter(repositories.RepositoryAdapter):
+    name = "MassIVE"
+    accession_pattern = r"^MSV\d+$"
+    ttl = (6 * 3600, 7 * 86400)
+    max_concurrency = 8
+    capabilities = frozenset([repositories.CAPABILITY_PRIVATE, repositories.CAPABILITY_REDU_METADATA, repositories.CAPABILITY_MASSIVE_METADATA, repositories.CAPABILITY_METADATA_OPTIONS])
+
+    def list_files(self, accession, dataset_password=""):
+        return _get_massive_files(accession, dataset_password=dataset_password)
+
+    def describe(self, accession):
+        return _get_massive_dataset_information(accession)
+
+    def get_dataset_files(self, accession, metadata_source, dataset_password="", metadata_option=None):
+        # The file listing and the metadata don't depend on each other, so we fetch them together, within the same deadline
+        files_future = deadline.submit(_fetch_executor, _get_massive_files, accession, dataset_password=dataset_password)
+
+        if metadata_source == "REDU":
+            redu_metadata_future = deadline.submit(_fetch_executor, _get_redu_metadata, accession)
+            return _add_redu_metadata(deadline.result(files_future), accession, redu_metadata_df=deadline.result(redu_metadata_future))
+        elif metadata_source == "MASSIVE":
+            massive_metadata_future = deadline.submit(_fetch_executor, _get_massive_metadata, accession, metadata_option=metadata_option)
+            return _add_massive_metadata(deadline.result(files_future), accession, metadata_option=metadata_option, metadata_df=deadline.result(massive_metadata_future))
+
+        return deadline.result(files_future)
+
+class GnpsTaskAdapter(repositories.RepositoryAdapter):
+    name = "GNPS Task"
+    accession_pattern = r"^[0-9a-fA-F]{32}$"
+
+    # GNPS tasks never change once they are done
+    ttl = (30 * 86400, 90 * 86400)
+
+    usi_prefix_format = "mzspec:GNPS:TASK-{}-"
+    private_usi_prefix_format = "mzspec:GNPS:TASK-{}-"
+    gnps_path_prefix_format = "f."
+
+    def list_files(self, accession, dataset_password=""):
+        return pd.DataFrame(_get_gnps_task_files(accession))
+
+    def describe(self, accession):
+        return _get_gnps_task_information(accession)
+
+    def add_metadata(self, files_df, accession, metadata_source=None, metadata_option=None):
+        return _add_task_metadata(files_df, accession)
+
+repositories.register(MassiveAdapter())
+repositories.register(GnpsTaskAdapter())
@@ -1,52 +1,214 @@
-import json
-import requests
+import bz2
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from remotezip import RemoteZip
+import pandas as pd
 
+import repositories
+import dataset_cache
+import http_client
+import deadline
 
-def _get_zenodo_files(dataset_accession):
-    zenodo_id = dataset_accession.replace("ZENODO", "").replace("-", "")
+RECORD_URL = "https://zenodo.org/api/records/{}"
 
-    zenodo_url = "https://zenodo.org/api/records/{}".format(zenodo_id)
-    r = requests.get(zenodo_url)
+# The record is shared by the file listing and the description, new versions of a record get a new id
+RECORD_TTL = (86400, 7 * 86400)
 
-    all_filenames = []
+# Zip contents are cached by the checksum of the archive, so they never change
+ZIP_MEMBERS_TTL = (365 * 86400, 365 * 86400)
+
+# Central directories of the zips of a record are read at the same time
+ZIP_WORKERS = 4
+
+# Members are streamed straight from the archive, a chunk at a time
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Fixed part of the local file header, followed by the name and the extra field, then the data
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+# Compression methods we can inflate on the fly
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_BZIP2 = 12
+
+_zip_executor = ThreadPoolExecutor(max_workers=ZIP_WORKERS, thread_name_prefix="zenodo-zip")
+
+
+def _get_zenodo_id(dataset_accession):
+    return dataset_accession.replace("ZENODO", "").replace("-", "")
+
+@dataset_cache.memoize(ttl_function=lambda *args: RECORD_TTL)
+def _get_zenodo_record(zenodo_id):
+    r = http_client.get(RECORD_URL.format(zenodo_id))
+    r.raise_for_status()
+
+    return r.json()
+
+@dataset_cache.memoize(ttl_function=lambda *args: ZIP_MEMBERS_TTL, key_function=lambda checksum, url: checksum or url)
+def _get_zip_index(checksum, url):
+    """Where every member of a zip is in the archive, so a single member can be read with a range request"""
+
+    # Only the end of the archive with the central directory is read, in a few ranged requests
+    with RemoteZip(url, session=http_client.get_session(), timeout=deadline.bound_timeout(http_client.DEFAULT_TIMEOUT)) as zip:
+        return [
+            {
+                "filename": zip_info.filename,
+                "header_offset": zip_info.header_offset,
+                "compress_size": zip_info.compress_size,
+                "file_size": zip_info.file_size,
+                "compress_type": zip_info.compress_type,
+                "flag_bits": zip_info.flag_bits,
+            }
+            for zip_info in zip.infolist()
+        ]
+
+def _get_zenodo_files(dataset_accession):
+    all_files = _get_zenodo_record(_get_zenodo_id(dataset_accession))['files']
 
     acceptable_extensions = (".raw", '.mzml', '.mzxml')
 
-    all_files = r.json()['files']
+    zip_files = [file for file in all_files if file['key'].endswith('.zip')]
+    zip_members_futures = [deadline.submit(_zip_executor, _get_zip_index, file.get('checksum'), file['links']['self']) for file in zip_files]
+    zip_members = dict(zip([file['key'] for file in zip_files], zip_members_futures))
 
+    all_filenames = []
     for file in all_files:
         if file['key'].lower().endswith(acceptable_extensions):
             all_filenames.append(file['key'])
 
-        if file['key'].endswith('.zip'):
-            url = file['links']['self']
+        if file['key'] in zip_members:
             zip_filename = file['key']
 
             # Finding all the filenames
-            with RemoteZip(url) as zip:
-                for zip_info in zip.infolist():
-                    actual_filename = zip_info.filename
-
-                    if "__MACOSX" in actual_filename:
-                        continue
+            for zip_member in deadline.result(zip_members[zip_filename]):
+                actual_filename = zip_member["filename"]
+                if "__MACOSX" in actual_filename:
+                    continue
 
-                    if actual_filename.endswith(".raw") or \
-                        actual_filename.endswith(".mzML") or \
-                        actual_filename.endswith(".mzXML"):
-                        
-                        all_filenames.append("{}-{}".format(zip_filename, actual_filename))
+                if actual_filename.endswith(".raw") or \
+                    actual_filename.endswith(".mzML") or \
+                    actual_filename.endswith(".mzXML"):
+                    
+                    all_filenames.append("{}-{}".format(zip_filename, actual_filename))
 
     return all_filenames
 
 def _get_zenodo_dataset_information(dataset_accession):
-    zenodo_id = dataset_accession.replace("ZENODO", "").replace("-", "")
-
-    zenodo_url = "https://zenodo.org/api/records/{}".format(zenodo_id)
-
-    dataset_information = requests.get(zenodo_url).json()
+    dataset_information = _get_zenodo_record(_get_zenodo_id(dataset_accession))
 
     title = dataset_information["metadata"]["title"]
     description = dataset_information["metadata"]["description"]
 
     return title, description
+
+def get_zip_member(record_id, zip_filename, member_filename):
+    """Finds a member of a zip of a Zenodo record
+
+    Returns:
+        (str, dict): url of the zip and the index entry of the member, None if there is no such member
+    """
+
+    for file in _get_zenodo_record(_get_zenodo_id(record_id))['files']:
+        if file['key'] != zip_filename:
+            continue
+
+        for zip_member in _get_zip_index(file.get('checksum'), file['links']['self']):
+            if zip_member["filename"] == member_filename:
+                return file['links']['self'], zip_member
+
+    return None
+
+def _get_decompressor(zip_member):
+    # Encrypted members can't be read without the password
+    if zip_member["flag_bits"] & 0x1:
+        raise NotImplementedError("Encrypted zip members are not supported")
+
+    if zip_member["compress_type"] == ZIP_STORED:
+        return None
+    if zip_member["compress_type"] == ZIP_DEFLATED:
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    if zip_member["compress_type"] == ZIP_BZIP2:
+        return bz2.BZ2Decompressor()
+
+    raise NotImplementedError("Unsupported zip compression method {}".format(zip_member["compress_type"]))
+
+def _get_range(url, start, stop, **kwargs):
+    # Never from the response cache, it doesn't tell ranges of the same url apart
+    r = http_client.get(url, headers={"Range": "bytes={}-{}".format(start, stop - 1), "Cache-Control": "no-store"}, **kwargs)
+    r.raise_for_status()
+
+    # A server ignoring the range would send us the whole archive
+    if r.status_code != 206:
+        r.close()
+        raise Exception("Range requests are not supported for {}".format(url))
+
+    return r
+
+def _decompress(decompressor, chunk):
+    # Bounded output per call, so a highly compressed chunk never has to be held in memory at once
+    if isinstance(decompressor, bz2.BZ2Decompressor):
+        yield decompressor.decompress(chunk, STREAM_CHUNK_SIZE)
+        while not decompressor.eof and not decompressor.needs_input:
+            yield decompressor.decompress(b"", STREAM_CHUNK_SIZE)
+        return
+
+    while len(chunk) > 0:
+        yield decompressor.decompress(chunk, STREAM_CHUNK_SIZE)
+        chunk = decompressor.unconsumed_tail
+
+def open_zip_member(url, zip_member):
+    """Starts reading a member of a remote zip
+
+    The local header is read first to know where the data starts, the data itself is then requested
+    as a single range and inflated as it arrives, so memory stays the same whatever the size of the archive.
+
+    Returns:
+        generator: the uncompressed content of the member, a chunk at a time
+    """
+
+    decompressor = _get_decompressor(zip_member)
+    if zip_member["compress_size"] == 0:
+        return iter([])
+
+    # The name and extra field lengths of the local header can differ from the central directory
+    header_offset = zip_member["header_offset"]
+    local_header = _get_range(url, header_offset, header_offset + LOCAL_HEADER.size).content
+    signature, *_, name_length, extra_length = LOCAL_HEADER.unpack(local_header)
+    if signature != LOCAL_HEADER_SIGNATURE:
+        raise Exception("Bad local file header for {}".format(zip_member["filename"]))
+
+    data_offset = header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+    r = _get_range(url, data_offset, data_offset + zip_member["compress_size"], stream=True)
+
+    def _stream():
+        with r:
+            for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if decompressor is None:
+                    yield chunk
+                else:
+                    yield from _decompress(decompressor, chunk)
+
+            # Only zlib keeps output back until the end
+            if hasattr(decompressor, "flush"):
+                yield decompressor.flush()
+
+    return _stream()
+
+
+class ZenodoAdapter(repositories.RepositoryAdapter):
+    name = "Zenodo"
+    accession_pattern = r"^ZENODO-?\d+$"
+    ttl = (7 * 86400, 90 * 86400)
+
+    def list_files(self, accession, dataset_password=""):
+        files_df = pd.DataFrame()
+        files_df["filename"] = _get_zenodo_files(accession)
+        return files_df
+
+    def describe(self, accession):
+        return _get_zenodo_dataset_information(accession)
+
+repositories.register(ZenodoAdapter())